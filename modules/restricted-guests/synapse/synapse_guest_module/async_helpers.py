@@ -0,0 +1,86 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Set, TypeVar
+
+from synapse.logging.context import PreserveLoggingContext
+from synapse.module_api import ModuleApi, make_deferred_yieldable, run_in_background
+from synapse.util.async_helpers import ObservableDeferred
+from twisted.internet import defer
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Coalesces concurrent calls that share a key: the first caller runs the
+    function, and every caller that arrives while it is still running waits for
+    and shares its result (or exception). Once the call completes, the next
+    caller starts a new one.
+    """
+
+    def __init__(self) -> None:
+        self._in_flight: Dict[Hashable, ObservableDeferred[T]] = {}
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Run `func`, or join the call for `key` that is already in flight.
+
+        Args:
+            key: Identifies the resource that is requested.
+            func: Produces the resource. Only called if no call for `key` is in
+                flight.
+
+        Returns:
+            The result of the (shared) call.
+        """
+        observable = self._in_flight.get(key)
+        if observable is None:
+            observable = ObservableDeferred(run_in_background(func), consumeErrors=True)
+            self._in_flight[key] = observable
+
+            def forget(_: Any) -> None:
+                if self._in_flight.get(key) is observable:
+                    del self._in_flight[key]
+
+            observable.observe().addBoth(forget)
+
+        # Every caller waits on its own observer, so that a cancelled caller
+        # doesn't cancel the shared call for all the others.
+        return await make_deferred_yieldable(observable.observe())
+
+
+class WakeableSleeper:
+    """Sleeps that can be ended early, e.g. when a background task learns that
+    there is new work for it.
+    """
+
+    def __init__(self, api: ModuleApi) -> None:
+        self._api = api
+        self._waiters: Set["defer.Deferred[None]"] = set()
+
+    def wake(self) -> None:
+        """Wake everything that is currently sleeping."""
+        waiters, self._waiters = self._waiters, set()
+        for waiter in waiters:
+            with PreserveLoggingContext():
+                waiter.callback(None)
+
+    async def sleep(self, seconds: float) -> None:
+        """Sleep for the given number of seconds, or until `wake` is called."""
+        waiter: "defer.Deferred[None]" = defer.Deferred()
+        self._waiters.add(waiter)
+        sleep = run_in_background(self._api.sleep, seconds)
+
+        try:
+            await make_deferred_yieldable(
+                defer.DeferredList(
+                    [sleep, waiter],
+                    fireOnOneCallback=True,
+                    fireOnOneErrback=True,
+                    consumeErrors=True,
+                )
+            )
+        finally:
+            self._waiters.discard(waiter)
+            sleep.cancel()
@@ -0,0 +1,106 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from collections import deque
+from typing import Any, Deque, List, Sequence, Tuple
+
+from synapse.logging.context import PreserveLoggingContext
+from synapse.module_api import (
+    DatabasePool,
+    LoggingTransaction,
+    ModuleApi,
+    make_deferred_yieldable,
+)
+from twisted.internet import defer
+
+# How many rows are inserted in a single transaction at most, unless a single
+# caller inserts more.
+MAX_BATCH_SIZE = 100
+
+
+class BatchInserter:
+    """Inserts rows into a table, combining the rows of concurrent callers into
+    multi-row inserts.
+
+    Rows are inserted right away if no insert is in flight. Otherwise they are
+    collected and inserted together once the insert in flight completes, so the
+    more callers there are, the larger the batches get. Every caller waits until
+    the transaction with its rows is committed, and gets its error if it fails.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        desc: str,
+        table: str,
+        keys: Sequence[str],
+        max_batch_size: int = MAX_BATCH_SIZE,
+    ):
+        self._api = api
+        self._desc = desc
+        self._table = table
+        self._keys = keys
+        self._max_batch_size = max_batch_size
+        # The rows of the waiting callers, and the Deferreds to fire once they
+        # are inserted.
+        self._pending: Deque[
+            Tuple[List[Tuple[Any, ...]], "defer.Deferred[None]"]
+        ] = deque()
+        self._flushing = False
+
+    async def insert(self, rows: List[Tuple[Any, ...]]) -> None:
+        """Insert the rows, and wait until they are committed.
+
+        Args:
+            rows: The values of each row, in the order of the keys
+        """
+        if len(rows) == 0:
+            return
+
+        inserted: "defer.Deferred[None]" = defer.Deferred()
+        self._pending.append((rows, inserted))
+
+        if not self._flushing:
+            self._flushing = True
+            # Not `run_in_background`, so that the flush doesn't run in the
+            # logcontext of the request that happens to start it.
+            self._api.run_as_background_process(
+                "guest_module_batch_insert", self._flush, bg_start_span=False
+            )
+
+        await make_deferred_yieldable(inserted)
+
+    async def _flush(self) -> None:
+        """Insert the pending rows in batches until there are none left."""
+        try:
+            while len(self._pending) > 0:
+                batch: List[Tuple[List[Tuple[Any, ...]], "defer.Deferred[None]"]] = []
+                batch_size = 0
+                while len(self._pending) > 0 and batch_size < self._max_batch_size:
+                    rows, inserted = self._pending.popleft()
+                    batch.append((rows, inserted))
+                    batch_size += len(rows)
+
+                try:
+                    await self._api.run_db_interaction(
+                        self._desc,
+                        self._insert_txn,
+                        [row for rows, _ in batch for row in rows],
+                    )
+                except Exception as e:
+                    with PreserveLoggingContext():
+                        for _, inserted in batch:
+                            inserted.errback(e)
+                else:
+                    with PreserveLoggingContext():
+                        for _, inserted in batch:
+                            inserted.callback(None)
+        finally:
+            self._flushing = False
+
+    def _insert_txn(self, txn: LoggingTransaction, rows: List[Tuple[Any, ...]]) -> None:
+        DatabasePool.simple_insert_many_txn(
+            txn, table=self._table, keys=self._keys, values=rows
+        )
@@ -0,0 +1,117 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from synapse.http.site import SynapseRequest
+from synapse.module_api import (
+    DirectServeJsonResource,
+    ModuleApi,
+    parse_json_object_from_request,
+)
+from twisted.python.failure import Failure
+
+from synapse_guest_module.guest_registration_servlet import GuestRegistrationServlet
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# How many guests can be registered with a single request.
+BULK_REGISTRATION_MAX_USERS = 1000
+
+# How many guests are registered, and stored in the DB, at a time. The
+# responses of a batch are sent as soon as it is done.
+BULK_REGISTRATION_BATCH_SIZE = 100
+
+
+class BulkGuestRegistrationServlet(DirectServeJsonResource):
+    """The `POST /_synapse/client/register_guests` endpoint registers many guests
+    at once, e.g. ahead of a large event. It can only be used by server admins
+    and requires the `displaynames` property with a list of displaynames.
+
+    The response is streamed as JSON lines: one line per displayname, in the
+    same order, with either the same object as `POST
+    /_synapse/client/register_guest` returns, or an object with a `msg` if the
+    registration of that guest failed.
+    """
+
+    def __init__(self, api: ModuleApi, registration_servlet: GuestRegistrationServlet):
+        super().__init__()
+        self._api = api
+        self._registration_servlet = registration_servlet
+
+    async def _async_render_POST(
+        self, request: SynapseRequest
+    ) -> Optional[Tuple[int, Dict[str, Any]]]:
+        requester = await self._api.get_user_by_req(request)
+        if not await self._api.is_user_admin(requester.user.to_string()):
+            return 403, {"msg": "You are not a server admin"}
+
+        json_dict = parse_json_object_from_request(request)
+
+        displaynames = json_dict.get("displaynames")
+        if (
+            not isinstance(displaynames, list)
+            or len(displaynames) == 0
+            or not all(
+                isinstance(displayname, str) and len(displayname.strip()) > 0
+                for displayname in displaynames
+            )
+        ):
+            return 400, {"msg": "You must provide 'displaynames' as a list of strings"}
+
+        if len(displaynames) > BULK_REGISTRATION_MAX_USERS:
+            return 400, {
+                "msg": "You can register at most "
+                f"{BULK_REGISTRATION_MAX_USERS} guests at once"
+            }
+
+        displaynames = [displayname.strip() for displayname in displaynames]
+
+        logger.info(
+            "Registering %d guest users for '%s'",
+            len(displaynames),
+            requester.user.to_string(),
+        )
+
+        disconnected = False
+
+        def on_disconnect(failure: Failure) -> None:
+            nonlocal disconnected
+            disconnected = True
+
+        # Fails if the connection is lost before the response is finished.
+        request.notifyFinish().addErrback(on_disconnect)
+
+        request.setResponseCode(200)
+        request.responseHeaders.setRawHeaders(
+            b"Content-Type", [b"application/jsonl; charset=utf-8"]
+        )
+
+        for start in range(0, len(displaynames), BULK_REGISTRATION_BATCH_SIZE):
+            batch = displaynames[start : start + BULK_REGISTRATION_BATCH_SIZE]
+
+            try:
+                results = await self._registration_servlet.register_guests(batch)
+            except Exception as e:
+                logger.error("Failed to register a batch of guest users: %s", e)
+                results = [
+                    {"msg": "Internal error: Could not register guest"} for _ in batch
+                ]
+
+            if disconnected:
+                # The users registered so far are tracked like any other guests.
+                logger.warning("Client disconnected during a bulk guest registration")
+                return None
+
+            request.write(_encode_json_lines(results))  # type: ignore[no-untyped-call]
+
+        request.finish()
+        return None
+
+
+def _encode_json_lines(objects: List[Dict[str, Any]]) -> bytes:
+    return b"".join(json.dumps(obj).encode("utf-8") + b"\n" for obj in objects)
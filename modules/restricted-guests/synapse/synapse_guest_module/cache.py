@@ -0,0 +1,51 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, Tuple, TypeVar
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+
+class TtlLruCache(Generic[KT, VT]):
+    """A cache that holds at most `max_size` entries, evicting the least
+    recently used one first, and forgets entries after `ttl_sec` seconds.
+    """
+
+    def __init__(self, max_size: int, ttl_sec: float) -> None:
+        self._max_size = max_size
+        self._ttl_sec = ttl_sec
+        # Maps the key to the (expiry time, value) of the entry, least
+        # recently used first.
+        self._entries: OrderedDict[KT, Tuple[float, VT]] = OrderedDict()
+
+    def get(self, key: KT) -> Optional[VT]:
+        """Return the cached value for `key`, or None if there is none."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: KT, value: VT) -> None:
+        """Cache `value` for `key`, evicting the least recently used entry if
+        the cache is full.
+        """
+        self._entries[key] = (time.monotonic() + self._ttl_sec, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -7,7 +7,7 @@
 # Originally licensed under the Apache License, Version 2.0:
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
-from typing import Optional
+from typing import Optional, Tuple
 
 import attr
 
@@ -19,6 +19,23 @@ class MasConfig:
     client_id: str
     client_secret: Optional[str] = None
     client_secret_filepath: Optional[str] = None
+    user_pool_size: int = 0
+    user_pool_low_water_mark: int = 0
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class RateLimitConfig:
+    per_ip_per_second: float = 0
+    per_ip_burst: int = 5
+    global_per_second: float = 0
+    global_burst: int = 50
+    max_concurrent: int = 0
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class RegistrationQueueConfig:
+    workers: int = 10
+    max_queued: int = 1000
 
 
 @attr.s(frozen=True, auto_attribs=True)
@@ -28,3 +45,10 @@ class GuestModuleConfig:
     enable_user_reaper: bool
     user_expiration_seconds: int
     mas: Optional[MasConfig] = None
+    reaper_concurrency: int = 5
+    additional_user_id_prefixes: Tuple[str, ...] = ()
+    purge_user_directory: bool = False
+    filter_user_directory_search: bool = True
+    rate_limit: Optional[RateLimitConfig] = None
+    single_transaction_registration: bool = False
+    registration_queue: Optional[RegistrationQueueConfig] = None
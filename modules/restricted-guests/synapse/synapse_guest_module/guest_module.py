@@ -9,7 +9,8 @@
 
 import asyncio
 import logging
-from typing import Any, Dict, Literal, Optional, Tuple, Union
+import time
+from typing import TYPE_CHECKING, Any, Dict, Literal, Optional, Tuple, Union
 
 from synapse.module_api import (
     NOT_SPAM,
@@ -21,38 +22,121 @@ from synapse.module_api import (
     run_as_background_process,
 )
 from synapse.module_api.errors import ConfigError
-from synapse.types import UserID
-
-from synapse_guest_module.config import GuestModuleConfig, MasConfig
+from synapse.types import UserID, create_requester
+
+from synapse_guest_module.async_helpers import SingleFlight
+from synapse_guest_module.bulk_registration_servlet import BulkGuestRegistrationServlet
+from synapse_guest_module.cache import TtlLruCache
+from synapse_guest_module.config import (
+    GuestModuleConfig,
+    MasConfig,
+    RateLimitConfig,
+    RegistrationQueueConfig,
+)
 from synapse_guest_module.guest_registration_servlet import GuestRegistrationServlet
 from synapse_guest_module.guest_user_reaper import GuestUserReaper
 from synapse_guest_module.mas_admin_client import MasAdminClient
+from synapse_guest_module.mas_user_pool import MasUserPool, drain_mas_user_pool
+from synapse_guest_module.metrics import CallbackMetrics, join_rule_lookups
+from synapse_guest_module.user_directory_purger import UserDirectoryPurger
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
 
 logger = logging.getLogger("synapse.contrib." + __name__)
 
+# How many rooms to cache the join rules of, and for how long. Join rules are
+# only used to decide whether a guest may join, so briefly stale rules only
+# delay the effect of a change.
+JOIN_RULE_CACHE_SIZE = 1000
+JOIN_RULE_CACHE_TTL_SEC = 30.0
+
+# Marks that the guest users that existed before `guest_module_users` was
+# introduced have been copied into it.
+USERS_BACKFILL = "users_backfill"
+
 
 class GuestModule:
     def __init__(self, config: GuestModuleConfig, api: ModuleApi):
         self._api = api
         self._config = config
-        self._mas_tables_ready: asyncio.Event | None = None
+        # str.startswith() accepts a tuple and checks all prefixes in one call.
+        self._guest_user_id_prefixes = tuple(
+            "@" + prefix
+            for prefix in (config.user_id_prefix, *config.additional_user_id_prefixes)
+        )
+        self._join_rules: TtlLruCache[str, str] = TtlLruCache(
+            JOIN_RULE_CACHE_SIZE, JOIN_RULE_CACHE_TTL_SEC
+        )
+        self._join_rule_lookups: SingleFlight[str | None] = SingleFlight()
+        self._user_may_create_room_metrics = CallbackMetrics("user_may_create_room")
+        self._user_may_invite_metrics = CallbackMetrics("user_may_invite")
+        self._user_may_join_room_metrics = CallbackMetrics("user_may_join_room")
+        self._check_username_for_spam_metrics = CallbackMetrics(
+            "check_username_for_spam"
+        )
+        self._profile_update_metrics = CallbackMetrics("profile_update")
+        self._join_rule_cache_hits = join_rule_lookups.labels("cache")
+        self._join_rule_state_lookups = join_rule_lookups.labels("state")
+        self._tables_ready = asyncio.Event()
+        run_as_background_process(
+            "guest_module_db_init",
+            self._init_tables,
+            bg_start_span=False,
+        )
 
         mas_admin_client = (
             MasAdminClient(api, config.mas) if config.mas is not None else None
         )
-        if config.mas is not None:
-            self._mas_tables_ready = asyncio.Event()
+
+        # Start the user reaper
+        self.reaper = GuestUserReaper(api, config, mas_admin_client, self._tables_ready)
+        if config.enable_user_reaper:
+            run_as_background_process(
+                "guest_module_reaper_bg_task",
+                self.reaper.run,
+                bg_start_span=False,
+            )
+
+        mas_user_pool: MasUserPool | None = None
+        if config.mas is not None and config.mas.user_pool_size > 0:
+            assert mas_admin_client is not None
+            mas_user_pool = MasUserPool(
+                api, config, mas_admin_client, self._tables_ready, self.reaper
+            )
+            run_as_background_process(
+                "guest_module_mas_user_pool_bg_task",
+                mas_user_pool.run,
+                bg_start_span=False,
+            )
+        elif config.mas is not None:
+            # Users that are left over from when the pool was enabled would
+            # otherwise never be deactivated.
             run_as_background_process(
-                "guest_module_mas_db_init",
-                self._init_mas_tables,
+                "guest_module_mas_user_pool_drain",
+                drain_mas_user_pool,
+                api,
+                self._tables_ready,
                 bg_start_span=False,
             )
+        self.mas_user_pool = mas_user_pool
         self.registration_servlet = GuestRegistrationServlet(
-            config, api, mas_admin_client, self._mas_tables_ready
+            config,
+            api,
+            mas_admin_client,
+            self._tables_ready,
+            mas_user_pool,
+            self.reaper,
         )
         self._api.register_web_resource(
             "/_synapse/client/register_guest", self.registration_servlet
         )
+        self.bulk_registration_servlet = BulkGuestRegistrationServlet(
+            api, self.registration_servlet
+        )
+        self._api.register_web_resource(
+            "/_synapse/client/register_guests", self.bulk_registration_servlet
+        )
         self._api.register_third_party_rules_callbacks(
             on_profile_update=self.profile_update
         )
@@ -60,17 +144,18 @@ class GuestModule:
             user_may_create_room=self.callback_user_may_create_room,
             user_may_invite=self.callback_user_may_invite,
             user_may_join_room=self.callback_user_may_join_room,
-            check_username_for_spam=self.callback_check_username_for_spam,
+            check_username_for_spam=(
+                self.callback_check_username_for_spam
+                if config.filter_user_directory_search
+                else None
+            ),
         )
 
-        # Start the user reaper
-        self.reaper = GuestUserReaper(
-            api, config, mas_admin_client, self._mas_tables_ready
-        )
-        if config.enable_user_reaper:
+        if config.purge_user_directory:
+            self.user_directory_purger = UserDirectoryPurger(api, self._tables_ready)
             run_as_background_process(
-                "guest_module_reaper_bg_task",
-                self.reaper.run,
+                "guest_module_user_directory_purge_bg_task",
+                self.user_directory_purger.run,
                 bg_start_span=False,
             )
 
@@ -82,6 +167,15 @@ class GuestModule:
         if not isinstance(user_id_prefix, str):
             raise ConfigError("Config option 'user_id_prefix' must be a string")
 
+        additional_user_id_prefixes = config.get("additional_user_id_prefixes", [])
+        if not isinstance(additional_user_id_prefixes, list) or not all(
+            isinstance(prefix, str) and len(prefix) > 0
+            for prefix in additional_user_id_prefixes
+        ):
+            raise ConfigError(
+                "Config option 'additional_user_id_prefixes' must be a list of non-empty strings"
+            )
+
         display_name_suffix = config.get("display_name_suffix", " (Guest)")
         if not isinstance(display_name_suffix, str):
             raise ConfigError("Config option 'display_name_suffix' must be a string")
@@ -99,6 +193,94 @@ class GuestModule:
                 "Config option 'user_expiration_seconds' must be a number"
             )
 
+        purge_user_directory = config.get("purge_user_directory", False)
+        if not isinstance(purge_user_directory, bool):
+            raise ConfigError("Config option 'purge_user_directory' must be a bool")
+
+        filter_user_directory_search = config.get("filter_user_directory_search", True)
+        if not isinstance(filter_user_directory_search, bool):
+            raise ConfigError(
+                "Config option 'filter_user_directory_search' must be a bool"
+            )
+
+        single_transaction_registration = config.get(
+            "single_transaction_registration", False
+        )
+        if not isinstance(single_transaction_registration, bool):
+            raise ConfigError(
+                "Config option 'single_transaction_registration' must be a bool"
+            )
+
+        reaper_concurrency = config.get("reaper_concurrency", 5)
+        if not isinstance(reaper_concurrency, int) or reaper_concurrency < 1:
+            raise ConfigError(
+                "Config option 'reaper_concurrency' must be a positive number"
+            )
+
+        rate_limit_config = config.get("rate_limit")
+        rate_limit: Optional[RateLimitConfig] = None
+        if rate_limit_config is not None:
+            if not isinstance(rate_limit_config, dict):
+                raise ConfigError("Config option 'rate_limit' must be an object")
+
+            rates = {}
+            for option in ["per_ip_per_second", "global_per_second"]:
+                rate = rate_limit_config.get(option, 0)
+                if (
+                    not isinstance(rate, (int, float))
+                    or isinstance(rate, bool)
+                    or rate < 0
+                ):
+                    raise ConfigError(
+                        f"Config option 'rate_limit.{option}' must be a non-negative number"
+                    )
+                rates[option] = float(rate)
+
+            counts = {}
+            for option, default, minimum in [
+                ("per_ip_burst", 5, 1),
+                ("global_burst", 50, 1),
+                ("max_concurrent", 0, 0),
+            ]:
+                count = rate_limit_config.get(option, default)
+                if not isinstance(count, int) or count < minimum:
+                    raise ConfigError(
+                        f"Config option 'rate_limit.{option}' must be a "
+                        + ("positive" if minimum > 0 else "non-negative")
+                        + " number"
+                    )
+                counts[option] = count
+
+            rate_limit = RateLimitConfig(
+                rates["per_ip_per_second"],
+                counts["per_ip_burst"],
+                rates["global_per_second"],
+                counts["global_burst"],
+                counts["max_concurrent"],
+            )
+
+        registration_queue_config = config.get("registration_queue")
+        registration_queue: Optional[RegistrationQueueConfig] = None
+        if registration_queue_config is not None:
+            if not isinstance(registration_queue_config, dict):
+                raise ConfigError(
+                    "Config option 'registration_queue' must be an object"
+                )
+
+            workers = registration_queue_config.get("workers", 10)
+            if not isinstance(workers, int) or workers < 1:
+                raise ConfigError(
+                    "Config option 'registration_queue.workers' must be a positive number"
+                )
+
+            max_queued = registration_queue_config.get("max_queued", 1000)
+            if not isinstance(max_queued, int) or max_queued < 1:
+                raise ConfigError(
+                    "Config option 'registration_queue.max_queued' must be a positive number"
+                )
+
+            registration_queue = RegistrationQueueConfig(workers, max_queued)
+
         mas_config = config.get("mas")
         mas: Optional[MasConfig] = None
         if mas_config is not None:
@@ -156,12 +338,36 @@ class GuestModule:
                     "Config option 'mas.client_secret' and 'mas.client_secret_filepath' are mutually exclusive"
                 )
 
+            user_pool_size = mas_config.get("user_pool_size", 0)
+            if not isinstance(user_pool_size, int) or user_pool_size < 0:
+                raise ConfigError(
+                    "Config option 'mas.user_pool_size' must be a non-negative number"
+                )
+
+            user_pool_low_water_mark = mas_config.get(
+                "user_pool_low_water_mark", user_pool_size // 2
+            )
+            if (
+                not isinstance(user_pool_low_water_mark, int)
+                or user_pool_low_water_mark < 0
+            ):
+                raise ConfigError(
+                    "Config option 'mas.user_pool_low_water_mark' must be a non-negative number"
+                )
+
+            if user_pool_size > 0 and user_pool_low_water_mark >= user_pool_size:
+                raise ConfigError(
+                    "Config option 'mas.user_pool_low_water_mark' must be lower than 'mas.user_pool_size'"
+                )
+
             mas = MasConfig(
                 admin_api_base_url.strip(),
                 oauth_base_url.strip(),
                 client_id.strip(),
                 client_secret,
                 client_secret_filepath,
+                user_pool_size,
+                user_pool_low_water_mark,
             )
 
         return GuestModuleConfig(
@@ -170,6 +376,13 @@ class GuestModule:
             enable_user_reaper,
             user_expiration_seconds,
             mas,
+            reaper_concurrency=reaper_concurrency,
+            purge_user_directory=purge_user_directory,
+            filter_user_directory_search=filter_user_directory_search,
+            rate_limit=rate_limit,
+            single_transaction_registration=single_transaction_registration,
+            registration_queue=registration_queue,
+            additional_user_id_prefixes=tuple(additional_user_id_prefixes),
         )
 
     async def profile_update(
@@ -183,37 +396,110 @@ class GuestModule:
         always contains the configured suffix (default ` (Guest)`) and add it if
         it is missing.
         """
-        user_is_guest = user_id.startswith("@" + self._config.user_id_prefix)
-        if user_is_guest:
-            new_profile_display_name = (
-                "" if new_profile.display_name is None else new_profile.display_name
-            )
-            guest_display_name_not_valid = not new_profile_display_name.endswith(
-                self._config.display_name_suffix
+        start = time.perf_counter()
+        user_is_guest = self._is_guest(user_id)
+        try:
+            if user_is_guest:
+                await self._fix_guest_display_name(user_id, new_profile)
+        finally:
+            self._profile_update_metrics.record(user_is_guest, start)
+
+    async def _fix_guest_display_name(
+        self, user_id: str, new_profile: ProfileInfo
+    ) -> None:
+        new_profile_display_name = (
+            "" if new_profile.display_name is None else new_profile.display_name
+        )
+        guest_display_name_not_valid = not new_profile_display_name.endswith(
+            self._config.display_name_suffix
+        )
+        if guest_display_name_not_valid:
+            user_id_1 = UserID.from_string(user_id)
+            guest_display_name = (
+                new_profile_display_name.strip() + self._config.display_name_suffix
             )
-            if guest_display_name_not_valid:
-                user_id_1 = UserID.from_string(user_id)
-                guest_display_name = (
-                    new_profile_display_name.strip() + self._config.display_name_suffix
-                )
-                await self._api.set_displayname(user_id_1, guest_display_name)
+            # The update below calls this callback again, but with a
+            # displayname that ends with the suffix, so it is a no-op.
+            await self._set_displayname(user_id_1, guest_display_name)
+
+    async def _set_displayname(self, user_id: UserID, displayname: str) -> None:
+        """Set the displayname of a user without updating their membership
+        events. This is called from `profile_update`, while Synapse processes
+        the profile update of the user, and Synapse updates the membership
+        events with the current profile once the callback returns. Propagating
+        the change here too would send every membership event twice.
+        """
+        hs: "HomeServer | None" = getattr(self._api, "_hs", None)
+        if hs is None:
+            await self._api.set_displayname(user_id, displayname)
+            return
+
+        await hs.get_profile_handler().set_displayname(
+            target_user=user_id,
+            requester=create_requester(user_id),
+            new_displayname=displayname,
+            by_admin=True,
+            propagate=False,
+        )
 
-    async def _init_mas_tables(self) -> None:
-        if self._mas_tables_ready is None:
+    async def _init_tables(self) -> None:
+        try:
+            await self._api.run_db_interaction(
+                "guest_module_create_tables",
+                self._create_tables,
+            )
+        except Exception as err:
+            logger.error("Failed to initialize tables: %s", err)
+            self._tables_ready.set()
             return
 
+        # The backfill runs in its own transaction, so that it can't roll back
+        # the creation of the tables.
         try:
             await self._api.run_db_interaction(
-                "guest_module_create_mas_tables",
-                self._create_mas_tables,
+                "guest_module_backfill_users",
+                self._backfill_users,
             )
         except Exception as err:
-            logger.error("Failed to initialize MAS tables: %s", err)
+            logger.error("Failed to backfill guest users: %s", err)
         finally:
-            self._mas_tables_ready.set()
+            self._tables_ready.set()
 
-    @staticmethod
-    def _create_mas_tables(txn: LoggingTransaction) -> None:
+    def _create_tables(self, txn: LoggingTransaction) -> None:
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_users (
+                user_id TEXT PRIMARY KEY NOT NULL,
+                created_at_sec BIGINT NOT NULL
+            )
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS guest_module_users_created_at_sec
+            ON guest_module_users (created_at_sec)
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_migrations (
+                name TEXT PRIMARY KEY NOT NULL
+            )
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_leases (
+                name TEXT PRIMARY KEY NOT NULL,
+                holder TEXT NOT NULL,
+                expires_at_sec BIGINT NOT NULL
+            )
+            """,
+            (),
+        )
         txn.execute(
             """
             CREATE TABLE IF NOT EXISTS guest_module_mas_users (
@@ -231,6 +517,55 @@ class GuestModule:
             """,
             (),
         )
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_mas_user_pool (
+                mas_user_id TEXT PRIMARY KEY NOT NULL,
+                user_id TEXT NOT NULL,
+                created_at_sec BIGINT NOT NULL
+            )
+            """,
+            (),
+        )
+
+    def _backfill_users(self, txn: LoggingTransaction) -> None:
+        """Track the local guest users that were registered before the module
+        tracked them in `guest_module_users`. This only runs once.
+        """
+        txn.execute(
+            "SELECT 1 FROM guest_module_migrations WHERE name = ?",
+            (USERS_BACKFILL,),
+        )
+        if txn.fetchone() is not None:
+            return
+
+        txn.execute(
+            """
+            INSERT INTO guest_module_users (user_id, created_at_sec)
+            SELECT name, COALESCE(creation_ts, ?)
+            FROM users
+            WHERE name != ?
+            AND name LIKE ?
+            AND deactivated = 0
+            ON CONFLICT (user_id) DO NOTHING
+            """,
+            (
+                # Users without a creation time expire relative to the backfill.
+                int(time.time()),
+                self._api.get_qualified_user_id(f"{self._config.user_id_prefix}reaper"),
+                f"@{self._config.user_id_prefix}%:{self._api.server_name}",
+            ),
+        )
+        logger.info("Backfilled %d guest users", txn.rowcount)
+
+        # Another process may have run the backfill at the same time.
+        txn.execute(
+            """
+            INSERT INTO guest_module_migrations (name) VALUES (?)
+            ON CONFLICT (name) DO NOTHING
+            """,
+            (USERS_BACKFILL,),
+        )
 
     async def callback_user_may_create_room(
         self,
@@ -239,7 +574,9 @@ class GuestModule:
         """Returns whether this user is allowed to create a room. Guest users
         should not be able to do that.
         """
-        user_is_guest = user_id.startswith("@" + self._config.user_id_prefix)
+        start = time.perf_counter()
+        user_is_guest = self._is_guest(user_id)
+        self._user_may_create_room_metrics.record(user_is_guest, start)
         return not user_is_guest
 
     async def callback_user_may_invite(
@@ -251,7 +588,9 @@ class GuestModule:
         """Returns whether this user is allowed to invite someone into a room.
         Guest users should not be able to to that.
         """
-        user_is_guest = inviter.startswith("@" + self._config.user_id_prefix)
+        start = time.perf_counter()
+        user_is_guest = self._is_guest(inviter)
+        self._user_may_invite_metrics.record(user_is_guest, start)
         return not user_is_guest
 
     async def callback_user_may_join_room(
@@ -262,29 +601,65 @@ class GuestModule:
         """Returns whether this user is allowed to join a room. Guest users
         should only be able to do that if the room is Ask to Join (knock).
         """
-        user_is_guest = user_id.startswith("@" + self._config.user_id_prefix)
+        start = time.perf_counter()
+        user_is_guest = self._is_guest(user_id)
         if not user_is_guest or is_invited:
+            self._user_may_join_room_metrics.record(user_is_guest, start)
+            return NOT_SPAM
+
+        try:
+            join_rule = await self._get_join_rule(room_id)
+        finally:
+            self._user_may_join_room_metrics.record(user_is_guest, start)
+
+        if join_rule is None:
+            return errors.Codes.BAD_STATE
+
+        if join_rule.startswith("knock"):
             return NOT_SPAM
 
+        return errors.Codes.FORBIDDEN
+
+    async def _get_join_rule(self, room_id: str) -> str | None:
+        """Return the join rule of a room, or None if the room has no join rules
+        event. Join rules are cached for a short time, and concurrent lookups for
+        the same room share a single state query.
+        """
+        join_rule = self._join_rules.get(room_id)
+        if join_rule is not None:
+            self._join_rule_cache_hits.inc()
+            return join_rule
+
+        return await self._join_rule_lookups.run(
+            room_id, lambda: self._fetch_join_rule(room_id)
+        )
+
+    async def _fetch_join_rule(self, room_id: str) -> str | None:
+        self._join_rule_state_lookups.inc()
         join_rules_events = await self._api.get_state_events_in_room(
             room_id, [("m.room.join_rules", None)]
         )
-        if join_rules_events is None or len(list(join_rules_events)) == 0:
-            return errors.Codes.BAD_STATE
 
-        for event in join_rules_events:
-            join_rule = event.get("content", {})
-            is_knock = join_rule.get("join_rule").startswith("knock")
-            if user_is_guest and is_knock:
-                return NOT_SPAM
+        for event in join_rules_events or []:
+            content = event.get("content", {})
+            join_rule = content.get("join_rule")
+            if not isinstance(join_rule, str):
+                return ""
 
-        return errors.Codes.FORBIDDEN
+            self._join_rules.set(room_id, join_rule)
+            return join_rule
+
+        return None
 
     async def callback_check_username_for_spam(self, user_profile: UserProfile) -> bool:
         """Returns whether this user should appear in the user directory. Since
         we prefer to not invite guests into normal rooms, we hide them here.
         """
-        user_is_guest = user_profile["user_id"].startswith(
-            "@" + self._config.user_id_prefix
-        )
+        start = time.perf_counter()
+        user_is_guest = self._is_guest(user_profile["user_id"])
+        self._check_username_for_spam_metrics.record(user_is_guest, start)
         return user_is_guest
+
+    def _is_guest(self, user_id: str) -> bool:
+        """Returns whether the user ID starts with one of the guest prefixes."""
+        return user_id.startswith(self._guest_user_id_prefixes)
@@ -9,25 +9,82 @@
 
 import asyncio
 import logging
-import secrets
-import string
+import math
 import time
-from typing import Any, Dict, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
+from synapse.api.errors import Codes, HttpResponseException, SynapseError
+from synapse.http.servlet import parse_string
+from synapse.http.site import SynapseRequest
 from synapse.module_api import (
-    DatabasePool,
     DirectServeJsonResource,
+    LoggingTransaction,
     ModuleApi,
+    make_deferred_yieldable,
     parse_json_object_from_request,
+    run_in_background,
 )
 from synapse.types import UserID
+from synapse.util.async_helpers import concurrently_execute
+from twisted.internet import defer
 from twisted.web.server import Request
 
+from synapse_guest_module.async_helpers import SingleFlight
+from synapse_guest_module.batch_inserter import BatchInserter
+from synapse_guest_module.cache import TtlLruCache
 from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_user_reaper import GuestUserReaper
+from synapse_guest_module.local_registration import LocalGuestRegistrar
+from synapse_guest_module.localpart import generate_localpart
 from synapse_guest_module.mas_admin_client import MasAdminClient
+from synapse_guest_module.mas_user_pool import MasUserPool
+from synapse_guest_module.metrics import (
+    localpart_conflicts,
+    measure_phase,
+    registration_phase_seconds,
+    registrations,
+)
+from synapse_guest_module.rate_limiter import RegistrationRateLimiter
+from synapse_guest_module.registration_jobs import RegistrationJobQueue
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
 
 logger = logging.getLogger("synapse.contrib." + __name__)
 
+T = TypeVar("T")
+
+# How many localparts are tried if the previous ones were already taken. The
+# localparts are unique by construction, so this should never happen.
+LOCALPART_ATTEMPTS = 3
+
+# How long, and for how many registrations, the responses are kept for retries
+# with the same `Idempotency-Key`.
+IDEMPOTENCY_KEY_TTL_SEC = 10 * 60
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+# Idempotency keys have to be long enough that they can't be guessed, since a
+# retry returns the access token of the registered user.
+IDEMPOTENCY_KEY_MIN_LENGTH = 16
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# After how many seconds clients should try again if the registration queue is
+# full.
+QUEUE_FULL_RETRY_AFTER_SEC = 1.0
+
+# How many users of a bulk registration are created at a time.
+BULK_REGISTRATION_CONCURRENCY = 10
+
 
 class GuestRegistrationServlet(DirectServeJsonResource):
     """The `POST /_synapse/client/register_guest` endpoints provides an endpoint
@@ -41,101 +98,670 @@ class GuestRegistrationServlet(DirectServeJsonResource):
         config: GuestModuleConfig,
         api: ModuleApi,
         mas_admin_client: MasAdminClient | None = None,
-        mas_tables_ready: asyncio.Event | None = None,
+        tables_ready: asyncio.Event | None = None,
+        mas_user_pool: MasUserPool | None = None,
+        reaper: GuestUserReaper | None = None,
     ):
         super().__init__()
         self._api = api
         self._config = config
         self._mas_admin_client = mas_admin_client
-        self._mas_tables_ready = mas_tables_ready
+        self._tables_ready = tables_ready
+        self._mas_user_pool = mas_user_pool
+        self._reaper = reaper
+        self._rate_limiter = (
+            RegistrationRateLimiter(config.rate_limit)
+            if config.rate_limit is not None
+            else None
+        )
+        # Maps idempotency keys to the response of their registration.
+        self._idempotent_results: TtlLruCache[
+            str, Tuple[int, Dict[str, Any]]
+        ] = TtlLruCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_KEY_TTL_SEC)
+        # Maps idempotency keys to the job of their queued registration.
+        self._idempotent_jobs: TtlLruCache[str, str] = TtlLruCache(
+            IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_KEY_TTL_SEC
+        )
+        self._idempotent_registrations: SingleFlight[
+            Tuple[int, Dict[str, Any]]
+        ] = SingleFlight()
+        self._job_queue = (
+            RegistrationJobQueue(api, config.registration_queue)
+            if config.registration_queue is not None
+            else None
+        )
+        # The users of concurrent registrations are stored together.
+        self._user_inserter = BatchInserter(
+            api,
+            "guest_module_store_users",
+            "guest_module_users",
+            ("user_id", "created_at_sec"),
+        )
+        self._mas_user_inserter = BatchInserter(
+            api,
+            "guest_module_store_mas_users",
+            "guest_module_mas_users",
+            ("mas_user_id", "user_id", "created_at_sec"),
+        )
 
     async def _async_render_POST(self, request: Request) -> Tuple[int, Dict[str, Any]]:
-        """On POST requests, generate a new username for a guest, check that it
-        doesn't exist yet, append the suffix to the displayname, create the user,
-        create a device, and return the session data to the caller.
+        """On POST requests, generate a new username for a guest, append the
+        suffix to the displayname, create the user, create a device, and return
+        the session data to the caller. If rate limits are configured, requests
+        over the limits are rejected with a 429 before any work is done.
+
+        If the request has an `Idempotency-Key` header, retries with the same
+        key get the response of the first successful registration, and
+        concurrent requests with the same key wait for the first one.
+
+        If the registration queue is enabled and the request has a
+        `Prefer: respond-async` header, the registration is queued instead and
+        a 202 with the ID of the job is returned right away.
         """
+        status, response = await _count_registration(self._handle_POST(request))
 
-        json_dict = parse_json_object_from_request(request)
+        if status == 429:
+            request.responseHeaders.setRawHeaders(
+                b"Retry-After", [str(math.ceil(response["retry_after_ms"] / 1000))]
+            )
 
-        displayname = json_dict.get("displayname")
-        if not isinstance(displayname, str) or len(displayname.strip()) == 0:
-            return 400, {"msg": "You must provide a 'displayname' as a string"}
+        return status, response
 
-        displayname = displayname.strip()
+    async def _handle_POST(self, request: Request) -> Tuple[int, Dict[str, Any]]:
+        idempotency_keys = request.requestHeaders.getRawHeaders(b"Idempotency-Key")
+        idempotency_key: Optional[str] = None
+        if idempotency_keys is not None:
+            idempotency_key = idempotency_keys[0].decode("utf-8", "replace")
+            if not (
+                IDEMPOTENCY_KEY_MIN_LENGTH
+                <= len(idempotency_key)
+                <= IDEMPOTENCY_KEY_MAX_LENGTH
+            ):
+                return 400, {
+                    "msg": "The 'Idempotency-Key' header must have between "
+                    f"{IDEMPOTENCY_KEY_MIN_LENGTH} and {IDEMPOTENCY_KEY_MAX_LENGTH} "
+                    "characters"
+                }
 
-        # Attempt up to 10 times to generate a localpart
-        for _ in range(10):
-            # generate a random string as a suffix
-            random_string = "".join(
-                secrets.choice(string.ascii_lowercase + string.digits)
-                for _ in range(32)
+        if self._job_queue is not None and _prefers_async(request):
+            return await self._enqueue_registration(
+                request, self._job_queue, idempotency_key
             )
 
-            localpart = self._config.user_id_prefix + random_string
+        if idempotency_key is None:
+            return await self._admit_and_register(request)
 
-            # make sure the user-id does not exist yet
-            if await self._api.check_user_exists(
-                self._api.get_qualified_user_id(localpart)
-            ):
-                continue
+        return await self._register_idempotent(request, idempotency_key)
 
-            if self._mas_admin_client is None:
-                logger.info(
-                    "Registering local Synapse guest user with localpart '%s'",
-                    localpart,
-                )
-                user_id = await self._api.register_user(
-                    localpart, displayname + self._config.display_name_suffix
+    async def _async_render_GET(self, request: Request) -> Tuple[int, Dict[str, Any]]:
+        """On GET requests, return the response of the queued registration with
+        the `job_id` query parameter, or a 202 if it hasn't finished yet.
+        """
+        job_id = parse_string(request, "job_id", required=True)
+
+        if self._job_queue is not None:
+            result = self._job_queue.get_result(job_id)
+            if result is not None:
+                return result
+
+            if self._job_queue.is_pending(job_id):
+                return 202, {"job_id": job_id}
+
+        return 404, {"msg": "Unknown registration job"}
+
+    async def _enqueue_registration(
+        self,
+        request: Request,
+        job_queue: RegistrationJobQueue,
+        idempotency_key: Optional[str],
+    ) -> Tuple[int, Dict[str, Any]]:
+        """Queue a guest registration. The request is validated and rate
+        limited right away, the registration itself runs in the background.
+
+        Retries with the same idempotency key get the job of the first request,
+        unless it failed, or the response of the first successful registration.
+        """
+        if idempotency_key is not None:
+            result = self._idempotent_results.get(idempotency_key)
+            if result is not None:
+                logger.debug("Replaying registration for idempotency key")
+                return result
+
+            job_id = self._idempotent_jobs.get(idempotency_key)
+            if job_id is not None and job_queue.is_pending(job_id):
+                return 202, {"job_id": job_id}
+
+        displayname = _parse_displayname(request)
+        if displayname is None:
+            return 400, {"msg": "You must provide a 'displayname' as a string"}
+
+        rate_limiter = self._rate_limiter
+        if rate_limiter is not None:
+            retry_after_sec = rate_limiter.try_admit(_get_client_ip(request))
+            if retry_after_sec > 0:
+                return _too_many_requests(retry_after_sec)
+
+        async def register() -> Tuple[int, Dict[str, Any]]:
+            try:
+                result = await _count_registration(
+                    self._register_displayname(displayname)
                 )
+                if idempotency_key is not None and result[0] == 201:
+                    self._idempotent_results.set(idempotency_key, result)
+                return result
+            finally:
+                if rate_limiter is not None:
+                    rate_limiter.release()
 
-                device_id, access_token, _, _ = await self._api.register_device(user_id)
-            else:
-                logger.info("Registering MAS guest user with localpart '%s'", localpart)
+        job_id = job_queue.submit(register)
+        if job_id is None:
+            if rate_limiter is not None:
+                rate_limiter.release()
+            return _too_many_requests(QUEUE_FULL_RETRY_AFTER_SEC)
+
+        if idempotency_key is not None:
+            self._idempotent_jobs.set(idempotency_key, job_id)
+
+        return 202, {"job_id": job_id}
+
+    async def _register_idempotent(
+        self, request: Request, idempotency_key: str
+    ) -> Tuple[int, Dict[str, Any]]:
+        """Register a guest, unless a registration with the same idempotency
+        key already succeeded or is in flight.
+        """
+        result = self._idempotent_results.get(idempotency_key)
+        if result is not None:
+            logger.debug("Replaying registration for idempotency key")
+            return result
 
-                # This will be the MAS-specific user ID (i.e. "01KFNJEB720EAGR907PSXRXQ51")
-                mas_user_id = await self._mas_admin_client.create_user(localpart)
-                # This is the Matrix user ID (i.e. "@guest_abc123:matrix.org")
-                user_id = self._api.get_qualified_user_id(localpart)
+        async def register() -> Tuple[int, Dict[str, Any]]:
+            result = await self._admit_and_register(request)
+            if result[0] == 201:
+                self._idempotent_results.set(idempotency_key, result)
+            return result
 
+        return await self._idempotent_registrations.run(idempotency_key, register)
+
+    async def _admit_and_register(self, request: Request) -> Tuple[int, Dict[str, Any]]:
+        if self._rate_limiter is None:
+            return await self._register_guest(request)
+
+        retry_after_sec = self._rate_limiter.try_admit(_get_client_ip(request))
+        if retry_after_sec > 0:
+            return _too_many_requests(retry_after_sec)
+
+        try:
+            return await self._register_guest(request)
+        finally:
+            self._rate_limiter.release()
+
+    async def _register_guest(self, request: Request) -> Tuple[int, Dict[str, Any]]:
+        displayname = _parse_displayname(request)
+        if displayname is None:
+            return 400, {"msg": "You must provide a 'displayname' as a string"}
+
+        return await self._register_displayname(displayname)
+
+    async def _register_displayname(
+        self, displayname: str
+    ) -> Tuple[int, Dict[str, Any]]:
+        if self._mas_user_pool is not None:
+            with registration_phase_seconds.labels("pool_claim").time():
+                pool_user = await self._mas_user_pool.claim_user()
+            if pool_user is not None:
+                mas_user_id, user_id = pool_user
                 logger.info(
-                    f"Registered guest user: '{user_id}' (MAS ID: '{mas_user_id}')"
+                    f"Claimed guest user from pool: '{user_id}' (MAS ID: '{mas_user_id}')"
                 )
 
-                await self._api.set_displayname(
-                    UserID.from_string(user_id),
+                device_id, access_token = await self._setup_mas_user(
+                    mas_user_id,
+                    user_id,
                     displayname + self._config.display_name_suffix,
+                    stored=True,
+                )
+
+                return 201, self._registration_response(
+                    user_id, device_id, access_token
                 )
 
-                await self._store_mas_user(mas_user_id, user_id, int(time.time()))
+        displayname += self._config.display_name_suffix
+
+        if self._mas_admin_client is None:
+            local_user = await self._register_local_guest(displayname)
+            if local_user is None:
+                return 500, {"msg": "Internal error: Could not find a free username"}
+
+            user_id, device_id, access_token = local_user
+        else:
+            mas_user = await self._with_new_localpart(self._create_mas_user)
+            if mas_user is None:
+                return 500, {"msg": "Internal error: Could not find a free username"}
 
-                # Determine how long to keep the access token valid for.
-                #
-                # If a user reaper is enabled, just have the token expire after
-                # the configured period.
-                expires_in_sec = (
-                    self._config.user_expiration_seconds
-                    if self._config.enable_user_reaper
-                    else 0
+            mas_user_id, user_id = mas_user
+            device_id, access_token = await self._setup_mas_user(
+                mas_user_id, user_id, displayname, stored=False
+            )
+
+        logger.debug("Registered user '%s'", user_id)
+
+        return 201, self._registration_response(user_id, device_id, access_token)
+
+    async def register_guests(self, displaynames: List[str]) -> List[Dict[str, Any]]:
+        """Register a guest for each of the given displaynames, e.g. ahead of a
+        large event. Up to `BULK_REGISTRATION_CONCURRENCY` users are created at a
+        time, and all users are stored in the DB in a single transaction.
+
+        Local users and their devices are still created one at a time through
+        the module API, unless `single_transaction_registration` is enabled, in
+        which case each guest is registered in a single transaction.
+
+        Rate limits, idempotency keys and the MAS user pool don't apply, the pool
+        is left for the guests that arrive on their own.
+
+        Args:
+            displaynames: The displaynames of the new users, without the suffix
+
+        Returns:
+            For each displayname, the registration response, or an object with a
+            `msg` if the registration failed.
+        """
+        results: List[Dict[str, Any]] = [
+            {"msg": "Internal error: Could not register guest"} for _ in displaynames
+        ]
+        # The (index, MAS user ID, user ID) of the users created so far.
+        created: List[Tuple[int, str, str]] = []
+        created_at_sec = int(time.time())
+
+        local_registrar = (
+            self._get_local_registrar() if self._mas_admin_client is None else None
+        )
+        if local_registrar is not None and self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        async def create_user(index: int) -> None:
+            displayname = displaynames[index] + self._config.display_name_suffix
+            user: Optional[Tuple[str, str]] = None
+            try:
+                if local_registrar is not None:
+                    # Registers and stores the user with a device right away.
+                    registered = await self._with_new_localpart(
+                        lambda localpart: local_registrar.register(
+                            localpart, displayname, created_at_sec
+                        )
+                    )
+                    if registered is not None:
+                        results[index] = self._registration_response(*registered)
+                        return
+                elif self._mas_admin_client is None:
+                    user_id = await self._with_new_localpart(
+                        lambda localpart: self._register_local_user(
+                            localpart, displayname
+                        )
+                    )
+                    if user_id is not None:
+                        user = ("", user_id)
+                else:
+                    user = await self._with_new_localpart(self._create_mas_user)
+            except Exception as e:
+                logger.error("Failed to register guest user: %s", e)
+                return
+
+            if user is None:
+                results[index] = {
+                    "msg": "Internal error: Could not find a free username"
+                }
+                return
+
+            mas_user_id, user_id = user
+            created.append((index, mas_user_id, user_id))
+
+        await concurrently_execute(
+            create_user, range(len(displaynames)), BULK_REGISTRATION_CONCURRENCY
+        )
+
+        if local_registrar is not None:
+            if self._reaper is not None:
+                self._reaper.user_registered(created_at_sec)
+            return results
+
+        # Store the users before handing out sessions, so that the reaper finds
+        # them even if setting them up fails.
+        try:
+            if self._mas_admin_client is None:
+                await self._store_users(
+                    [user_id for _, _, user_id in created], created_at_sec
                 )
-                (
-                    device_id,
-                    access_token,
-                ) = await self._mas_admin_client.create_personal_session(
-                    mas_user_id, expires_in_sec
+            else:
+                await self._store_mas_users(
+                    [(mas_user_id, user_id) for _, mas_user_id, user_id in created],
+                    created_at_sec,
                 )
+        except Exception as e:
+            logger.error("Failed to store guest users: %s", e)
+
+            # Without the rows, the reaper would never deactivate the users.
+            async def roll_back_user(user: Tuple[int, str, str]) -> None:
+                _, mas_user_id, user_id = user
+                if self._mas_admin_client is None:
+                    await self._rollback_local_user(user_id)
+                else:
+                    await self._rollback_mas_user(mas_user_id, stored=False)
+
+            await concurrently_execute(
+                roll_back_user, created, BULK_REGISTRATION_CONCURRENCY
+            )
+            return results
+
+        async def set_up_user(user: Tuple[int, str, str]) -> None:
+            index, mas_user_id, user_id = user
+            try:
+                if self._mas_admin_client is None:
+                    device_id, access_token, _, _ = await self._api.register_device(
+                        user_id
+                    )
+                else:
+                    device_id, access_token = await self._setup_mas_user(
+                        mas_user_id,
+                        user_id,
+                        displaynames[index] + self._config.display_name_suffix,
+                        stored=True,
+                    )
+            except Exception as e:
+                logger.error("Failed to set up guest user '%s': %s", user_id, e)
+                return
 
-            logger.debug("Registered user '%s'", user_id)
+            results[index] = self._registration_response(
+                user_id, device_id, access_token
+            )
 
-            res = {
-                "userId": user_id,
-                "deviceId": device_id,
-                "accessToken": access_token,
-                "homeserverUrl": self._api.public_baseurl,
-            }
+        await concurrently_execute(set_up_user, created, BULK_REGISTRATION_CONCURRENCY)
+
+        return results
+
+    async def _with_new_localpart(
+        self, create: Callable[[str], Awaitable[T]]
+    ) -> Optional[T]:
+        """Create a user with a newly generated localpart. Localparts are unique
+        by construction, so they aren't checked upfront. If a localpart is taken
+        anyway, the creation fails and is retried with another localpart.
+
+        Args:
+            create: Creates the user with the given localpart
+
+        Returns:
+            The result of `create`, or None if all localparts were taken.
+        """
+        for _ in range(LOCALPART_ATTEMPTS):
+            localpart = generate_localpart(self._config.user_id_prefix)
+
+            try:
+                return await create(localpart)
+            except (SynapseError, HttpResponseException) as e:
+                if not _is_user_in_use(e):
+                    raise
+
+            localpart_conflicts.inc()
+            logger.warning("Localpart '%s' is already taken", localpart)
+
+        return None
+
+    async def _register_local_guest(
+        self, displayname: str
+    ) -> Optional[Tuple[str, str, str]]:
+        """Register a local guest user with a device, and store it in the DB.
+
+        Args:
+            displayname: The displayname of the new user, including the suffix
+
+        Returns:
+            A tuple of (user_id, device_id, access_token), or None if no free
+            localpart was found.
+        """
+        created_at_sec = int(time.time())
+
+        local_registrar = self._get_local_registrar()
+        if local_registrar is not None:
+            if self._tables_ready is not None:
+                await self._tables_ready.wait()
+
+            with registration_phase_seconds.labels("single_transaction").time():
+                registered = await self._with_new_localpart(
+                    lambda localpart: local_registrar.register(
+                        localpart, displayname, created_at_sec
+                    )
+                )
+            if registered is not None and self._reaper is not None:
+                self._reaper.user_registered(created_at_sec)
+
+            return registered
+
+        user_id = await self._with_new_localpart(
+            lambda localpart: self._register_local_user(localpart, displayname)
+        )
+        if user_id is None:
+            return None
+
+        try:
+            await self._store_user(user_id, created_at_sec)
+        except Exception:
+            # Without the tracking row, the reaper would never deactivate it.
+            await self._rollback_local_user(user_id)
+            raise
+
+        with registration_phase_seconds.labels("register_device").time():
+            device_id, access_token, _, _ = await self._api.register_device(user_id)
+        return user_id, device_id, access_token
+
+    def _get_local_registrar(self) -> LocalGuestRegistrar | None:
+        """Return the registrar for single-transaction registrations, if they
+        are enabled and this module runs in the main process.
+        """
+        if not self._config.single_transaction_registration:
+            return None
 
-            return 201, res
+        if self._api.worker_app is not None:
+            return None
 
-        return 500, {"msg": "Internal error: Could not find a free username"}
+        hs: "HomeServer | None" = getattr(self._api, "_hs", None)
+        if hs is None:
+            return None
+
+        return LocalGuestRegistrar(self._api, hs, self._config)
+
+    async def _register_local_user(self, localpart: str, displayname: str) -> str:
+        logger.info(
+            "Registering local Synapse guest user with localpart '%s'", localpart
+        )
+        with registration_phase_seconds.labels("register_user").time():
+            return await self._api.register_user(localpart, displayname)
+
+    def _registration_response(
+        self, user_id: str, device_id: str, access_token: str
+    ) -> Dict[str, Any]:
+        return {
+            "userId": user_id,
+            "deviceId": device_id,
+            "accessToken": access_token,
+            "homeserverUrl": self._api.public_baseurl,
+        }
+
+    async def _create_mas_user(self, localpart: str) -> Tuple[str, str]:
+        """Create a guest user in MAS.
+
+        Args:
+            localpart: The localpart of the new user
+
+        Returns:
+            A tuple of (mas_user_id, user_id).
+        """
+        assert self._mas_admin_client is not None
+
+        logger.info("Registering MAS guest user with localpart '%s'", localpart)
+
+        # This will be the MAS-specific user ID (i.e. "01KFNJEB720EAGR907PSXRXQ51")
+        with registration_phase_seconds.labels("mas_create_user").time():
+            mas_user_id = await self._mas_admin_client.create_user(localpart)
+        # This is the Matrix user ID (i.e. "@guest_abc123:matrix.org")
+        user_id = self._api.get_qualified_user_id(localpart)
+
+        logger.info(f"Registered guest user: '{user_id}' (MAS ID: '{mas_user_id}')")
+
+        return mas_user_id, user_id
+
+    async def _setup_mas_user(
+        self, mas_user_id: str, user_id: str, displayname: str, stored: bool
+    ) -> Tuple[str, str]:
+        """Set the displayname of a new MAS user and create a session for it.
+        These steps, and storing the user if it isn't stored yet, run
+        concurrently. If any of them fails, the MAS user is deactivated again and
+        the error is raised.
+
+        Args:
+            mas_user_id: The MAS user ID
+            user_id: The Matrix user ID
+            displayname: The displayname of the new user, including the suffix
+            stored: Whether the user is already stored in the DB
+
+        Returns:
+            A tuple of (device_id, access_token).
+        """
+        assert self._mas_admin_client is not None
+
+        # Determine how long to keep the access token valid for.
+        #
+        # If a user reaper is enabled, just have the token expire after
+        # the configured period.
+        expires_in_sec = (
+            self._config.user_expiration_seconds
+            if self._config.enable_user_reaper
+            else 0
+        )
+
+        steps: List["defer.Deferred[Any]"] = [
+            run_in_background(
+                measure_phase,
+                "mas_create_session",
+                self._mas_admin_client.create_personal_session,
+                mas_user_id,
+                expires_in_sec,
+            ),
+            run_in_background(
+                measure_phase,
+                "set_displayname",
+                self._api.set_displayname,
+                UserID.from_string(user_id),
+                displayname,
+            ),
+        ]
+        if not stored:
+            steps.append(
+                run_in_background(
+                    self._store_mas_user, mas_user_id, user_id, int(time.time())
+                )
+            )
+
+        results: List[Tuple[bool, Any]] = await make_deferred_yieldable(
+            defer.DeferredList(steps, consumeErrors=True)
+        )
+        if not stored:
+            stored, _ = results[2]
+
+        failures = [result for success, result in results if not success]
+        if len(failures) > 0:
+            await self._rollback_mas_user(mas_user_id, stored)
+            failures[0].raiseException()
+
+        _, (device_id, access_token) = results[0]
+        return device_id, access_token
+
+    async def _rollback_local_user(self, user_id: str) -> None:
+        """Deactivate a local user whose registration failed before it was
+        stored in the DB.
+
+        Args:
+            user_id: The Matrix user ID
+        """
+        logger.warning("Rolling back registration of local user '%s'", user_id)
+
+        if self._reaper is None:
+            logger.error("Can't deactivate local user '%s' without a reaper", user_id)
+            return
+
+        try:
+            await self._reaper.deactivate_local_user(user_id)
+        except Exception as e:
+            logger.error(
+                "Failed to deactivate local user '%s' after a failed registration: %s",
+                user_id,
+                e,
+            )
+
+    async def _rollback_mas_user(self, mas_user_id: str, stored: bool) -> None:
+        """Deactivate a MAS user whose registration failed halfway.
+
+        Args:
+            mas_user_id: The MAS user ID
+            stored: Whether the user was already stored in the DB
+        """
+        assert self._mas_admin_client is not None
+
+        logger.warning("Rolling back registration of MAS user '%s'", mas_user_id)
+
+        try:
+            await self._mas_admin_client.deactivate_user(mas_user_id)
+        except Exception as e:
+            # If the user was stored, the reaper will try again later.
+            logger.error(
+                "Failed to deactivate MAS user '%s' after a failed registration: %s",
+                mas_user_id,
+                e,
+            )
+            return
+
+        if not stored:
+            return
+
+        def delete_user(txn: LoggingTransaction) -> None:
+            txn.execute(
+                "DELETE FROM guest_module_mas_users WHERE mas_user_id = ?",
+                (mas_user_id,),
+            )
+
+        await self._api.run_db_interaction("guest_module_delete_mas_user", delete_user)
+
+    async def _store_user(self, user_id: str, created_at_sec: int) -> None:
+        """Store details about the local user in the DB, so that the reaper can
+        find it.
+
+        Args:
+            user_id: The Matrix user ID
+            created_at_sec: The creation timestamp in seconds since the unix epoch
+        """
+        await self._store_users([user_id], created_at_sec)
+
+    async def _store_users(self, user_ids: List[str], created_at_sec: int) -> None:
+        """Store details about local users in the DB. The users are stored
+        together with those of concurrent registrations.
+
+        Args:
+            user_ids: The Matrix user IDs
+            created_at_sec: The creation timestamp in seconds since the unix epoch
+        """
+        if len(user_ids) == 0:
+            return
+
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        with registration_phase_seconds.labels("store_user").time():
+            await self._user_inserter.insert(
+                [(user_id, created_at_sec) for user_id in user_ids]
+            )
+
+        if self._reaper is not None:
+            self._reaper.user_registered(created_at_sec)
 
     async def _store_mas_user(
         self, mas_user_id: str, user_id: str, created_at_sec: int
@@ -147,18 +773,104 @@ class GuestRegistrationServlet(DirectServeJsonResource):
             user_id: The Matrix user ID
             created_at_sec: The creation timestamp in seconds since the unix epoch
         """
-        if self._mas_tables_ready is not None:
-            await self._mas_tables_ready.wait()
-
-        def store_user(txn: Any) -> None:
-            DatabasePool.simple_insert_txn(
-                txn,
-                table="guest_module_mas_users",
-                values={
-                    "mas_user_id": mas_user_id,
-                    "user_id": user_id,
-                    "created_at_sec": created_at_sec,
-                },
+        await self._store_mas_users([(mas_user_id, user_id)], created_at_sec)
+
+    async def _store_mas_users(
+        self, users: List[Tuple[str, str]], created_at_sec: int
+    ) -> None:
+        """Store details about MAS users in the DB. The users are stored
+        together with those of concurrent registrations.
+
+        Args:
+            users: The (MAS user ID, Matrix user ID) of each user
+            created_at_sec: The creation timestamp in seconds since the unix epoch
+        """
+        if len(users) == 0:
+            return
+
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        with registration_phase_seconds.labels("store_user").time():
+            await self._mas_user_inserter.insert(
+                [
+                    (mas_user_id, user_id, created_at_sec)
+                    for mas_user_id, user_id in users
+                ]
             )
 
-        await self._api.run_db_interaction("guest_module_store_mas_user", store_user)
+        if self._reaper is not None:
+            self._reaper.user_registered(created_at_sec)
+
+
+async def _count_registration(
+    registration: Awaitable[Tuple[int, Dict[str, Any]]],
+) -> Tuple[int, Dict[str, Any]]:
+    """Await the registration and count its response status. Queued
+    registrations are only counted once they finished, not with their 202.
+    """
+    try:
+        status, response = await registration
+    except SynapseError as e:
+        registrations.labels(str(e.code)).inc()
+        raise
+    except Exception:
+        registrations.labels("500").inc()
+        raise
+
+    if status != 202:
+        registrations.labels(str(status)).inc()
+
+    return status, response
+
+
+def _get_client_ip(request: Request) -> str:
+    """Returns the IP address of the client, taking X-Forwarded-For into account
+    if Synapse is configured to trust it.
+    """
+    if isinstance(request, SynapseRequest):
+        return request.get_client_ip_if_available()
+
+    return getattr(request.client, "host", "")
+
+
+def _is_user_in_use(e: Exception) -> bool:
+    """Returns whether the error is Synapse or MAS rejecting a localpart that is
+    already taken.
+    """
+    if isinstance(e, SynapseError):
+        return e.errcode == Codes.USER_IN_USE
+
+    return isinstance(e, HttpResponseException) and e.code == 409
+
+
+def _parse_displayname(request: Request) -> Optional[str]:
+    """Returns the stripped displayname from the body of a registration
+    request, or None if it is missing or empty.
+    """
+    json_dict = parse_json_object_from_request(request)
+
+    displayname = json_dict.get("displayname")
+    if not isinstance(displayname, str) or len(displayname.strip()) == 0:
+        return None
+
+    return displayname.strip()
+
+
+def _prefers_async(request: Request) -> bool:
+    """Returns whether the request has a `Prefer: respond-async` header, see
+    RFC 7240.
+    """
+    for header in request.requestHeaders.getRawHeaders(b"Prefer") or []:
+        for preference in header.split(b","):
+            if preference.split(b";")[0].strip().lower() == b"respond-async":
+                return True
+
+    return False
+
+
+def _too_many_requests(retry_after_sec: float) -> Tuple[int, Dict[str, Any]]:
+    return 429, {
+        "msg": "Too many guest registrations, try again later",
+        "retry_after_ms": math.ceil(retry_after_sec * 1000),
+    }
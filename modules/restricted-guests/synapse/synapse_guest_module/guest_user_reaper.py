@@ -10,15 +10,51 @@
 import asyncio
 import logging
 import time
-from typing import List
-
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from synapse.handlers.deactivate_account import DeactivateAccountHandler
 from synapse.module_api import DatabasePool, LoggingTransaction, ModuleApi
+from synapse.types import create_requester
+from synapse.util.async_helpers import concurrently_execute
 
+from synapse_guest_module.async_helpers import WakeableSleeper
 from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.lease import DbLease
 from synapse_guest_module.mas_admin_client import MasAdminClient
+from synapse_guest_module.metrics import (
+    reaper_backlog,
+    reaper_deactivations,
+    reaper_failures,
+    reaper_oldest_overdue_seconds,
+    reaper_pass_seconds,
+)
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
 
 logger = logging.getLogger("synapse.contrib." + __name__)
 
+T = TypeVar("T")
+
+# How many expired users are fetched and deactivated at a time.
+REAPER_BATCH_SIZE = 100
+
+# The longest time the reaper sleeps, even if no user expires before.
+REAPER_MAX_INTERVAL_SEC = 60.0 * 60.0
+
+# How long the reaper waits before it retries users that are already expired,
+# i.e. whose deactivation failed.
+REAPER_RETRY_INTERVAL_SEC = 60.0
+
 
 class GuestUserReaper:
     def __init__(
@@ -26,13 +62,19 @@ class GuestUserReaper:
         api: ModuleApi,
         config: GuestModuleConfig,
         mas_admin_client: MasAdminClient | None = None,
-        mas_tables_ready: asyncio.Event | None = None,
+        tables_ready: asyncio.Event | None = None,
     ):
         self._api = api
         self._config = config
         self._mas_admin_client = mas_admin_client
-        self._mas_tables_ready = mas_tables_ready
+        self._tables_ready = tables_ready
         self.reaper_user = f"{config.user_id_prefix}reaper"
+        self._sleeper = WakeableSleeper(api)
+        # When the reaper will run next, as seconds since the unix epoch.
+        self._next_run_at: float | None = None
+        # Only one of the processes that load the module runs a pass at a time.
+        self._lease = DbLease(api, "reaper", tables_ready)
+        self._holds_lease = False
 
     async def run(self) -> None:
         logger.info("User cleanup job started")
@@ -43,67 +85,201 @@ class GuestUserReaper:
             logger.debug("Run deactivation loop")
 
             try:
-                await self.deactivate_expired_guest_users()
+                await self._run_pass()
             except Exception as e:
                 logger.error("Error in the user deactivation: %s", e)
 
-            await self._api.sleep(60.0)
+            try:
+                delay = await self.get_next_run_delay()
+            except Exception as e:
+                logger.error("Error while scheduling the user deactivation: %s", e)
+                delay = REAPER_RETRY_INTERVAL_SEC
+
+            logger.debug("Next deactivation loop in %.0fs", delay)
+
+            self._next_run_at = time.time() + delay
+            await self._sleeper.sleep(delay)
+            self._next_run_at = None
+
+    async def _run_pass(self) -> None:
+        """Run a reaper pass, unless another process is running one.
+
+        Without MAS, workers don't compete for the lease, since they can only
+        deactivate users through the admin API of the main process.
+        """
+        if self._mas_admin_client is None and self._is_worker():
+            return
+
+        if not await self._lease.acquire():
+            return
+
+        self._holds_lease = True
+        try:
+            await self.deactivate_expired_guest_users()
+        finally:
+            self._holds_lease = False
+            await self._lease.release()
+
+    def user_registered(self, created_at_sec: int) -> None:
+        """Tell the reaper about a new user, so that it can wake up early if the
+        user expires before the reaper would run next.
+
+        Args:
+            created_at_sec: The creation timestamp in seconds since the unix epoch
+        """
+        if self._next_run_at is None:
+            return
+
+        if self._expires_at(created_at_sec) < self._next_run_at:
+            self._sleeper.wake()
+
+    async def get_next_run_delay(self) -> float:
+        """Return how many seconds to wait until the earliest tracked user
+        expires, at most `REAPER_MAX_INTERVAL_SEC` or the expiration interval.
+
+        Users registered by a worker don't wake up the reaper, so it has to
+        look for them at least once per expiration interval.
+        """
+        max_delay = min(
+            REAPER_MAX_INTERVAL_SEC, float(self._config.user_expiration_seconds)
+        )
+
+        if self._mas_admin_client is not None:
+            table = "guest_module_mas_users"
+        else:
+            table = "guest_module_users"
+
+        def get_earliest_created_at(txn: LoggingTransaction) -> int | None:
+            txn.execute(f"SELECT MIN(created_at_sec) FROM {table}", ())
+            row = txn.fetchone()
+            return None if row is None else row[0]
+
+        earliest_created_at: int | None = await self._api.run_db_interaction(
+            "guest_module_get_earliest_created_at", get_earliest_created_at
+        )
+        if earliest_created_at is None:
+            return max_delay
+
+        delay = self._expires_at(earliest_created_at) - time.time()
+        if delay <= 0:
+            # The user is already expired, but its deactivation failed
+            return REAPER_RETRY_INTERVAL_SEC
+
+        return min(delay, max_delay)
+
+    def _expires_at(self, created_at_sec: int) -> float:
+        # A user is expired once it is older than the expiration interval,
+        # which is one second after it reached it (see the expiry queries).
+        return created_at_sec + self._config.user_expiration_seconds + 1
 
     async def deactivate_expired_guest_users(self) -> None:
         """Deactivate all users that are older than the specified expiration
-        interval. This uses the admin API to disable the user.
+        interval. On the main process, this calls the deactivation handler of
+        Synapse directly. Otherwise, it falls back to the admin API.
         """
         if self._mas_admin_client is not None:
             await self._deactivate_expired_mas_users()
             return
 
-        def get_expired_users(txn: LoggingTransaction) -> List[str]:
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        # date operations are database-specific (postgres, sqlite, ...)
+        expire_ts_seconds = int(time.time() - self._config.user_expiration_seconds)
+
+        def get_expired_users(
+            txn: LoggingTransaction, after: Optional[Tuple[int, str]]
+        ) -> List[Tuple[str, int]]:
             sql = """
-            SELECT name
-            FROM users
-            WHERE name != ?
-            AND name LIKE ?
-            AND deactivated = 0
-            AND creation_ts < ?;
+            SELECT user_id, created_at_sec
+            FROM guest_module_users
+            WHERE created_at_sec < ?
             """
+            args: List[Any] = [expire_ts_seconds]
 
-            # date operations are database-specific (postgres, sqlite, ...)
-            expire_ts_seconds = int(time.time() - self._config.user_expiration_seconds)
-            txn.execute(
-                sql,
-                (
-                    self._api.get_qualified_user_id(self.reaper_user),
-                    f"@{self._config.user_id_prefix}%:{self._api.server_name}",
-                    expire_ts_seconds,
-                ),
+            if after is not None:
+                sql += """
+                AND (created_at_sec > ? OR (created_at_sec = ? AND user_id > ?))
+                """
+                args.extend((after[0], after[0], after[1]))
+
+            sql += " ORDER BY created_at_sec, user_id LIMIT ?"
+            args.append(REAPER_BATCH_SIZE)
+
+            txn.execute(sql, args)
+            return [(row[0], row[1]) for row in txn.fetchall()]
+
+        deactivate_account_handler = self._get_deactivate_account_handler()
+        # Deactivations fail in the deactivation handler of Synapse or when
+        # calling the admin API of Synapse.
+        failure_cause = "admin_api" if deactivate_account_handler is None else "synapse"
+        token: str | None = None
+
+        async def deactivate_user(user_id: str) -> None:
+            await self._deactivate_local_user(
+                user_id, deactivate_account_handler, token
+            )
+
+        async def deactivate_batch(user_ids: List[str]) -> List[str]:
+            nonlocal token
+            if deactivate_account_handler is None and token is None:
+                token = await self.get_admin_token()
+
+            deactivated = await self._deactivate_users(
+                user_ids, deactivate_user, failure_cause
+            )
+            await self._remove_users(
+                "guest_module_delete_users",
+                "guest_module_users",
+                "user_id",
+                deactivated,
             )
-            expired_users_rows = txn.fetchall()
 
-            return [row[0] for row in expired_users_rows]
+            return deactivated
 
-        expired_users: List[str] = await self._api.run_db_interaction(
+        await self._deactivate_in_batches(
+            "guest_module_users",
             "guest_module_get_expired_users",
             get_expired_users,
+            deactivate_batch,
         )
 
-        if len(expired_users) > 0:
-            logger.info("Deactivate %d users", len(expired_users))
+    async def deactivate_local_user(self, user_id: str) -> None:
+        """Deactivate a single local user, e.g. one whose registration failed
+        halfway. On the main process, this calls the deactivation handler of
+        Synapse directly. Otherwise, it falls back to the admin API.
+        """
+        deactivate_account_handler = self._get_deactivate_account_handler()
+        token = (
+            await self.get_admin_token() if deactivate_account_handler is None else None
+        )
 
-            token = await self.get_admin_token()
+        await self._deactivate_local_user(user_id, deactivate_account_handler, token)
 
-            for user_id in expired_users:
-                logger.debug("Deactivate user %s", user_id)
+    async def _deactivate_local_user(
+        self,
+        user_id: str,
+        deactivate_account_handler: DeactivateAccountHandler | None,
+        token: str | None,
+    ) -> None:
+        logger.debug("Deactivate user %s", user_id)
+
+        if deactivate_account_handler is not None:
+            await deactivate_account_handler.deactivate_account(
+                user_id,
+                erase_data=False,
+                requester=create_requester(user_id),
+                by_admin=True,
+            )
+            return
 
-                url = f"http://localhost:8008/_synapse/admin/v1/deactivate/{user_id}"
+        url = f"http://localhost:8008/_synapse/admin/v1/deactivate/{user_id}"
 
-                try:
-                    await self._api.http_client.post_json_get_json(
-                        uri=url,
-                        post_json={},
-                        headers={"Authorization": ["Bearer {}".format(token)]},
-                    )
-                except Exception as e:
-                    logger.error('Failed to delete user "%s": %s', user_id, e)
+        await self._api.http_client.post_json_get_json(
+            uri=url,
+            post_json={},
+            headers={"Authorization": ["Bearer {}".format(token)]},
+        )
 
     async def _deactivate_expired_mas_users(self) -> None:
         """Deactivate all MAS users that are older than the specified expiration
@@ -112,52 +288,243 @@ class GuestUserReaper:
 
         assert self._mas_admin_client is not None
 
-        if self._mas_tables_ready is not None:
-            await self._mas_tables_ready.wait()
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
 
-        def get_expired_users(txn: LoggingTransaction) -> List[str]:
-            expire_ts_seconds = int(time.time() - self._config.user_expiration_seconds)
-            txn.execute(
+        expire_ts_seconds = int(time.time() - self._config.user_expiration_seconds)
+
+        def get_expired_users(
+            txn: LoggingTransaction, after: Optional[Tuple[int, str]]
+        ) -> List[Tuple[str, int]]:
+            sql = """
+            SELECT mas_user_id, created_at_sec
+            FROM guest_module_mas_users
+            WHERE created_at_sec < ?
+            """
+            args: List[Any] = [expire_ts_seconds]
+
+            if after is not None:
+                sql += """
+                AND (created_at_sec > ? OR (created_at_sec = ? AND mas_user_id > ?))
                 """
-                SELECT mas_user_id
-                FROM guest_module_mas_users
-                WHERE created_at_sec < ?
-                """,
-                (expire_ts_seconds,),
+                args.extend((after[0], after[0], after[1]))
+
+            sql += " ORDER BY created_at_sec, mas_user_id LIMIT ?"
+            args.append(REAPER_BATCH_SIZE)
+
+            txn.execute(sql, args)
+            return [(row[0], row[1]) for row in txn.fetchall()]
+
+        async def deactivate_batch(mas_user_ids: List[str]) -> List[str]:
+            assert self._mas_admin_client is not None
+
+            deactivated = await self._deactivate_users(
+                mas_user_ids, self._mas_admin_client.deactivate_user, "mas_api"
+            )
+            await self._remove_users(
+                "guest_module_delete_mas_users",
+                "guest_module_mas_users",
+                "mas_user_id",
+                deactivated,
             )
-            expired_users_rows = txn.fetchall()
 
-            return [row[0] for row in expired_users_rows]
+            return deactivated
 
-        expired_users: List[str] = await self._api.run_db_interaction(
+        await self._deactivate_in_batches(
+            "guest_module_mas_users",
             "guest_module_get_expired_mas_users",
             get_expired_users,
+            deactivate_batch,
         )
 
-        if len(expired_users) == 0:
+    async def _deactivate_in_batches(
+        self,
+        table: str,
+        desc: str,
+        get_expired_users: Callable[
+            [LoggingTransaction, Optional[Tuple[int, str]]], List[Tuple[str, int]]
+        ],
+        deactivate_batch: Callable[[List[str]], Awaitable[List[str]]],
+    ) -> None:
+        """Page through the expired users in batches of `REAPER_BATCH_SIZE`, and
+        deactivate each batch before the next one is fetched.
+
+        Batches are ordered by creation time and user ID, and the last row of a
+        batch is the cursor for the next one. Users whose deactivation failed
+        are therefore skipped for the rest of the pass instead of being fetched
+        again.
+
+        The backlog of expired users is measured before and after the pass.
+
+        Args:
+            table: The table that tracks the users
+            desc: The description of the DB interaction that fetches a batch
+            get_expired_users: Fetches the (user ID, creation time) of the
+                expired users after the given (creation time, user ID) cursor
+            deactivate_batch: Deactivates a batch of users, and returns the IDs
+                of the users that were deactivated
+        """
+        after: Optional[Tuple[int, str]] = None
+        expired_count = 0
+        deactivated_count = 0
+        start = time.monotonic()
+
+        await self._update_backlog(table)
+
+        while True:
+            batch: List[Tuple[str, int]] = await self._run_db_interaction(
+                desc, get_expired_users, after
+            )
+            if len(batch) == 0:
+                break
+
+            logger.debug("Deactivate %d users", len(batch))
+
+            deactivated = await deactivate_batch([user_id for user_id, _ in batch])
+            expired_count += len(batch)
+            deactivated_count += len(deactivated)
+
+            if len(batch) < REAPER_BATCH_SIZE:
+                break
+
+            last_user_id, last_created_at = batch[-1]
+            after = (last_created_at, last_user_id)
+
+            if self._holds_lease and not await self._lease.acquire():
+                logger.warning("Lost the reaper lease, stopping the deactivation")
+                break
+
+        if expired_count > 0:
+            await self._update_backlog(table)
+
+        duration = time.monotonic() - start
+        reaper_pass_seconds.observe(duration)
+
+        if expired_count == 0:
             return
 
-        logger.info("Deactivating %d expired MAS users", len(expired_users))
+        logger.info(
+            "Deactivated %d of %d users in %.2fs (%.1f users/s)",
+            deactivated_count,
+            expired_count,
+            duration,
+            deactivated_count / duration if duration > 0 else 0.0,
+        )
 
-        token = await self._mas_admin_client.request_admin_token()
+    async def _update_backlog(self, table: str) -> None:
+        """Measure how many tracked users are expired but not deactivated yet,
+        and how long the oldest of them has been expired.
 
-        for mas_user_id in expired_users:
+        Args:
+            table: The table that tracks the users
+        """
+        expire_ts_seconds = time.time() - self._config.user_expiration_seconds
+
+        def get_backlog(txn: LoggingTransaction) -> Tuple[int, int | None]:
+            txn.execute(
+                f"SELECT COUNT(*), MIN(created_at_sec) FROM {table}"
+                " WHERE created_at_sec < ?",
+                (int(expire_ts_seconds),),
+            )
+            row = txn.fetchone()
+            return (0, None) if row is None else (row[0], row[1])
+
+        count, oldest_created_at = await self._run_db_interaction(
+            "guest_module_get_reaper_backlog", get_backlog
+        )
+
+        reaper_backlog.set(count)
+        reaper_oldest_overdue_seconds.set(
+            0.0 if oldest_created_at is None else expire_ts_seconds - oldest_created_at
+        )
+
+    async def _run_db_interaction(
+        self, desc: str, func: Callable[..., T], *args: Any
+    ) -> T:
+        """Run a DB interaction of the reaper, and count it if it fails."""
+        try:
+            return await self._api.run_db_interaction(desc, func, *args)
+        except Exception:
+            reaper_failures.labels("database").inc()
+            raise
+
+    def _is_worker(self) -> bool:
+        """Returns whether this module runs in a worker process."""
+        return self._api.worker_app is not None
+
+    def _get_deactivate_account_handler(self) -> DeactivateAccountHandler | None:
+        """Return the deactivation handler of Synapse, if this module runs in
+        the main process. The handler isn't part of the module API, and
+        deactivating users is only supported by the main process.
+        """
+        if self._is_worker():
+            return None
+
+        hs: "HomeServer | None" = getattr(self._api, "_hs", None)
+        if hs is None:
+            return None
+
+        return hs.get_deactivate_account_handler()
+
+    async def _deactivate_users(
+        self,
+        user_ids: List[str],
+        deactivate_user: Callable[[str], Awaitable[None]],
+        failure_cause: str,
+    ) -> List[str]:
+        """Deactivate the given users, running up to `reaper_concurrency`
+        deactivations at the same time. A failed deactivation is logged and
+        doesn't affect the other users.
+
+        Args:
+            user_ids: The IDs of the users to deactivate
+            deactivate_user: Deactivates a single user
+            failure_cause: The cause under which failed deactivations are counted
+
+        Returns:
+            The IDs of the users that were deactivated.
+        """
+        deactivated: List[str] = []
+
+        async def deactivate(user_id: str) -> None:
             try:
-                await self._mas_admin_client.deactivate_user(mas_user_id, token)
-                await self._remove_mas_user(mas_user_id)
+                await deactivate_user(user_id)
             except Exception as e:
-                logger.error('Failed to deactivate MAS user "%s": %s', mas_user_id, e)
+                logger.error('Failed to deactivate user "%s": %s', user_id, e)
+                reaper_failures.labels(failure_cause).inc()
+                return
 
-    async def _remove_mas_user(self, mas_user_id: str) -> None:
-        def delete_user(txn: LoggingTransaction) -> None:
-            txn.execute(
-                "DELETE FROM guest_module_mas_users WHERE mas_user_id = ?",
-                (mas_user_id,),
+            reaper_deactivations.inc()
+            deactivated.append(user_id)
+
+        await concurrently_execute(
+            deactivate, user_ids, self._config.reaper_concurrency
+        )
+
+        return deactivated
+
+    async def _remove_users(
+        self, desc: str, table: str, column: str, user_ids: List[str]
+    ) -> None:
+        """Stop tracking the given users, using a single transaction.
+
+        Args:
+            desc: The description of the DB interaction
+            table: The table that tracks the users
+            column: The column of `table` that holds the user IDs
+            user_ids: The IDs of the deactivated users
+        """
+        if len(user_ids) == 0:
+            return
+
+        def delete_users(txn: LoggingTransaction) -> None:
+            DatabasePool.simple_delete_many_txn(
+                txn, table=table, column=column, values=user_ids, keyvalues={}
             )
 
-        await self._api.run_db_interaction(
-            "guest_module_delete_mas_user",
-            delete_user,
+        await self._run_db_interaction(
+            desc,
+            delete_users,
         )
 
     async def get_admin_token(self) -> str:
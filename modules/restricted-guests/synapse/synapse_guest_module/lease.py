@@ -0,0 +1,84 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import asyncio
+import logging
+import secrets
+import time
+
+from synapse.module_api import LoggingTransaction, ModuleApi
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# How long a lease stays valid if it isn't renewed, e.g. because its holder died.
+LEASE_DURATION_SEC = 5 * 60
+
+
+class DbLease:
+    """A named lease in `guest_module_leases`, so that a background task only
+    runs in one of the processes (main process and workers) that load the
+    module at a time.
+
+    A lease is held until it is released or until it expires. An expired lease
+    can be taken over by any process, so the task fails over if its holder
+    dies.
+    """
+
+    def __init__(
+        self, api: ModuleApi, name: str, tables_ready: asyncio.Event | None = None
+    ):
+        self._api = api
+        self._name = name
+        self._tables_ready = tables_ready
+        self._holder = f"{api.worker_name or 'master'}-{secrets.token_hex(8)}"
+
+    async def acquire(self) -> bool:
+        """Acquire the lease, or renew it if it is already held by this process.
+
+        Returns:
+            Whether this process holds the lease.
+        """
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        now = int(time.time())
+
+        def acquire_txn(txn: LoggingTransaction) -> bool:
+            txn.execute(
+                """
+                INSERT INTO guest_module_leases (name, holder, expires_at_sec)
+                VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE
+                SET holder = excluded.holder, expires_at_sec = excluded.expires_at_sec
+                WHERE guest_module_leases.holder = excluded.holder
+                OR guest_module_leases.expires_at_sec <= ?
+                """,
+                (self._name, self._holder, now + LEASE_DURATION_SEC, now),
+            )
+            txn.execute(
+                "SELECT holder FROM guest_module_leases WHERE name = ?",
+                (self._name,),
+            )
+            row = txn.fetchone()
+            return row is not None and row[0] == self._holder
+
+        acquired: bool = await self._api.run_db_interaction(
+            "guest_module_acquire_lease", acquire_txn
+        )
+        if not acquired:
+            logger.debug('Lease "%s" is held by another process', self._name)
+
+        return acquired
+
+    async def release(self) -> None:
+        """Release the lease, if this process holds it."""
+
+        def release_txn(txn: LoggingTransaction) -> None:
+            txn.execute(
+                "DELETE FROM guest_module_leases WHERE name = ? AND holder = ?",
+                (self._name, self._holder),
+            )
+
+        await self._api.run_db_interaction("guest_module_release_lease", release_txn)
@@ -0,0 +1,136 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import logging
+from typing import TYPE_CHECKING, Tuple
+
+from synapse.module_api import DatabasePool, LoggingTransaction, ModuleApi
+from synapse.types import UserID
+from synapse.util.stringutils import random_string
+
+from synapse_guest_module.config import GuestModuleConfig
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+
+class LocalGuestRegistrar:
+    """Registers local guest users in a single DB transaction: the user, its
+    profile, a device, an access token and the row in `guest_module_users`.
+
+    Registering through the module API takes a transaction for each of these
+    steps. To save them, this calls into the storage of Synapse directly, which
+    is only possible in the main process. Unlike a regular registration, it
+    skips the registration spam checks, the auto-join rooms and the user
+    directory, which guests don't need.
+    """
+
+    def __init__(self, api: ModuleApi, hs: "HomeServer", config: GuestModuleConfig):
+        self._api = api
+        self._hs = hs
+        self._config = config
+
+    async def register(
+        self, localpart: str, displayname: str, created_at_sec: int
+    ) -> Tuple[str, str, str]:
+        """Register a local guest user with a device and an access token.
+
+        Args:
+            localpart: The localpart of the new user
+            displayname: The displayname of the new user, including the suffix
+            created_at_sec: The creation timestamp in seconds since the unix epoch
+
+        Raises:
+            SynapseError: If the server is over its user limits, or with
+                `M_USER_IN_USE` if the localpart is already taken.
+
+        Returns:
+            A tuple of (user_id, device_id, access_token).
+        """
+        # Checks the monthly active user limits, like a regular registration.
+        await self._hs.get_auth_blocking().check_auth_blocking()
+
+        store = self._hs.get_datastores().main
+        user = UserID(localpart, self._hs.hostname)
+        user_id = user.to_string()
+        device_id = random_string(10).upper()
+        access_token = self._hs.get_auth_handler().generate_access_token(user)
+
+        # If a user reaper is enabled, just have the token expire when the user
+        # does.
+        valid_until_ms = (
+            (created_at_sec + self._config.user_expiration_seconds) * 1000
+            if self._config.enable_user_reaper
+            else None
+        )
+
+        def register_user_txn(txn: LoggingTransaction) -> None:
+            # Creates the user and its profile, see `RegistrationHandler.register_user`.
+            store._register_user(
+                txn,
+                user_id=user_id,
+                password_hash=None,
+                was_guest=False,
+                make_guest=False,
+                appservice_id=None,
+                create_profile_with_displayname=displayname,
+                admin=False,
+                user_type=self._hs.config.user_types.default_user_type,
+                shadow_banned=False,
+                approved=False,
+            )
+            # See `DeviceWorkerStore.store_device`.
+            DatabasePool.simple_insert_txn(
+                txn,
+                table="devices",
+                values={
+                    "user_id": user_id,
+                    "device_id": device_id,
+                    "display_name": None,
+                    "hidden": False,
+                },
+            )
+            store._invalidate_cache_and_stream(
+                txn, store.get_device, (user_id, device_id)
+            )
+            # See `RegistrationStore.add_access_token_to_user`.
+            DatabasePool.simple_insert_txn(
+                txn,
+                table="access_tokens",
+                values={
+                    "id": store._access_tokens_id_gen.get_next(),
+                    "user_id": user_id,
+                    "token": access_token,
+                    "device_id": device_id,
+                    "valid_until_ms": valid_until_ms,
+                    "puppets_user_id": None,
+                    "last_validated": created_at_sec * 1000,
+                    "refresh_token_id": None,
+                    "used": False,
+                },
+            )
+            DatabasePool.simple_insert_txn(
+                txn,
+                table="guest_module_users",
+                values={"user_id": user_id, "created_at_sec": created_at_sec},
+            )
+
+        logger.info(
+            "Registering local Synapse guest user with localpart '%s' in a single "
+            "transaction",
+            localpart,
+        )
+        await self._api.run_db_interaction(
+            "guest_module_register_local_user", register_user_txn
+        )
+
+        # Run the account validity callbacks of other modules and announce the
+        # new device, like a regular registration.
+        await self._hs.get_account_validity_handler().on_user_registration(user_id)
+        await self._hs.get_device_handler().notify_device_update(user_id, [device_id])
+
+        return user_id, device_id, access_token
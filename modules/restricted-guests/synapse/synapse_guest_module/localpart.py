@@ -0,0 +1,42 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+#
+# Originally licensed under the Apache License, Version 2.0:
+# <http://www.apache.org/licenses/LICENSE-2.0>.
+
+import base64
+import secrets
+import time
+
+# Maps the standard base32 alphabet to Crockford's base32 alphabet in lowercase,
+# which sorts like the encoded bytes and only has characters that are valid in
+# localparts.
+_BASE32_TO_LOCALPART = bytes.maketrans(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", b"0123456789abcdefghjkmnpqrstvwxyz"
+)
+
+
+def generate_localpart(user_id_prefix: str) -> str:
+    """Generate a unique localpart for a new guest user.
+
+    Like a ULID, the random string is made of the current time in milliseconds
+    followed by 80 random bits. Two localparts can only be the same if they are
+    generated in the same millisecond and get the same random bits, so they
+    don't have to be checked before they are used.
+
+    Args:
+        user_id_prefix: The configured prefix of guest usernames.
+
+    Returns:
+        The prefix followed by a random string.
+    """
+    timestamp_ms = time.time_ns() // 1_000_000
+    raw = timestamp_ms.to_bytes(6, "big") + secrets.token_bytes(10)
+    random_string = (
+        base64.b32encode(raw).rstrip(b"=").translate(_BASE32_TO_LOCALPART).decode()
+    )
+
+    return user_id_prefix + random_string
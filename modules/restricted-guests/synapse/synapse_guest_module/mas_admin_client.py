@@ -7,13 +7,25 @@ import base64
 import logging
 import random
 import string
+import time
+from typing import Any, Dict
 
+from synapse.api.errors import HttpResponseException
 from synapse.module_api import ModuleApi
 
+from synapse_guest_module.async_helpers import SingleFlight
 from synapse_guest_module.config import MasConfig
 
 logger = logging.getLogger("synapse.contrib." + __name__)
 
+# Treat the admin token as expired this many seconds before MAS does, so that a
+# request started with the token doesn't race against its expiry.
+ADMIN_TOKEN_EXPIRY_MARGIN_SEC = 30
+
+# Refresh the admin token in the background once this fraction of its usable
+# lifetime has passed, so that callers rarely have to wait for a new one.
+ADMIN_TOKEN_REFRESH_FRACTION = 0.75
+
 
 class MasAdminClient:
     def __init__(self, api: ModuleApi, config: MasConfig):
@@ -24,6 +36,15 @@ class MasAdminClient:
         self._oauth_base_url = config.oauth_base_url.rstrip("/")
         self._client_secret = self._load_client_secret()
 
+        self._admin_token: str | None = None
+        self._admin_token_expires_at = 0.0
+        self._admin_token_refresh_at = 0.0
+        self._admin_token_refreshing = False
+
+        # Concurrent callers that need the same resource share one request to MAS.
+        self._token_requests: SingleFlight[str] = SingleFlight()
+        self._deactivations: SingleFlight[None] = SingleFlight()
+
     async def create_user(self, username: str) -> str:
         """Creates a new user in MAS with the given username.
 
@@ -33,14 +54,9 @@ class MasAdminClient:
         Returns:
             The MAS ID of the created user.
         """
-        token = await self.request_admin_token()
         url = self._build_admin_url("/api/admin/v1/users")
 
-        response = await self._api.http_client.post_json_get_json(
-            uri=url,
-            post_json={"username": username},
-            headers={"Authorization": [f"Bearer {token}"]},
-        )
+        response = await self._post_admin_json(url, {"username": username})
 
         mas_user_id: str = response.get("data", {}).get("id")
         if mas_user_id is None or not isinstance(mas_user_id, str):
@@ -60,7 +76,6 @@ class MasAdminClient:
         Returns:
             A tuple of (device_id, access_token).
         """
-        token = await self.request_admin_token()
         url = self._build_admin_url("/api/admin/v1/personal-sessions")
 
         device_id = self._generate_device_id()
@@ -71,11 +86,7 @@ class MasAdminClient:
             "human_name": "guest session",
         }
 
-        response = await self._api.http_client.post_json_get_json(
-            uri=url,
-            post_json=request_body,
-            headers={"Authorization": [f"Bearer {token}"]},
-        )
+        response = await self._post_admin_json(url, request_body)
 
         data = response.get("data", {})
         attributes = data.get("attributes", {}) if isinstance(data, dict) else {}
@@ -86,21 +97,75 @@ class MasAdminClient:
 
         return device_id, access_token
 
-    async def deactivate_user(self, mas_user_id: str, token: str | None = None) -> None:
-        if token is None:
-            token = await self.request_admin_token()
+    async def deactivate_user(self, mas_user_id: str) -> None:
+        """Deactivates the given MAS user. Concurrent deactivations of the same
+        user share one request.
 
+        Args:
+            mas_user_id: The MAS user ID.
+        """
         url = self._build_admin_url(f"/api/admin/v1/users/{mas_user_id}/deactivate")
-        await self._api.http_client.post_json_get_json(
-            uri=url,
-            post_json={"skip_erase": True},
-            headers={"Authorization": [f"Bearer {token}"]},
+        await self._deactivations.run(
+            mas_user_id, lambda: self._post_admin_json(url, {"skip_erase": True})
         )
 
     async def request_admin_token(self) -> str:
+        """
+        Returns an admin access token for MAS. The token is cached until shortly
+        before it expires, and is refreshed in the background once most of its
+        lifetime has passed.
+
+        Returns:
+            The admin access token.
+
+        Raises:
+            ValueError: If the token response is invalid.
+            HttpResponseException: On a non-2xx HTTP response.
+        """
+        now = time.time()
+        token = self._admin_token
+        if token is not None and now < self._admin_token_expires_at:
+            if now >= self._admin_token_refresh_at and not self._admin_token_refreshing:
+                self._admin_token_refreshing = True
+                self._api.run_as_background_process(
+                    "guest_module_mas_admin_token_refresh",
+                    self._refresh_admin_token,
+                    bg_start_span=False,
+                )
+            return token
+
+        return await self._fetch_admin_token()
+
+    def invalidate_admin_token(self, token: str) -> None:
+        """Drop the cached admin token if it is the given one, e.g. after MAS
+        rejected it.
+
+        Args:
+            token: The admin token that was rejected.
+        """
+        if self._admin_token == token:
+            self._admin_token = None
+            self._admin_token_expires_at = 0.0
+            self._admin_token_refresh_at = 0.0
+
+    async def _refresh_admin_token(self) -> None:
+        try:
+            await self._fetch_admin_token()
+        except Exception as e:
+            logger.warning("Failed to refresh the MAS admin token: %s", e)
+        finally:
+            self._admin_token_refreshing = False
+
+    async def _fetch_admin_token(self) -> str:
+        """Request a new admin access token, or wait for the request that is
+        already in flight.
+        """
+        return await self._token_requests.run("admin_token", self._request_token)
+
+    async def _request_token(self) -> str:
         """
         Uses the client credentials flow to request an admin access token
-        from MAS.
+        from MAS, and caches it if the response says when it expires.
 
         Returns:
             The admin access token.
@@ -128,8 +193,47 @@ class MasAdminClient:
         access_token = response.get("access_token")
         if not isinstance(access_token, str) or len(access_token) == 0:
             raise ValueError("MAS token response missing access_token")
+
+        # Without an expiry we can't tell how long the token stays valid, so
+        # it isn't cached and the next caller requests a new one.
+        expires_in = response.get("expires_in")
+        if isinstance(expires_in, int) and not isinstance(expires_in, bool):
+            now = time.time()
+            usable_sec = expires_in - ADMIN_TOKEN_EXPIRY_MARGIN_SEC
+            self._admin_token = access_token
+            self._admin_token_expires_at = now + usable_sec
+            self._admin_token_refresh_at = (
+                now + usable_sec * ADMIN_TOKEN_REFRESH_FRACTION
+            )
+
         return access_token
 
+    async def _post_admin_json(self, url: str, body: Dict[str, Any]) -> Any:
+        """POST a JSON body to the MAS admin API using the cached admin token.
+        If MAS rejects the token, it is dropped and the request is retried once
+        with a new token.
+        """
+        token = await self.request_admin_token()
+        try:
+            return await self._api.http_client.post_json_get_json(
+                uri=url,
+                post_json=body,
+                headers={"Authorization": [f"Bearer {token}"]},
+            )
+        except HttpResponseException as e:
+            if e.code != 401:
+                raise
+
+            logger.info("MAS rejected the admin token, requesting a new one")
+            self.invalidate_admin_token(token)
+
+        token = await self.request_admin_token()
+        return await self._api.http_client.post_json_get_json(
+            uri=url,
+            post_json=body,
+            headers={"Authorization": [f"Bearer {token}"]},
+        )
+
     def _load_client_secret(self) -> str:
         """Source the MAS client secret from either configuration or a file."""
         if self._config.client_secret_filepath is not None:
@@ -0,0 +1,251 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import asyncio
+import logging
+import time
+from typing import Optional, Tuple
+
+from synapse.module_api import DatabasePool, LoggingTransaction, ModuleApi
+from synapse.storage.engines import PostgresEngine
+from synapse.util.async_helpers import concurrently_execute
+
+from synapse_guest_module.async_helpers import WakeableSleeper
+from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_user_reaper import GuestUserReaper
+from synapse_guest_module.lease import DbLease
+from synapse_guest_module.localpart import generate_localpart
+from synapse_guest_module.mas_admin_client import MasAdminClient
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# How many MAS users are created at the same time while refilling the pool.
+REFILL_CONCURRENCY = 5
+
+# How often the pool is checked when no claim woke up the refill loop.
+REFILL_INTERVAL_SEC = 60.0
+
+
+class MasUserPool:
+    """A pool of MAS guest users that are created ahead of time, so that a
+    registration only has to claim one of them instead of creating a new user.
+
+    Pooled users are kept in `guest_module_mas_user_pool` and move to
+    `guest_module_mas_users` once they are claimed, so that their expiration
+    starts with the claim.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        config: GuestModuleConfig,
+        mas_admin_client: MasAdminClient,
+        tables_ready: asyncio.Event | None = None,
+        reaper: GuestUserReaper | None = None,
+    ):
+        assert config.mas is not None
+
+        self._api = api
+        self._config = config
+        self._mas_admin_client = mas_admin_client
+        self._tables_ready = tables_ready
+        self._reaper = reaper
+        self._size = config.mas.user_pool_size
+        self._low_water_mark = config.mas.user_pool_low_water_mark
+        self._sleeper = WakeableSleeper(api)
+        self._lease = DbLease(api, "mas_user_pool", tables_ready)
+
+    async def run(self) -> None:
+        logger.info("MAS user pool refill job started")
+
+        await self._api.sleep(5.0)  # Wait for Synapse to start properly
+
+        while True:
+            try:
+                # Only one of the processes that load the module refills the
+                # pool, so that they don't overfill it together.
+                if await self._lease.acquire():
+                    try:
+                        await self.refill()
+                    finally:
+                        await self._lease.release()
+            except Exception as e:
+                logger.error("Error while refilling the MAS user pool: %s", e)
+
+            await self._sleeper.sleep(REFILL_INTERVAL_SEC)
+
+    async def refill(self) -> None:
+        """Create new MAS users if the pool dropped to its low-water mark."""
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        def count_users(txn: LoggingTransaction) -> int:
+            txn.execute("SELECT COUNT(*) FROM guest_module_mas_user_pool", ())
+            row = txn.fetchone()
+            return int(row[0]) if row is not None else 0
+
+        pool_size: int = await self._api.run_db_interaction(
+            "guest_module_count_mas_user_pool", count_users
+        )
+
+        if pool_size > self._low_water_mark:
+            return
+
+        missing = self._size - pool_size
+        logger.info("Adding %d users to the MAS user pool", missing)
+
+        await concurrently_execute(self._add_user, range(missing), REFILL_CONCURRENCY)
+
+    async def _add_user(self, _: int) -> None:
+        localpart = generate_localpart(self._config.user_id_prefix)
+
+        try:
+            mas_user_id = await self._mas_admin_client.create_user(localpart)
+        except Exception as e:
+            logger.error("Failed to create a MAS user for the pool: %s", e)
+            return
+
+        user_id = self._api.get_qualified_user_id(localpart)
+
+        def store_user(txn: LoggingTransaction) -> None:
+            DatabasePool.simple_insert_txn(
+                txn,
+                table="guest_module_mas_user_pool",
+                values={
+                    "mas_user_id": mas_user_id,
+                    "user_id": user_id,
+                    "created_at_sec": int(time.time()),
+                },
+            )
+
+        await self._api.run_db_interaction(
+            "guest_module_store_mas_pool_user", store_user
+        )
+
+    async def claim_user(self) -> Optional[Tuple[str, str]]:
+        """Atomically take a user out of the pool and start tracking it as a
+        registered guest.
+
+        Returns:
+            A tuple of (mas_user_id, user_id), or None if the pool is empty.
+        """
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        claimed_at_sec = int(time.time())
+
+        def claim_user_txn(
+            txn: LoggingTransaction,
+        ) -> Optional[Tuple[str, str, int]]:
+            if isinstance(txn.database_engine, PostgresEngine):
+                # Skip rows that concurrent claims have locked, so that they
+                # don't all queue up behind the oldest pooled user.
+                txn.execute(
+                    """
+                    DELETE FROM guest_module_mas_user_pool
+                    WHERE mas_user_id = (
+                        SELECT mas_user_id
+                        FROM guest_module_mas_user_pool
+                        ORDER BY created_at_sec
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING mas_user_id, user_id
+                    """,
+                    (),
+                )
+                row = txn.fetchone()
+            else:
+                # SQLite only has a single writer, so there are no concurrent
+                # claims to race against.
+                txn.execute(
+                    """
+                    SELECT mas_user_id, user_id
+                    FROM guest_module_mas_user_pool
+                    ORDER BY created_at_sec
+                    LIMIT 1
+                    """,
+                    (),
+                )
+                row = txn.fetchone()
+                if row is not None:
+                    txn.execute(
+                        "DELETE FROM guest_module_mas_user_pool WHERE mas_user_id = ?",
+                        (row[0],),
+                    )
+
+            if row is None:
+                return None
+
+            mas_user_id, user_id = row
+            DatabasePool.simple_insert_txn(
+                txn,
+                table="guest_module_mas_users",
+                values={
+                    "mas_user_id": mas_user_id,
+                    "user_id": user_id,
+                    "created_at_sec": claimed_at_sec,
+                },
+            )
+
+            txn.execute("SELECT COUNT(*) FROM guest_module_mas_user_pool", ())
+            remaining_row = txn.fetchone()
+            remaining = int(remaining_row[0]) if remaining_row is not None else 0
+
+            return mas_user_id, user_id, remaining
+
+        claimed: Optional[Tuple[str, str, int]] = await self._api.run_db_interaction(
+            "guest_module_claim_mas_pool_user", claim_user_txn
+        )
+        if claimed is None:
+            return None
+
+        mas_user_id, user_id, remaining = claimed
+
+        # Only wake up the refill loop once the pool needs to be refilled, so
+        # that claims don't cause additional transactions.
+        if remaining <= self._low_water_mark:
+            self._sleeper.wake()
+
+        if self._reaper is not None:
+            self._reaper.user_registered(claimed_at_sec)
+
+        return mas_user_id, user_id
+
+
+async def drain_mas_user_pool(
+    api: ModuleApi, tables_ready: asyncio.Event | None = None
+) -> None:
+    """Hand the users that are left in the pool after it was disabled over to
+    the reaper. They expire relative to when they were added to the pool.
+    """
+    if tables_ready is not None:
+        await tables_ready.wait()
+
+    def drain_txn(txn: LoggingTransaction) -> int:
+        txn.execute(
+            """
+            INSERT INTO guest_module_mas_users (mas_user_id, user_id, created_at_sec)
+            SELECT mas_user_id, user_id, created_at_sec
+            FROM guest_module_mas_user_pool
+            -- Without a WHERE clause, SQLite parses ON CONFLICT as a join.
+            WHERE 1 = 1
+            ON CONFLICT (mas_user_id) DO NOTHING
+            """,
+            (),
+        )
+        txn.execute("DELETE FROM guest_module_mas_user_pool", ())
+        return txn.rowcount
+
+    try:
+        drained: int = await api.run_db_interaction(
+            "guest_module_drain_mas_user_pool", drain_txn
+        )
+    except Exception as e:
+        logger.error("Failed to drain the MAS user pool: %s", e)
+        return
+
+    if drained > 0:
+        logger.info("Moved %d users from the disabled MAS user pool", drained)
@@ -0,0 +1,162 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import time
+from typing import Any, Awaitable, Callable, TypeVar
+
+from prometheus_client import Counter, Gauge, Histogram
+
+T = TypeVar("T")
+
+# The metrics are registered with the default registry of prometheus_client,
+# which Synapse exposes on its metrics listener.
+
+# Registrations wait for MAS, so phases can take a lot longer than the default
+# buckets of up to 10 seconds.
+PHASE_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+registration_phase_seconds = Histogram(
+    "synapse_guest_module_registration_phase_seconds",
+    "Time spent in each phase of a guest registration",
+    ["phase"],
+    buckets=PHASE_BUCKETS,
+)
+
+registrations = Counter(
+    "synapse_guest_module_registrations_total",
+    "Guest registrations, by the HTTP status code of their response. Queued "
+    "registrations are counted once they finished.",
+    ["status"],
+)
+
+localpart_conflicts = Counter(
+    "synapse_guest_module_localpart_conflicts_total",
+    "Generated localparts that were already taken, so that the registration "
+    "was retried with another one",
+)
+
+
+async def measure_phase(phase: str, func: Callable[..., Awaitable[T]], *args: Any) -> T:
+    """Call the function and record how long it took as the given phase of a
+    registration.
+    """
+    with registration_phase_seconds.labels(phase).time():
+        return await func(*args)
+
+
+# Reaper passes can take a long time after large events.
+REAPER_PASS_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0, 3600.0)
+
+reaper_backlog = Gauge(
+    "synapse_guest_module_reaper_backlog_users",
+    "Expired guest users that are not deactivated yet, as of the start and the "
+    "end of the last reaper pass of this process",
+)
+
+reaper_oldest_overdue_seconds = Gauge(
+    "synapse_guest_module_reaper_oldest_overdue_seconds",
+    "How long the oldest guest user that is not deactivated yet has been "
+    "expired, as of the start and the end of the last reaper pass of this process",
+)
+
+reaper_pass_seconds = Histogram(
+    "synapse_guest_module_reaper_pass_seconds",
+    "Time spent in a reaper pass",
+    buckets=REAPER_PASS_BUCKETS,
+)
+
+reaper_deactivations = Counter(
+    "synapse_guest_module_reaper_deactivations_total",
+    "Guest users that were deactivated by the reaper",
+)
+
+reaper_failures = Counter(
+    "synapse_guest_module_reaper_failures_total",
+    "Failures of the reaper, by their cause",
+    ["cause"],
+)
+
+
+# The callbacks run inline with the requests of every user, so they should take
+# well below a millisecond.
+CALLBACK_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+callback_calls = Counter(
+    "synapse_guest_module_callback_calls_total",
+    "Calls of the spam checker and third party rules callbacks of the module, "
+    "by whether they concern a guest",
+    ["callback", "user"],
+)
+
+callback_seconds = Histogram(
+    "synapse_guest_module_callback_seconds",
+    "Time spent in the spam checker and third party rules callbacks of the module",
+    ["callback"],
+    buckets=CALLBACK_BUCKETS,
+)
+
+join_rule_lookups = Counter(
+    "synapse_guest_module_join_rule_lookups_total",
+    "Lookups of the join rules of a room when a guest joins it, by whether they "
+    "were served from the cache or queried from the room state",
+    ["source"],
+)
+
+
+class CallbackMetrics:
+    """The metrics of a single callback. The labels are resolved upfront, so
+    that recording a call only costs a counter increment and a histogram
+    observation.
+    """
+
+    def __init__(self, callback: str):
+        self._guest_calls = callback_calls.labels(callback, "guest")
+        self._other_calls = callback_calls.labels(callback, "other")
+        self._seconds = callback_seconds.labels(callback)
+
+    def record(self, is_guest: bool, start: float) -> None:
+        """Record a call of the callback.
+
+        Args:
+            is_guest: Whether the call concerned a guest
+            start: When the call started, as returned by `time.perf_counter()`
+        """
+        if is_guest:
+            self._guest_calls.inc()
+        else:
+            self._other_calls.inc()
+
+        self._seconds.observe(time.perf_counter() - start)
@@ -0,0 +1,112 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import time
+from collections import OrderedDict
+
+from synapse_guest_module.config import RateLimitConfig
+
+# How many clients the per-IP buckets are kept for. The buckets of the least
+# recently seen clients are dropped first, which resets them to a full bucket.
+MAX_TRACKED_CLIENTS = 10000
+
+
+class TokenBucket:
+    """A bucket that holds up to `burst` tokens and is refilled with `rate`
+    tokens per second. Every admitted request takes one token.
+    """
+
+    def __init__(self, rate: float, burst: int, now: float) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """Return how many seconds it takes until a token is available, or 0 if
+        there is one already.
+        """
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._updated_at) * self._rate
+        )
+        self._updated_at = now
+
+        if self._tokens >= 1:
+            return 0.0
+
+        return (1 - self._tokens) / self._rate
+
+    def take(self) -> None:
+        """Take a token. Only call this if `wait_time` returned 0."""
+        self._tokens -= 1
+
+
+class RegistrationRateLimiter:
+    """Admission control for guest registrations: a token bucket per client IP,
+    a global token bucket, and a cap on registrations that are in flight.
+    """
+
+    def __init__(self, config: RateLimitConfig) -> None:
+        self._config = config
+        self._per_ip: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._global: TokenBucket | None = None
+        if config.global_per_second > 0:
+            self._global = TokenBucket(
+                config.global_per_second, config.global_burst, time.monotonic()
+            )
+        self._in_flight = 0
+
+    def try_admit(self, client_ip: str) -> float:
+        """Admit a registration of the given client, unless a limit is hit.
+        Admitted registrations must call `release` once they are done.
+
+        Args:
+            client_ip: The IP address of the client
+
+        Returns:
+            0 if the registration is admitted, otherwise the number of seconds
+            after which the client should try again.
+        """
+        max_concurrent = self._config.max_concurrent
+        if max_concurrent > 0 and self._in_flight >= max_concurrent:
+            return 1.0
+
+        now = time.monotonic()
+        buckets = []
+        if self._config.per_ip_per_second > 0:
+            buckets.append(self._get_client_bucket(client_ip, now))
+        if self._global is not None:
+            buckets.append(self._global)
+
+        # Only take tokens if all buckets have one, so that a rejected request
+        # doesn't use up a token.
+        wait_time = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+        if wait_time > 0:
+            return wait_time
+
+        for bucket in buckets:
+            bucket.take()
+
+        self._in_flight += 1
+        return 0.0
+
+    def release(self) -> None:
+        """Mark an admitted registration as done."""
+        self._in_flight -= 1
+
+    def _get_client_bucket(self, client_ip: str, now: float) -> TokenBucket:
+        bucket = self._per_ip.get(client_ip)
+        if bucket is None:
+            bucket = TokenBucket(
+                self._config.per_ip_per_second, self._config.per_ip_burst, now
+            )
+            self._per_ip[client_ip] = bucket
+
+            while len(self._per_ip) > MAX_TRACKED_CLIENTS:
+                self._per_ip.popitem(last=False)
+        else:
+            self._per_ip.move_to_end(client_ip)
+
+        return bucket
@@ -0,0 +1,103 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import logging
+import secrets
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from synapse.module_api import ModuleApi
+
+from synapse_guest_module.cache import TtlLruCache
+from synapse_guest_module.config import RegistrationQueueConfig
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# How long, and for how many jobs, the results of finished jobs are kept.
+JOB_RESULT_TTL_SEC = 10 * 60
+JOB_RESULT_CACHE_SIZE = 10000
+
+RegistrationResult = Tuple[int, Dict[str, Any]]
+
+
+class RegistrationJobQueue:
+    """Runs registrations in the background, so that clients don't have to wait
+    for them. At most `workers` registrations run at a time, and at most
+    `max_queued` wait for a worker. Once the queue is full, new jobs are
+    rejected.
+
+    Jobs and their results are only kept in memory, so they are lost on a
+    restart.
+    """
+
+    def __init__(self, api: ModuleApi, config: RegistrationQueueConfig) -> None:
+        self._api = api
+        self._config = config
+        self._queue: Deque[
+            Tuple[str, Callable[[], Awaitable[RegistrationResult]]]
+        ] = deque()
+        # The jobs that are queued or running.
+        self._pending: Set[str] = set()
+        self._results: TtlLruCache[str, RegistrationResult] = TtlLruCache(
+            JOB_RESULT_CACHE_SIZE, JOB_RESULT_TTL_SEC
+        )
+        self._active_workers = 0
+
+    def submit(
+        self, func: Callable[[], Awaitable[RegistrationResult]]
+    ) -> Optional[str]:
+        """Queue a registration.
+
+        Args:
+            func: Performs the registration and returns its response
+
+        Returns:
+            The ID of the job, or None if the queue is full.
+        """
+        if len(self._queue) >= self._config.max_queued:
+            return None
+
+        # The ID is the only thing that protects the credentials of the
+        # registered user, so it has to be unguessable.
+        job_id = secrets.token_urlsafe(16)
+        self._pending.add(job_id)
+        self._queue.append((job_id, func))
+
+        if self._active_workers < self._config.workers:
+            self._active_workers += 1
+            self._api.run_as_background_process(
+                "guest_module_registration_worker", self._work, bg_start_span=False
+            )
+
+        return job_id
+
+    def is_pending(self, job_id: str) -> bool:
+        """Returns whether the job is queued or running."""
+        return job_id in self._pending
+
+    def get_result(self, job_id: str) -> Optional[RegistrationResult]:
+        """Returns the response of the finished job, or None if the job is
+        unknown, hasn't finished yet, or finished too long ago.
+        """
+        return self._results.get(job_id)
+
+    async def _work(self) -> None:
+        """Run queued jobs until the queue is empty."""
+        try:
+            while len(self._queue) > 0:
+                job_id, func = self._queue.popleft()
+
+                try:
+                    result = await func()
+                except Exception as e:
+                    logger.error(
+                        "Failed to register guest user in the background: %s", e
+                    )
+                    result = 500, {"msg": "Internal error: Could not register guest"}
+
+                self._results.set(job_id, result)
+                self._pending.discard(job_id)
+        finally:
+            self._active_workers -= 1
@@ -0,0 +1,109 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import asyncio
+import logging
+from typing import List
+
+from synapse.module_api import DatabasePool, LoggingTransaction, ModuleApi
+
+from synapse_guest_module.lease import DbLease
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# How many guests are removed from the user directory at a time.
+PURGE_BATCH_SIZE = 100
+
+# How often the user directory is checked for guests.
+PURGE_INTERVAL_SEC = 60.0
+
+# The user directory tables and the columns that reference the user, see
+# `UserDirectoryStore.remove_from_user_dir` in Synapse.
+USER_DIRECTORY_COLUMNS = [
+    ("user_directory", "user_id"),
+    ("user_directory_search", "user_id"),
+    ("users_in_public_rooms", "user_id"),
+    ("users_who_share_private_rooms", "user_id"),
+    ("users_who_share_private_rooms", "other_user_id"),
+]
+
+
+class UserDirectoryPurger:
+    """Removes the guests that are tracked by the module from the user
+    directory of Synapse.
+
+    Synapse has no hook to keep users out of the directory, and adds guests
+    again when their profile or room memberships change. The purger therefore
+    runs regularly, and guests only stay in the directory until the next run.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        tables_ready: asyncio.Event | None = None,
+    ):
+        self._api = api
+        self._tables_ready = tables_ready
+        self._lease = DbLease(api, "user_directory_purge", tables_ready)
+
+    async def run(self) -> None:
+        logger.info("User directory purge job started")
+
+        await self._api.sleep(5.0)  # Wait for Synapse to start properly
+
+        while True:
+            try:
+                if await self._lease.acquire():
+                    try:
+                        await self.purge()
+                    finally:
+                        await self._lease.release()
+            except Exception as e:
+                logger.error("Error while purging the user directory: %s", e)
+
+            await self._api.sleep(PURGE_INTERVAL_SEC)
+
+    async def purge(self) -> None:
+        """Remove all tracked guests from the user directory."""
+        if self._tables_ready is not None:
+            await self._tables_ready.wait()
+
+        purged_count = 0
+
+        while True:
+            purged = await self._api.run_db_interaction(
+                "guest_module_purge_user_directory", self._purge_batch_txn
+            )
+            purged_count += purged
+
+            if purged < PURGE_BATCH_SIZE:
+                break
+
+        if purged_count > 0:
+            logger.info("Removed %d guests from the user directory", purged_count)
+
+    @staticmethod
+    def _purge_batch_txn(txn: LoggingTransaction) -> int:
+        txn.execute(
+            """
+            SELECT user_id
+            FROM user_directory
+            WHERE user_id IN (
+                SELECT user_id FROM guest_module_users
+                UNION ALL
+                SELECT user_id FROM guest_module_mas_users
+            )
+            LIMIT ?
+            """,
+            (PURGE_BATCH_SIZE,),
+        )
+        user_ids: List[str] = [row[0] for row in txn.fetchall()]
+
+        for table, column in USER_DIRECTORY_COLUMNS:
+            DatabasePool.simple_delete_many_txn(
+                txn, table=table, column=column, values=user_ids, keyvalues={}
+            )
+
+        return len(user_ids)
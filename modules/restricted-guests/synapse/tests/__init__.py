@@ -9,11 +9,17 @@
 
 import sqlite3
 from asyncio import Future
-from typing import Any, Awaitable, Callable, Dict, Tuple, TypeVar
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, TypeVar
 from unittest.mock import Mock
 
 from synapse.http.client import SimpleHttpClient
+from synapse.metrics.background_process_metrics import (
+    run_as_background_process as _run_as_background_process,
+)
 from synapse.module_api import ModuleApi
+from synapse.storage.engines import Sqlite3Engine
+from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from synapse_guest_module import GuestModule
 
@@ -48,10 +54,14 @@ class CursorWrapper:
 
     def __init__(self, cursor: sqlite3.Cursor) -> None:
         self.cur = cursor
+        self.database_engine = Sqlite3Engine({"args": {"database": ":memory:"}})
 
     def execute(self, sql: str, args: Any) -> None:
         self.cur.execute(sql, args)
 
+    def execute_batch(self, sql: str, args: Any) -> None:
+        self.cur.executemany(sql, args)
+
     @property
     def rowcount(self) -> Any:
         return self.cur.rowcount
@@ -81,6 +91,21 @@ def make_awaitable(result: TV) -> Awaitable[TV]:
     return future
 
 
+def get_deferred_result(deferred: "defer.Deferred[TV]") -> TV:
+    """
+    Returns the result of a Deferred that has already fired, or raises the
+    exception it failed with.
+    """
+    results: List[Any] = []
+    deferred.addBoth(results.append)
+    assert len(results) == 1, "Deferred has not fired yet"
+
+    result = results[0]
+    if isinstance(result, Failure):
+        result.raiseException()
+    return result  # type: ignore[no-any-return]
+
+
 def get_qualified_user_id(username: str) -> str:
     return f"@{username}:matrix.local"
 
@@ -89,6 +114,31 @@ async def register_user(localpart: str, admin: bool = False) -> str:
     return f"@{localpart}:matrix.local"
 
 
+def run_as_background_process(
+    desc: str,
+    func: Callable[..., Awaitable[RV | None]],
+    *args: Any,
+    bg_start_span: bool = True,
+    **kwargs: Any,
+) -> "defer.Deferred[RV | None]":
+    """Runs the process like `ModuleApi.run_as_background_process` does."""
+    return _run_as_background_process(
+        desc,
+        "matrix.local",
+        func,
+        *args,
+        bg_start_span=bg_start_span,
+        **kwargs,
+    )
+
+
+async def sleep(seconds: float) -> None:
+    """Never wakes up, so that background loops started by the module park on
+    their first sleep instead of spinning during the tests.
+    """
+    await defer.Deferred()
+
+
 def create_module(
     config_override: Dict[str, Any] | None = None,
 ) -> Tuple[GuestModule, Mock, SQLiteStore]:
@@ -103,11 +153,15 @@ def create_module(
     module_api = Mock(spec=ModuleApi)
     module_api.http_client = client
     module_api.server_name = "matrix.local"
+    module_api.worker_name = None
+    module_api.worker_app = None
     module_api.public_baseurl = "https://matrix.local:1234/"
     module_api.run_db_interaction.side_effect = store.run_db_interaction
     module_api.get_qualified_user_id.side_effect = get_qualified_user_id
     module_api.check_user_exists.return_value = make_awaitable(False)
     module_api.register_user.side_effect = register_user
+    module_api.sleep.side_effect = sleep
+    module_api.run_as_background_process.side_effect = run_as_background_process
     module_api.register_device.return_value = make_awaitable(
         ("DEVICEID", "syn_registered_token", None, None)
     )
@@ -123,8 +177,7 @@ def create_module(
 
     module = GuestModule(config, module_api)
 
-    if getattr(module, "_mas_tables_ready", None) is not None:
-        module._mas_tables_ready.set()  # type: ignore[union-attr]
+    module._tables_ready.set()
 
     return module, module_api, store
 
@@ -141,10 +194,26 @@ def mas_config_override() -> Dict[str, Any]:
 
 
 def _setup_db(conn: sqlite3.Connection) -> None:
-    conn.execute("CREATE TABLE access_tokens(user_id text, token text)")
+    conn.execute(
+        "CREATE TABLE access_tokens(id bigint, user_id text, token text, device_id text, valid_until_ms bigint, puppets_user_id text, last_validated bigint, refresh_token_id bigint, used boolean)"
+    )
+    conn.execute(
+        "CREATE TABLE devices(user_id text, device_id text, display_name text, hidden boolean)"
+    )
     conn.execute(
         "CREATE TABLE users(name text, deactivated smallint, creation_ts bigint)"
     )
     conn.execute(
-        "CREATE TABLE guest_module_mas_users(mas_user_id text, user_id text, created_at_sec bigint)"
+        "CREATE TABLE guest_module_mas_users(mas_user_id text PRIMARY KEY, user_id text, created_at_sec bigint)"
+    )
+    conn.execute(
+        "CREATE TABLE guest_module_mas_user_pool(mas_user_id text PRIMARY KEY, user_id text, created_at_sec bigint)"
+    )
+    conn.execute(
+        "CREATE TABLE user_directory(user_id text, room_id text, display_name text, avatar_url text)"
+    )
+    conn.execute("CREATE TABLE user_directory_search(user_id text, value text)")
+    conn.execute("CREATE TABLE users_in_public_rooms(user_id text, room_id text)")
+    conn.execute(
+        "CREATE TABLE users_who_share_private_rooms(user_id text, other_user_id text, room_id text)"
     )
@@ -0,0 +1,95 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from typing import Dict
+
+import aiounittest
+from twisted.internet import defer
+
+from synapse_guest_module.async_helpers import SingleFlight
+from tests import get_deferred_result
+
+
+class SingleFlightTest(aiounittest.AsyncTestCase):
+    async def test_concurrent_calls_coalesced(self) -> None:
+        single_flight: SingleFlight[str] = SingleFlight()
+        pending: "defer.Deferred[str]" = defer.Deferred()
+        calls = 0
+
+        async def func() -> str:
+            nonlocal calls
+            calls += 1
+            return await pending
+
+        first = defer.ensureDeferred(single_flight.run("key", func))
+        second = defer.ensureDeferred(single_flight.run("key", func))
+        pending.callback("result")
+
+        self.assertEqual(get_deferred_result(first), "result")
+        self.assertEqual(get_deferred_result(second), "result")
+        self.assertEqual(calls, 1)
+
+    async def test_different_keys_not_coalesced(self) -> None:
+        single_flight: SingleFlight[str] = SingleFlight()
+        pending: Dict[str, "defer.Deferred[str]"] = {
+            "key-1": defer.Deferred(),
+            "key-2": defer.Deferred(),
+        }
+
+        first = defer.ensureDeferred(
+            single_flight.run("key-1", lambda: pending["key-1"])
+        )
+        second = defer.ensureDeferred(
+            single_flight.run("key-2", lambda: pending["key-2"])
+        )
+        pending["key-1"].callback("result-1")
+        pending["key-2"].callback("result-2")
+
+        self.assertEqual(get_deferred_result(first), "result-1")
+        self.assertEqual(get_deferred_result(second), "result-2")
+
+    async def test_sequential_calls_not_coalesced(self) -> None:
+        single_flight: SingleFlight[int] = SingleFlight()
+        calls = 0
+
+        async def func() -> int:
+            nonlocal calls
+            calls += 1
+            return calls
+
+        self.assertEqual(await single_flight.run("key", func), 1)
+        self.assertEqual(await single_flight.run("key", func), 2)
+
+    async def test_exception_shared(self) -> None:
+        single_flight: SingleFlight[str] = SingleFlight()
+        pending: "defer.Deferred[str]" = defer.Deferred()
+
+        async def func() -> str:
+            return await pending
+
+        first = defer.ensureDeferred(single_flight.run("key", func))
+        second = defer.ensureDeferred(single_flight.run("key", func))
+        pending.errback(ValueError("failed"))
+
+        with self.assertRaises(ValueError):
+            get_deferred_result(first)
+        with self.assertRaises(ValueError):
+            get_deferred_result(second)
+
+    async def test_cancelled_caller_does_not_cancel_others(self) -> None:
+        single_flight: SingleFlight[str] = SingleFlight()
+        pending: "defer.Deferred[str]" = defer.Deferred()
+
+        async def func() -> str:
+            return await pending
+
+        first = defer.ensureDeferred(single_flight.run("key", func))
+        second = defer.ensureDeferred(single_flight.run("key", func))
+        first.cancel()
+        pending.callback("result")
+
+        with self.assertRaises(defer.CancelledError):
+            get_deferred_result(first)
+        self.assertEqual(get_deferred_result(second), "result")
@@ -0,0 +1,128 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from typing import Any, Callable, List
+from unittest.mock import ANY, Mock
+
+import aiounittest
+from synapse.logging.context import make_deferred_yieldable
+from synapse.module_api import ModuleApi
+from twisted.internet import defer
+
+from synapse_guest_module.batch_inserter import MAX_BATCH_SIZE, BatchInserter
+from tests import SQLiteStore, get_deferred_result, run_as_background_process
+
+
+class BatchInserterTest(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        self.store = SQLiteStore()
+        self.store.conn.execute("CREATE TABLE things(id text, value bigint)")
+
+        # Every transaction waits until the test releases it.
+        self.transactions: List["defer.Deferred[None]"] = []
+        self.batches: List[List[Any]] = []
+
+        async def run_db_interaction(
+            desc: str, func: Callable[..., Any], rows: List[Any]
+        ) -> Any:
+            self.batches.append(rows)
+            transaction: "defer.Deferred[None]" = defer.Deferred()
+            self.transactions.append(transaction)
+            await make_deferred_yieldable(transaction)
+            return await self.store.run_db_interaction(desc, func, rows)
+
+        self.api = Mock(spec=ModuleApi)
+        self.api.run_db_interaction.side_effect = run_db_interaction
+        self.api.run_as_background_process.side_effect = run_as_background_process
+
+    def things(self) -> List[Any]:
+        return self.store.conn.execute(
+            "SELECT id, value FROM things ORDER BY id"
+        ).fetchall()
+
+    async def test_concurrent_rows_batched(self) -> None:
+        inserter = BatchInserter(self.api, "insert_things", "things", ("id", "value"))
+
+        first = defer.ensureDeferred(inserter.insert([("a", 1)]))
+        second = defer.ensureDeferred(inserter.insert([("b", 2)]))
+        third = defer.ensureDeferred(inserter.insert([("c", 3), ("d", 4)]))
+
+        # The first row is inserted right away, the others wait for it
+        self.assertEqual(self.batches, [[("a", 1)]])
+        self.transactions[0].callback(None)
+        self.assertIsNone(get_deferred_result(first))
+
+        self.assertEqual(self.batches[1], [("b", 2), ("c", 3), ("d", 4)])
+        self.assertFalse(second.called)
+        self.transactions[1].callback(None)
+
+        self.assertIsNone(get_deferred_result(second))
+        self.assertIsNone(get_deferred_result(third))
+        self.assertEqual(self.things(), [("a", 1), ("b", 2), ("c", 3), ("d", 4)])
+
+    async def test_max_batch_size(self) -> None:
+        inserter = BatchInserter(
+            self.api, "insert_things", "things", ("id", "value"), max_batch_size=2
+        )
+
+        results = [
+            defer.ensureDeferred(inserter.insert([(str(i), i)])) for i in range(5)
+        ]
+        for transaction in self.transactions:
+            transaction.callback(None)
+
+        for result in results:
+            self.assertIsNone(get_deferred_result(result))
+        self.assertEqual([len(batch) for batch in self.batches], [1, 2, 2])
+
+    async def test_more_rows_than_batch(self) -> None:
+        inserter = BatchInserter(self.api, "insert_things", "things", ("id", "value"))
+
+        rows = [(f"{i:03}", i) for i in range(MAX_BATCH_SIZE + 2)]
+        first = defer.ensureDeferred(inserter.insert(rows[:1]))
+        second = defer.ensureDeferred(inserter.insert(rows[1 : MAX_BATCH_SIZE + 1]))
+        third = defer.ensureDeferred(inserter.insert(rows[MAX_BATCH_SIZE + 1 :]))
+
+        self.transactions[0].callback(None)
+        self.assertIsNone(get_deferred_result(first))
+        self.assertFalse(third.called)
+
+        # The second batch is full, so the last row waits for another one
+        self.transactions[1].callback(None)
+        self.assertIsNone(get_deferred_result(second))
+        self.assertFalse(third.called)
+        self.transactions[2].callback(None)
+
+        self.assertIsNone(get_deferred_result(third))
+        self.assertEqual([len(batch) for batch in self.batches], [1, MAX_BATCH_SIZE, 1])
+        self.assertEqual(self.things(), rows)
+        # A single background process inserts all batches
+        self.api.run_as_background_process.assert_called_once_with(
+            "guest_module_batch_insert", ANY, bg_start_span=False
+        )
+
+    async def test_failure_raised_to_batch(self) -> None:
+        self.store.conn.execute("CREATE UNIQUE INDEX things_id ON things(id)")
+        inserter = BatchInserter(self.api, "insert_things", "things", ("id", "value"))
+
+        first = defer.ensureDeferred(inserter.insert([("a", 1)]))
+        second = defer.ensureDeferred(inserter.insert([("b", 2)]))
+        third = defer.ensureDeferred(inserter.insert([("a", 3)]))
+        self.transactions[0].callback(None)
+        self.transactions[1].callback(None)
+
+        self.assertIsNone(get_deferred_result(first))
+        with self.assertRaises(Exception):
+            get_deferred_result(second)
+        with self.assertRaises(Exception):
+            get_deferred_result(third)
+        self.assertEqual(self.things(), [("a", 1)])
+
+        # The next rows are inserted again
+        fourth = defer.ensureDeferred(inserter.insert([("b", 2)]))
+        self.transactions[2].callback(None)
+
+        self.assertIsNone(get_deferred_result(fourth))
+        self.assertEqual(self.things(), [("a", 1), ("b", 2)])
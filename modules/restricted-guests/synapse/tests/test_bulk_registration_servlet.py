@@ -0,0 +1,296 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import io
+import json
+from typing import Any, Dict, List, Tuple, cast
+from unittest.mock import AsyncMock, Mock, patch
+
+import aiounittest
+from synapse.http.site import SynapseRequest
+from synapse.types import create_requester
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.web.test.requesthelper import DummyRequest
+
+from synapse_guest_module import GuestModule
+from synapse_guest_module.bulk_registration_servlet import BULK_REGISTRATION_MAX_USERS
+from tests import SQLiteStore, create_module, make_awaitable, mas_config_override
+
+
+def bulk_request(body: Dict[str, Any]) -> Any:
+    request: Any = DummyRequest([])
+    request.content = io.BytesIO(json.dumps(body).encode("utf-8"))
+    return request
+
+
+def written_lines(request: DummyRequest) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in b"".join(request.written).splitlines()]
+
+
+class BulkGuestRegistrationServletTest(aiounittest.AsyncTestCase):
+    def create_module(
+        self, config_override: Dict[str, Any] | None = None, admin: bool = True
+    ) -> Tuple[GuestModule, Mock, SQLiteStore]:
+        module, module_api, store = create_module(config_override)
+
+        # `make_awaitable` is not needed here as both methods are already `AsyncMock`.
+        module_api.get_user_by_req.return_value = create_requester(
+            "@admin:matrix.local"
+        )
+        module_api.is_user_admin.return_value = admin
+
+        return module, module_api, store
+
+    async def render_POST(self, module: GuestModule, request: DummyRequest) -> Any:
+        return await module.bulk_registration_servlet._async_render_POST(
+            cast(SynapseRequest, request)
+        )
+
+    async def test_async_render_POST_not_admin(self) -> None:
+        module, module_api, _ = self.create_module(admin=False)
+
+        result = await self.render_POST(
+            module, bulk_request({"displaynames": ["My Name"]})
+        )
+
+        self.assertEqual(result, (403, {"msg": "You are not a server admin"}))
+        module_api.is_user_admin.assert_awaited_once_with("@admin:matrix.local")
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_invalid_displaynames(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        bodies: List[Dict[str, Any]] = [
+            {},
+            {"displaynames": []},
+            {"displaynames": ["My Name", " "]},
+        ]
+        for body in bodies:
+            result = await self.render_POST(module, bulk_request(body))
+
+            self.assertEqual(
+                result,
+                (400, {"msg": "You must provide 'displaynames' as a list of strings"}),
+            )
+
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_too_many_displaynames(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        result = await self.render_POST(
+            module,
+            bulk_request(
+                {"displaynames": ["Name"] * (BULK_REGISTRATION_MAX_USERS + 1)}
+            ),
+        )
+
+        self.assertEqual(
+            result, (400, {"msg": "You can register at most 1000 guests at once"})
+        )
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_success(self) -> None:
+        module, module_api, store = self.create_module()
+
+        request = bulk_request({"displaynames": ["First ", "Second", "Third"]})
+
+        result = await self.render_POST(module, request)
+
+        self.assertIsNone(result)
+        self.assertTrue(request.finished)
+        self.assertEqual(request.responseCode, 200)
+
+        lines = written_lines(request)
+        self.assertEqual(len(lines), 3)
+        for line in lines:
+            self.assertRegex(line["userId"], r"^@guest-.*:matrix.local$")
+            self.assertEqual(line["deviceId"], "DEVICEID")
+            self.assertEqual(line["accessToken"], "syn_registered_token")
+
+        self.assertEqual(
+            sorted(call.args[1] for call in module_api.register_user.call_args_list),
+            ["First (Guest)", "Second (Guest)", "Third (Guest)"],
+        )
+
+        stored_users = store.conn.execute(
+            "SELECT user_id FROM guest_module_users"
+        ).fetchall()
+        self.assertCountEqual(stored_users, [(line["userId"],) for line in lines])
+
+    async def test_async_render_POST_partial_failure(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        module_api.register_device.side_effect = [
+            make_awaitable(("DEVICEID", "syn_registered_token", None, None)),
+            Exception("device registration failed"),
+        ]
+
+        request = bulk_request({"displaynames": ["First", "Second"]})
+
+        await self.render_POST(module, request)
+
+        lines = written_lines(request)
+        self.assertEqual(lines[0]["accessToken"], "syn_registered_token")
+        self.assertEqual(lines[1], {"msg": "Internal error: Could not register guest"})
+
+    async def test_async_render_POST_store_failure_rolls_back(self) -> None:
+        module, module_api, store = self.create_module({"enable_user_reaper": True})
+        store.conn.execute("DROP TABLE guest_module_users")
+
+        hs = module_api._hs = Mock()
+        deactivate_account = AsyncMock()
+        hs.get_deactivate_account_handler.return_value.deactivate_account = (
+            deactivate_account
+        )
+
+        request = bulk_request({"displaynames": ["First", "Second"]})
+
+        await self.render_POST(module, request)
+
+        lines = written_lines(request)
+        self.assertEqual(
+            lines, [{"msg": "Internal error: Could not register guest"}] * 2
+        )
+        self.assertCountEqual(
+            [call.args[0] for call in deactivate_account.await_args_list],
+            [
+                f"@{call.args[0]}:matrix.local"
+                for call in module_api.register_user.call_args_list
+            ],
+        )
+        module_api.register_device.assert_not_called()
+
+    async def test_async_render_POST_mas_store_failure_rolls_back(self) -> None:
+        module, module_api, store = self.create_module(mas_config_override())
+        store.conn.execute("DROP TABLE guest_module_mas_users")
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+
+        async def post_json_get_json(
+            uri: str, post_json: Dict[str, Any], **kwargs: object
+        ) -> Dict[str, Any]:
+            if uri.endswith("/users"):
+                return {"data": {"id": "mas-" + post_json["username"]}}
+
+            return {}
+
+        module_api.http_client.post_json_get_json.side_effect = post_json_get_json
+
+        request = bulk_request({"displaynames": ["First", "Second"]})
+
+        await self.render_POST(module, request)
+
+        lines = written_lines(request)
+        self.assertEqual(
+            lines, [{"msg": "Internal error: Could not register guest"}] * 2
+        )
+        deactivated = [
+            call.kwargs["uri"]
+            for call in module_api.http_client.post_json_get_json.await_args_list
+            if call.kwargs["uri"].endswith("/deactivate")
+        ]
+        self.assertEqual(len(deactivated), 2)
+        module_api.set_displayname.assert_not_called()
+
+    @patch(
+        "synapse_guest_module.bulk_registration_servlet.BULK_REGISTRATION_BATCH_SIZE", 1
+    )
+    async def test_async_render_POST_client_disconnected(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        request = bulk_request({"displaynames": ["First", "Second"]})
+
+        def register_user(localpart: str, displayname: str) -> Any:
+            request.processingFailed(Failure(ConnectionDone()))  # type: ignore[no-untyped-call]
+            return make_awaitable(f"@{localpart}:matrix.local")
+
+        module_api.register_user.side_effect = register_user
+
+        await self.render_POST(module, request)
+
+        # The second batch isn't registered anymore
+        self.assertEqual(module_api.register_user.call_count, 1)
+        self.assertEqual(request.written, [])
+
+    async def test_async_render_POST_single_transaction(self) -> None:
+        module, module_api, store = self.create_module(
+            {"single_transaction_registration": True}
+        )
+
+        registrar = Mock()
+        registrar.register = AsyncMock(
+            side_effect=lambda localpart, displayname, created_at_sec: (
+                f"@{localpart}:matrix.local",
+                "DEVICEID",
+                "syt_token",
+            )
+        )
+        module.registration_servlet._get_local_registrar = Mock(  # type: ignore[method-assign]
+            return_value=registrar
+        )
+
+        request = bulk_request({"displaynames": ["First", "Second"]})
+
+        await self.render_POST(module, request)
+
+        lines = written_lines(request)
+        self.assertEqual([line["accessToken"] for line in lines], ["syt_token"] * 2)
+        self.assertEqual(
+            sorted(call.args[1] for call in registrar.register.await_args_list),
+            ["First (Guest)", "Second (Guest)"],
+        )
+        # The registrar stores the users and their devices itself
+        module_api.register_user.assert_not_called()
+        module_api.register_device.assert_not_called()
+
+    async def test_async_render_POST_mas_success(self) -> None:
+        module, module_api, store = self.create_module(mas_config_override())
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+
+        async def post_json_get_json(
+            uri: str, post_json: Dict[str, Any], **kwargs: object
+        ) -> Dict[str, Any]:
+            if uri.endswith("/users"):
+                return {"data": {"id": "mas-" + post_json["username"]}}
+
+            return {
+                "data": {
+                    "id": "MASDEVICE123",
+                    "attributes": {"access_token": "mas_access_token"},
+                }
+            }
+
+        module_api.http_client.post_json_get_json.side_effect = post_json_get_json
+
+        request = bulk_request({"displaynames": ["First", "Second"]})
+
+        await self.render_POST(module, request)
+
+        lines = written_lines(request)
+        self.assertEqual(len(lines), 2)
+        for line in lines:
+            self.assertEqual(line["accessToken"], "mas_access_token")
+
+        self.assertEqual(module_api.set_displayname.await_count, 2)
+
+        stored_users = store.conn.execute(
+            "SELECT mas_user_id, user_id FROM guest_module_mas_users"
+        ).fetchall()
+        self.assertCountEqual(
+            stored_users,
+            [
+                ("mas-" + line["userId"][1:].split(":")[0], line["userId"])
+                for line in lines
+            ],
+        )
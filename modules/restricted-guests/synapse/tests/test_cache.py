@@ -0,0 +1,46 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from unittest.mock import Mock, patch
+
+import aiounittest
+
+from synapse_guest_module.cache import TtlLruCache
+
+
+class TtlLruCacheTest(aiounittest.AsyncTestCase):
+    async def test_get_set(self) -> None:
+        cache: TtlLruCache[str, str] = TtlLruCache(10, 60)
+
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+
+    async def test_evict_least_recently_used(self) -> None:
+        cache: TtlLruCache[str, int] = TtlLruCache(2, 60)
+
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    @patch("synapse_guest_module.cache.time.monotonic")
+    async def test_expire(self, monotonic: Mock) -> None:
+        cache: TtlLruCache[str, str] = TtlLruCache(10, 60)
+
+        monotonic.return_value = 1000.0
+        cache.set("key", "value")
+
+        monotonic.return_value = 1059.0
+        self.assertEqual(cache.get("key"), "value")
+
+        monotonic.return_value = 1060.0
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(len(cache), 0)
@@ -7,18 +7,24 @@
 # Originally licensed under the Apache License, Version 2.0:
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
-from typing import Tuple
-from unittest.mock import Mock
+from typing import Any, Tuple
+from unittest.mock import ANY, AsyncMock, Mock, patch
 
 import aiounittest
 from parameterized import parameterized_class  # type: ignore[import-untyped]
-from synapse.module_api import ProfileInfo, UserProfile
+from prometheus_client import REGISTRY
+from synapse.module_api import NOT_SPAM, ProfileInfo, UserProfile, errors
 from synapse.module_api.errors import ConfigError
 from synapse.types import UserID
 
-from synapse_guest_module.config import GuestModuleConfig, MasConfig
+from synapse_guest_module.config import (
+    GuestModuleConfig,
+    MasConfig,
+    RateLimitConfig,
+    RegistrationQueueConfig,
+)
 from synapse_guest_module.guest_module import GuestModule
-from tests import SQLiteStore, create_module, mas_config_override
+from tests import SQLiteStore, create_module, make_awaitable, mas_config_override
 
 
 class GuestModuleConfigTest(aiounittest.AsyncTestCase):
@@ -85,6 +91,185 @@ class GuestModuleConfigTest(aiounittest.AsyncTestCase):
             ),
         )
 
+    async def test_parse_config_fail_reaper_concurrency(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'reaper_concurrency' must be a positive number"
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_concurrency": 0,
+                }
+            )
+
+    async def test_parse_config_additional_user_id_prefixes(self) -> None:
+        config = GuestModule.parse_config(
+            {
+                "additional_user_id_prefixes": ["visitor-", "kiosk-"],
+            }
+        )
+
+        self.assertEqual(config.additional_user_id_prefixes, ("visitor-", "kiosk-"))
+
+    async def test_parse_config_fail_additional_user_id_prefixes(self) -> None:
+        for prefixes in ["visitor-", [""], [1]]:
+            with self.assertRaisesRegex(
+                ConfigError,
+                "Config option 'additional_user_id_prefixes' must be a list of non-empty strings",
+            ):
+                GuestModule.parse_config(
+                    {
+                        "additional_user_id_prefixes": prefixes,
+                    }
+                )
+
+    async def test_parse_config_user_directory(self) -> None:
+        config = GuestModule.parse_config(
+            {
+                "purge_user_directory": True,
+                "filter_user_directory_search": False,
+            }
+        )
+
+        self.assertTrue(config.purge_user_directory)
+        self.assertFalse(config.filter_user_directory_search)
+
+    async def test_parse_config_fail_purge_user_directory(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'purge_user_directory' must be a bool"
+        ):
+            GuestModule.parse_config(
+                {
+                    "purge_user_directory": "yes",
+                }
+            )
+
+    async def test_parse_config_fail_filter_user_directory_search(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'filter_user_directory_search' must be a bool"
+        ):
+            GuestModule.parse_config(
+                {
+                    "filter_user_directory_search": "no",
+                }
+            )
+
+    async def test_parse_config_rate_limit(self) -> None:
+        config = GuestModule.parse_config(
+            {
+                "rate_limit": {
+                    "per_ip_per_second": 0.1,
+                    "global_per_second": 10,
+                    "max_concurrent": 20,
+                },
+            }
+        )
+
+        self.assertEqual(
+            config.rate_limit,
+            RateLimitConfig(
+                per_ip_per_second=0.1,
+                per_ip_burst=5,
+                global_per_second=10.0,
+                global_burst=50,
+                max_concurrent=20,
+            ),
+        )
+
+    async def test_parse_config_fail_rate_limit(self) -> None:
+        for rate_limit, message in [
+            ("fast", "Config option 'rate_limit' must be an object"),
+            (
+                {"per_ip_per_second": -1},
+                "Config option 'rate_limit.per_ip_per_second' must be a non-negative number",
+            ),
+            (
+                {"global_burst": 0},
+                "Config option 'rate_limit.global_burst' must be a positive number",
+            ),
+            (
+                {"max_concurrent": "10"},
+                "Config option 'rate_limit.max_concurrent' must be a non-negative number",
+            ),
+        ]:
+            with self.assertRaisesRegex(ConfigError, message):
+                GuestModule.parse_config(
+                    {
+                        "rate_limit": rate_limit,
+                    }
+                )
+
+    async def test_parse_config_registration_queue(self) -> None:
+        config = GuestModule.parse_config({"registration_queue": {"workers": 4}})
+
+        self.assertEqual(
+            config.registration_queue,
+            RegistrationQueueConfig(workers=4, max_queued=1000),
+        )
+
+    async def test_parse_config_fail_registration_queue(self) -> None:
+        for registration_queue, message in [
+            (True, "Config option 'registration_queue' must be an object"),
+            (
+                {"workers": 0},
+                "Config option 'registration_queue.workers' must be a positive number",
+            ),
+            (
+                {"max_queued": "10"},
+                "Config option 'registration_queue.max_queued' must be a positive number",
+            ),
+        ]:
+            with self.assertRaisesRegex(ConfigError, message):
+                GuestModule.parse_config({"registration_queue": registration_queue})
+
+    async def test_parse_config_mas_user_pool(self) -> None:
+        config = GuestModule.parse_config(
+            {
+                "mas": {
+                    "admin_api_base_url": "https://mas.example.org",
+                    "client_id": "client-id",
+                    "client_secret": "client-secret",
+                    "user_pool_size": 10,
+                },
+            }
+        )
+
+        assert config.mas is not None
+        self.assertEqual(config.mas.user_pool_size, 10)
+        self.assertEqual(config.mas.user_pool_low_water_mark, 5)
+
+    async def test_parse_config_fail_mas_user_pool_size(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'mas.user_pool_size' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "mas": {
+                        "admin_api_base_url": "https://mas.example.org",
+                        "client_id": "client-id",
+                        "client_secret": "client-secret",
+                        "user_pool_size": -1,
+                    },
+                }
+            )
+
+    async def test_parse_config_fail_mas_user_pool_low_water_mark(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'mas.user_pool_low_water_mark' must be lower than 'mas.user_pool_size'",
+        ):
+            GuestModule.parse_config(
+                {
+                    "mas": {
+                        "admin_api_base_url": "https://mas.example.org",
+                        "client_id": "client-id",
+                        "client_secret": "client-secret",
+                        "user_pool_size": 10,
+                        "user_pool_low_water_mark": 10,
+                    },
+                }
+            )
+
     async def test_parse_config_fail_user_id_prefix(self) -> None:
         with self.assertRaisesRegex(
             ConfigError, "Config option 'user_id_prefix' must be a string"
@@ -137,6 +322,75 @@ class GuestModuleRuntimeTest(aiounittest.AsyncTestCase):
     def create_module(self) -> Tuple[GuestModule, Mock, SQLiteStore]:
         return create_module(self.config_override)
 
+    async def test_backfill_users(self) -> None:
+        module, _, store = self.create_module()
+
+        store.conn.executemany(
+            "INSERT INTO users VALUES (?, ?, ?)",
+            [
+                ["@user-1:matrix.local", 0, 1],
+                ["@guest-reaper:matrix.local", 0, 2],
+                ["@guest-deactivated:matrix.local", 1, 3],
+                ["@guest-1:other.local", 0, 4],
+                ["@guest-1:matrix.local", 0, 5],
+            ],
+        )
+        store.conn.execute("DELETE FROM guest_module_migrations")
+
+        await store.run_db_interaction("backfill", module._backfill_users)
+
+        tracked_users = store.conn.execute(
+            "SELECT user_id, created_at_sec FROM guest_module_users"
+        ).fetchall()
+        self.assertEqual(tracked_users, [("@guest-1:matrix.local", 5)])
+
+    async def test_backfill_users_only_once(self) -> None:
+        module, _, store = self.create_module()
+
+        store.conn.execute(
+            "INSERT INTO users VALUES (?, ?, ?)", ["@guest-1:matrix.local", 0, 5]
+        )
+
+        await store.run_db_interaction("backfill", module._backfill_users)
+
+        tracked_users = store.conn.execute(
+            "SELECT user_id FROM guest_module_users"
+        ).fetchall()
+        self.assertEqual(tracked_users, [])
+
+    async def test_backfill_users_without_creation_time(self) -> None:
+        module, _, store = self.create_module()
+
+        store.conn.execute(
+            "INSERT INTO users VALUES (?, ?, ?)", ["@guest-1:matrix.local", 0, None]
+        )
+        store.conn.execute("DELETE FROM guest_module_migrations")
+
+        with patch("time.time", return_value=1000.0):
+            await store.run_db_interaction("backfill", module._backfill_users)
+
+        tracked_users = store.conn.execute(
+            "SELECT user_id, created_at_sec FROM guest_module_users"
+        ).fetchall()
+        self.assertEqual(tracked_users, [("@guest-1:matrix.local", 1000)])
+
+    async def test_init_tables_backfill_failure_keeps_tables(self) -> None:
+        module, _, store = self.create_module()
+
+        store.conn.execute("DROP TABLE guest_module_mas_user_pool")
+        store.conn.execute("DELETE FROM guest_module_migrations")
+        # Let the backfill fail
+        store.conn.execute("DROP TABLE users")
+
+        await module._init_tables()
+
+        self.assertTrue(module._tables_ready.is_set())
+        store.conn.execute("SELECT * FROM guest_module_mas_user_pool")
+        migrations = store.conn.execute(
+            "SELECT name FROM guest_module_migrations"
+        ).fetchall()
+        self.assertEqual(migrations, [])
+
     async def test_profile_update_no_guest(self) -> None:
         module, module_api, _ = self.create_module()
 
@@ -176,6 +430,78 @@ class GuestModuleRuntimeTest(aiounittest.AsyncTestCase):
             "My User (Guest)",
         )
 
+    async def test_profile_update_guest_in_process(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        hs = Mock()
+        profile_handler = hs.get_profile_handler.return_value
+        module_api._hs = hs
+
+        async def set_displayname(**kwargs: Any) -> None:
+            # Synapse calls the callback again for the module's own update
+            await module.profile_update(
+                kwargs["target_user"].to_string(),
+                ProfileInfo(display_name=kwargs["new_displayname"], avatar_url=None),
+                True,
+                False,
+            )
+
+        profile_handler.set_displayname = AsyncMock(side_effect=set_displayname)
+
+        await module.profile_update(
+            "@guest-asdf:matrix.local",
+            ProfileInfo(display_name="My User ", avatar_url=None),
+            True,
+            False,
+        )
+
+        profile_handler.set_displayname.assert_awaited_once_with(
+            target_user=UserID.from_string("@guest-asdf:matrix.local"),
+            requester=ANY,
+            new_displayname="My User (Guest)",
+            by_admin=True,
+            propagate=False,
+        )
+        module_api.set_displayname.assert_not_called()
+
+    async def test_profile_update_guest_renamed_during_fix(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        hs = Mock()
+        profile_handler = hs.get_profile_handler.return_value
+        module_api._hs = hs
+
+        renamed = False
+
+        async def set_displayname(**kwargs: Any) -> None:
+            nonlocal renamed
+            if not renamed:
+                # The guest renames themselves while the first fix is running
+                renamed = True
+                await module.profile_update(
+                    kwargs["target_user"].to_string(),
+                    ProfileInfo(display_name="Bar", avatar_url=None),
+                    False,
+                    False,
+                )
+
+        profile_handler.set_displayname = AsyncMock(side_effect=set_displayname)
+
+        await module.profile_update(
+            "@guest-asdf:matrix.local",
+            ProfileInfo(display_name="Foo", avatar_url=None),
+            False,
+            False,
+        )
+
+        self.assertEqual(
+            [
+                call.kwargs["new_displayname"]
+                for call in profile_handler.set_displayname.await_args_list
+            ],
+            ["Foo (Guest)", "Bar (Guest)"],
+        )
+
     async def test_callback_user_may_create_room_no_guest(self) -> None:
         module, _, _ = self.create_module()
 
@@ -194,6 +520,28 @@ class GuestModuleRuntimeTest(aiounittest.AsyncTestCase):
 
         self.assertFalse(allow)
 
+    async def test_callback_user_may_create_room_additional_prefix(self) -> None:
+        _, module_api, _ = self.create_module()
+        module = GuestModule(
+            GuestModule.parse_config(
+                {
+                    "enable_user_reaper": False,
+                    "additional_user_id_prefixes": ["visitor-"],
+                }
+            ),
+            module_api,
+        )
+
+        self.assertFalse(
+            await module.callback_user_may_create_room("@visitor-asdf:matrix.local")
+        )
+        self.assertFalse(
+            await module.callback_user_may_create_room("@guest-asdf:matrix.local")
+        )
+        self.assertTrue(
+            await module.callback_user_may_create_room("@my-user:matrix.local")
+        )
+
     async def test_callback_user_may_invite_no_guest(self) -> None:
         module, _, _ = self.create_module()
 
@@ -216,6 +564,177 @@ class GuestModuleRuntimeTest(aiounittest.AsyncTestCase):
 
         self.assertFalse(allow)
 
+    async def test_callback_user_may_join_room_no_guest(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        allow = await module.callback_user_may_join_room(
+            "@my-user:matrix.local", "!room:matrix.local", False
+        )
+
+        self.assertEqual(allow, NOT_SPAM)
+        module_api.get_state_events_in_room.assert_not_called()
+
+    async def test_callback_user_may_join_room_guest_invited(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", True
+        )
+
+        self.assertEqual(allow, NOT_SPAM)
+        module_api.get_state_events_in_room.assert_not_called()
+
+    async def test_callback_user_may_join_room_guest_knock(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable(
+            [{"content": {"join_rule": "knock_restricted"}}]
+        )
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", False
+        )
+
+        self.assertEqual(allow, NOT_SPAM)
+        module_api.get_state_events_in_room.assert_called_once_with(
+            "!room:matrix.local", [("m.room.join_rules", None)]
+        )
+
+    async def test_callback_user_may_join_room_guest_public(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable(
+            [{"content": {"join_rule": "public"}}]
+        )
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", False
+        )
+
+        self.assertEqual(allow, errors.Codes.FORBIDDEN)
+
+    async def test_callback_user_may_join_room_guest_no_join_rules(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable([])
+
+        for _ in range(2):
+            allow = await module.callback_user_may_join_room(
+                "@guest-asdf:matrix.local", "!room:matrix.local", False
+            )
+            self.assertEqual(allow, errors.Codes.BAD_STATE)
+
+        # A missing join rules event isn't cached
+        self.assertEqual(module_api.get_state_events_in_room.call_count, 2)
+
+    async def test_callback_user_may_join_room_join_rule_cached(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable(
+            [{"content": {"join_rule": "knock"}}]
+        )
+
+        for room_id in ["!room:matrix.local", "!room:matrix.local", "!other:local"]:
+            allow = await module.callback_user_may_join_room(
+                "@guest-asdf:matrix.local", room_id, False
+            )
+            self.assertEqual(allow, NOT_SPAM)
+
+        self.assertEqual(module_api.get_state_events_in_room.call_count, 2)
+
+    async def test_callback_user_may_join_room_metrics(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable(
+            [{"content": {"join_rule": "knock"}}]
+        )
+
+        def sample(name: str, **labels: str) -> float:
+            return REGISTRY.get_sample_value(name, labels) or 0.0
+
+        guest_calls = sample(
+            "synapse_guest_module_callback_calls_total",
+            callback="user_may_join_room",
+            user="guest",
+        )
+        other_calls = sample(
+            "synapse_guest_module_callback_calls_total",
+            callback="user_may_join_room",
+            user="other",
+        )
+        observed = sample(
+            "synapse_guest_module_callback_seconds_count",
+            callback="user_may_join_room",
+        )
+        cache_hits = sample(
+            "synapse_guest_module_join_rule_lookups_total", source="cache"
+        )
+        state_lookups = sample(
+            "synapse_guest_module_join_rule_lookups_total", source="state"
+        )
+
+        for user_id in [
+            "@guest-asdf:matrix.local",
+            "@guest-asdf:matrix.local",
+            "@my-user:matrix.local",
+        ]:
+            await module.callback_user_may_join_room(
+                user_id, "!room:matrix.local", False
+            )
+
+        self.assertEqual(
+            sample(
+                "synapse_guest_module_callback_calls_total",
+                callback="user_may_join_room",
+                user="guest",
+            ),
+            guest_calls + 2,
+        )
+        self.assertEqual(
+            sample(
+                "synapse_guest_module_callback_calls_total",
+                callback="user_may_join_room",
+                user="other",
+            ),
+            other_calls + 1,
+        )
+        self.assertEqual(
+            sample(
+                "synapse_guest_module_callback_seconds_count",
+                callback="user_may_join_room",
+            ),
+            observed + 3,
+        )
+        self.assertEqual(
+            sample("synapse_guest_module_join_rule_lookups_total", source="cache"),
+            cache_hits + 1,
+        )
+        self.assertEqual(
+            sample("synapse_guest_module_join_rule_lookups_total", source="state"),
+            state_lookups + 1,
+        )
+
+    async def test_callback_check_username_for_spam_not_registered(self) -> None:
+        _, module_api, _ = self.create_module()
+        module_api.register_spam_checker_callbacks.reset_mock()
+
+        GuestModule(
+            GuestModule.parse_config(
+                {
+                    "enable_user_reaper": False,
+                    "filter_user_directory_search": False,
+                }
+            ),
+            module_api,
+        )
+
+        module_api.register_spam_checker_callbacks.assert_called_once_with(
+            user_may_create_room=ANY,
+            user_may_invite=ANY,
+            user_may_join_room=ANY,
+            check_username_for_spam=None,
+        )
+
     async def test_callback_check_username_for_spam_no_guest(self) -> None:
         module, _, _ = self.create_module()
 
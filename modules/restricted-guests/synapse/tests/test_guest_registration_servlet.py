@@ -8,17 +8,30 @@
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
 import io
-from typing import Tuple, cast
-from unittest.mock import ANY, Mock
+from typing import Any, Dict, List, Tuple, cast
+from unittest.mock import ANY, AsyncMock, Mock, patch
 
 import aiounittest
 from parameterized import parameterized_class  # type: ignore[import-untyped]
+from prometheus_client import REGISTRY
+from synapse.api.errors import Codes, HttpResponseException, SynapseError
+from synapse.logging.context import make_deferred_yieldable
+from synapse.types import UserID
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
 from twisted.web.server import Request
 from twisted.web.test.requesthelper import DummyRequest
 
 from synapse_guest_module import GuestModule
 from synapse_guest_module.mas_admin_client import MasAdminClient
-from tests import SQLiteStore, create_module, make_awaitable, mas_config_override
+from tests import (
+    SQLiteStore,
+    create_module,
+    get_deferred_result,
+    make_awaitable,
+    mas_config_override,
+    register_user,
+)
 
 
 @parameterized_class(
@@ -58,13 +71,39 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
             response, {"msg": "You must provide a 'displayname' as a string"}
         )
 
+    def reject_localparts(self, module_api: Mock, count: int) -> Mock:
+        """Let the creation of the next `count` users fail because their
+        localpart is taken, and return the mock that creates users.
+        """
+        if self.config_override is None:
+            module_api.register_user.side_effect = [
+                SynapseError(400, "User ID already taken.", Codes.USER_IN_USE)
+            ] * count + [make_awaitable("@guest-new:matrix.local")]
+            return cast(Mock, module_api.register_user)
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token"
+        }
+        module_api.http_client.post_json_get_json.side_effect = [
+            HttpResponseException(409, "Conflict", b"")
+        ] * count + [
+            {"data": {"id": "mas-user-id"}},
+            {
+                "data": {
+                    "id": "MASDEVICE123",
+                    "attributes": {"access_token": "mas_access_token"},
+                }
+            },
+        ]
+        return cast(Mock, module_api.http_client.post_json_get_json)
+
     async def test_async_render_POST_no_free_username(self) -> None:
         module, module_api, _ = self.create_module()
 
         request = cast(Request, DummyRequest([]))
         request.content = io.BytesIO(b'{"displayname":"My Name"}')
 
-        module_api.check_user_exists.return_value = make_awaitable(True)
+        create_user = self.reject_localparts(module_api, 3)
 
         status, response = await module.registration_servlet._async_render_POST(request)
 
@@ -73,11 +112,126 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
             response, {"msg": "Internal error: Could not find a free username"}
         )
 
-        self.assertEqual(module_api.check_user_exists.call_count, 10)
+        self.assertEqual(create_user.call_count, 3)
+        module_api.check_user_exists.assert_not_called()
 
-    async def test_async_render_POST_success(self) -> None:
+    async def test_async_render_POST_taken_username_retried(self) -> None:
         module, module_api, _ = self.create_module()
 
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        create_user = self.reject_localparts(module_api, 1)
+
+        status, _ = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        first_localpart, second_localpart = [
+            call.args[0] if self.config_override is None else call.kwargs["post_json"]
+            for call in create_user.call_args_list[:2]
+        ]
+        self.assertNotEqual(first_localpart, second_localpart)
+
+    async def test_async_render_POST_metrics(self) -> None:
+        module, module_api, _ = self.create_module()
+        create_phase = (
+            "register_user" if self.config_override is None else ("mas_create_user")
+        )
+
+        def sample(name: str, labels: Dict[str, str] | None = None) -> float:
+            return REGISTRY.get_sample_value(name, labels) or 0.0
+
+        registered = sample(
+            "synapse_guest_module_registrations_total", {"status": "201"}
+        )
+        rejected = sample("synapse_guest_module_registrations_total", {"status": "400"})
+        conflicts = sample("synapse_guest_module_localpart_conflicts_total")
+        create_count = sample(
+            "synapse_guest_module_registration_phase_seconds_count",
+            {"phase": create_phase},
+        )
+        store_count = sample(
+            "synapse_guest_module_registration_phase_seconds_count",
+            {"phase": "store_user"},
+        )
+
+        self.reject_localparts(module_api, 1)
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+        status, _ = await module.registration_servlet._async_render_POST(request)
+        self.assertEqual(status, 201)
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b"{}")
+        status, _ = await module.registration_servlet._async_render_POST(request)
+        self.assertEqual(status, 400)
+
+        self.assertEqual(
+            sample("synapse_guest_module_registrations_total", {"status": "201"}),
+            registered + 1,
+        )
+        self.assertEqual(
+            sample("synapse_guest_module_registrations_total", {"status": "400"}),
+            rejected + 1,
+        )
+        self.assertEqual(
+            sample("synapse_guest_module_localpart_conflicts_total"), conflicts + 1
+        )
+        # Both the failed and the successful attempt are measured
+        self.assertEqual(
+            sample(
+                "synapse_guest_module_registration_phase_seconds_count",
+                {"phase": create_phase},
+            ),
+            create_count + 2,
+        )
+        self.assertEqual(
+            sample(
+                "synapse_guest_module_registration_phase_seconds_count",
+                {"phase": "store_user"},
+            ),
+            store_count + 1,
+        )
+
+    @patch("synapse_guest_module.rate_limiter.time.monotonic", return_value=1000.0)
+    async def test_async_render_POST_rate_limited(self, monotonic: Mock) -> None:
+        module, module_api, _ = create_module(
+            {
+                **(self.config_override or {}),
+                "rate_limit": {"per_ip_per_second": 0.5, "per_ip_burst": 1},
+            }
+        )
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+        request.client = IPv4Address("TCP", "1.2.3.4", 1234)
+        request_2 = cast(Request, DummyRequest([]))
+        request_2.content = io.BytesIO(b'{"displayname":"My Name"}')
+        request_2.client = IPv4Address("TCP", "1.2.3.4", 1234)
+
+        # The first request uses up the bucket, its result doesn't matter here
+        try:
+            await module.registration_servlet._async_render_POST(request)
+        except Exception:
+            pass
+        module_api.register_user.reset_mock()
+        module_api.http_client.post_json_get_json.reset_mock()
+
+        status, response = await module.registration_servlet._async_render_POST(
+            request_2
+        )
+
+        self.assertEqual(status, 429)
+        self.assertEqual(response["retry_after_ms"], 2000)
+        self.assertEqual(
+            request_2.responseHeaders.getRawHeaders(b"Retry-After"), [b"2"]
+        )
+        module_api.register_user.assert_not_called()
+        module_api.http_client.post_json_get_json.assert_not_called()
+
+    async def test_async_render_POST_success(self) -> None:
+        module, module_api, store = self.create_module()
+
         request = cast(Request, DummyRequest([]))
         request.content = io.BytesIO(b'{"displayname":"My Name "}')
 
@@ -104,7 +258,8 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
 
         self.assertEqual(status, 201)
 
-        self.assertRegex(response.pop("userId"), r"^@guest-[A-Za-z0-9]+:matrix.local$")
+        user_id = response.pop("userId")
+        self.assertRegex(user_id, r"^@guest-[A-Za-z0-9]+:matrix.local$")
         if self.config_override is None:
             self.assertDictEqual(
                 response,
@@ -116,6 +271,11 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
                 },
             )
             module_api.register_user.assert_called_with(ANY, "My Name (Guest)")
+
+            tracked_users = store.conn.execute(
+                "SELECT user_id FROM guest_module_users"
+            ).fetchall()
+            self.assertEqual(tracked_users, [(user_id,)])
         else:
             self.assertDictEqual(
                 response,
@@ -128,9 +288,615 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
             )
 
 
+def registration_request(idempotency_key: str | None = None) -> Request:
+    request = cast(Request, DummyRequest([]))
+    request.content = io.BytesIO(b'{"displayname":"My Name"}')
+    if idempotency_key is not None:
+        request.requestHeaders.setRawHeaders(b"Idempotency-Key", [idempotency_key])
+    return request
+
+
+class IdempotentGuestRegistrationTest(aiounittest.AsyncTestCase):
+    async def test_async_render_POST_retry_replays_response(self) -> None:
+        module, module_api, _ = create_module()
+
+        status, response = await module.registration_servlet._async_render_POST(
+            registration_request("0123456789abcdef")
+        )
+        self.assertEqual(status, 201)
+
+        (
+            retry_status,
+            retry_response,
+        ) = await module.registration_servlet._async_render_POST(
+            registration_request("0123456789abcdef")
+        )
+
+        self.assertEqual(retry_status, 201)
+        self.assertEqual(retry_response, response)
+        self.assertEqual(module_api.register_user.call_count, 1)
+
+        # A different key registers a new user
+        await module.registration_servlet._async_render_POST(
+            registration_request("fedcba9876543210")
+        )
+        self.assertEqual(module_api.register_user.call_count, 2)
+
+    async def test_async_render_POST_concurrent_duplicate_waits(self) -> None:
+        module, module_api, _ = create_module()
+
+        pending: "defer.Deferred[Any]" = defer.Deferred()
+
+        async def register_device(user_id: str) -> Any:
+            return await pending
+
+        module_api.register_device.side_effect = register_device
+
+        first = defer.ensureDeferred(
+            module.registration_servlet._async_render_POST(
+                registration_request("0123456789abcdef")
+            )
+        )
+        second = defer.ensureDeferred(
+            module.registration_servlet._async_render_POST(
+                registration_request("0123456789abcdef")
+            )
+        )
+        pending.callback(("DEVICEID", "syn_registered_token", None, None))
+
+        self.assertEqual(get_deferred_result(first), get_deferred_result(second))
+        self.assertEqual(module_api.register_user.call_count, 1)
+
+    async def test_async_render_POST_failure_not_replayed(self) -> None:
+        module, module_api, _ = create_module()
+
+        module_api.register_user.side_effect = SynapseError(
+            400, "User ID already taken.", Codes.USER_IN_USE
+        )
+        status, _ = await module.registration_servlet._async_render_POST(
+            registration_request("0123456789abcdef")
+        )
+        self.assertEqual(status, 500)
+
+        module_api.register_user.side_effect = register_user
+        status, _ = await module.registration_servlet._async_render_POST(
+            registration_request("0123456789abcdef")
+        )
+        self.assertEqual(status, 201)
+
+    async def test_async_render_POST_invalid_idempotency_key(self) -> None:
+        module, module_api, _ = create_module()
+
+        status, response = await module.registration_servlet._async_render_POST(
+            registration_request("short")
+        )
+
+        self.assertEqual(status, 400)
+        self.assertEqual(
+            response,
+            {
+                "msg": "The 'Idempotency-Key' header must have between 16 and 255 characters"
+            },
+        )
+        module_api.register_user.assert_not_called()
+
+
+class QueuedGuestRegistrationTest(aiounittest.AsyncTestCase):
+    def create_module(self) -> Tuple[GuestModule, Mock, SQLiteStore]:
+        return create_module({"registration_queue": {"workers": 1, "max_queued": 1}})
+
+    def job_request(self, job_id: str) -> Request:
+        request = cast(Request, DummyRequest([]))
+        request.args = {b"job_id": [job_id.encode("ascii")]}
+        return request
+
+    async def test_async_render_POST_respond_async(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        request = registration_request()
+        request.requestHeaders.setRawHeaders(b"Prefer", [b"respond-async"])
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 202)
+        job_id = response["job_id"]
+
+        status, response = await module.registration_servlet._async_render_GET(
+            self.job_request(job_id)
+        )
+
+        self.assertEqual(status, 201)
+        self.assertEqual(response["accessToken"], "syn_registered_token")
+
+    async def test_async_render_POST_queue_full(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        pending: "defer.Deferred[Any]" = defer.Deferred()
+
+        async def register_device(user_id: str) -> Any:
+            return await make_deferred_yieldable(pending)
+
+        module_api.register_device.side_effect = register_device
+
+        job_ids: List[str] = []
+        for _ in range(3):
+            request = registration_request()
+            request.requestHeaders.setRawHeaders(b"Prefer", [b"respond-async"])
+            status, response = await module.registration_servlet._async_render_POST(
+                request
+            )
+            if status == 202:
+                job_ids.append(response["job_id"])
+
+        # One job runs, one is queued, and the third is rejected
+        self.assertEqual(len(job_ids), 2)
+        self.assertEqual(status, 429)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"Retry-After"), [b"1"])
+
+        status, response = await module.registration_servlet._async_render_GET(
+            self.job_request(job_ids[1])
+        )
+        self.assertEqual((status, response), (202, {"job_id": job_ids[1]}))
+
+        pending.callback(("DEVICEID", "syn_registered_token", None, None))
+
+        for job_id in job_ids[:2]:
+            status, _ = await module.registration_servlet._async_render_GET(
+                self.job_request(job_id)
+            )
+            self.assertEqual(status, 201)
+
+    async def test_async_render_POST_retry_returns_same_job(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        pending: "defer.Deferred[Any]" = defer.Deferred()
+
+        async def register_device(user_id: str) -> Any:
+            return await make_deferred_yieldable(pending)
+
+        module_api.register_device.side_effect = register_device
+
+        def retry() -> Request:
+            request = registration_request("0123456789abcdef")
+            request.requestHeaders.setRawHeaders(b"Prefer", [b"respond-async"])
+            return request
+
+        status, response = await module.registration_servlet._async_render_POST(retry())
+        self.assertEqual(status, 202)
+        job_id = response["job_id"]
+
+        status, response = await module.registration_servlet._async_render_POST(retry())
+        self.assertEqual((status, response), (202, {"job_id": job_id}))
+
+        pending.callback(("DEVICEID", "syn_registered_token", None, None))
+
+        _, job_response = await module.registration_servlet._async_render_GET(
+            self.job_request(job_id)
+        )
+        status, response = await module.registration_servlet._async_render_POST(retry())
+        self.assertEqual((status, response), (201, job_response))
+
+        self.assertEqual(module_api.register_user.call_count, 1)
+
+    async def test_async_render_POST_invalid_idempotency_key(self) -> None:
+        module, module_api, _ = self.create_module()
+
+        request = registration_request("too-short")
+        request.requestHeaders.setRawHeaders(b"Prefer", [b"respond-async"])
+
+        status, _ = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 400)
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_without_preference(self) -> None:
+        module, _, _ = self.create_module()
+
+        status, _ = await module.registration_servlet._async_render_POST(
+            registration_request()
+        )
+
+        self.assertEqual(status, 201)
+
+    async def test_async_render_GET_unknown_job(self) -> None:
+        module, _, _ = self.create_module()
+
+        status, response = await module.registration_servlet._async_render_GET(
+            self.job_request("unknown")
+        )
+
+        self.assertEqual((status, response), (404, {"msg": "Unknown registration job"}))
+
+
+class SingleTransactionGuestRegistrationTest(aiounittest.AsyncTestCase):
+    def create_module(self) -> Tuple[GuestModule, Mock, SQLiteStore]:
+        module, module_api, store = create_module(
+            {
+                "single_transaction_registration": True,
+                "enable_user_reaper": True,
+                "user_expiration_seconds": 3600,
+            }
+        )
+
+        hs = module_api._hs = Mock()
+        hs.hostname = "matrix.local"
+        hs.get_auth_blocking.return_value.check_auth_blocking = AsyncMock()
+        hs.get_auth_handler.return_value.generate_access_token.return_value = (
+            "syt_token"
+        )
+        hs.get_account_validity_handler.return_value.on_user_registration = AsyncMock()
+        hs.get_device_handler.return_value.notify_device_update = AsyncMock()
+
+        main_store = hs.get_datastores.return_value.main
+        main_store._access_tokens_id_gen.get_next.return_value = 7
+
+        def register_user_txn(txn: Any, user_id: str, **kwargs: Any) -> None:
+            txn.execute(
+                "INSERT INTO users (name, deactivated, creation_ts) VALUES (?, 0, 0)",
+                (user_id,),
+            )
+
+        main_store._register_user.side_effect = register_user_txn
+
+        return module, module_api, store
+
+    @patch("synapse_guest_module.guest_registration_servlet.time.time")
+    async def test_async_render_POST_success(self, time: Mock) -> None:
+        time.return_value = 1000
+        module, module_api, store = self.create_module()
+
+        status, response = await module.registration_servlet._async_render_POST(
+            registration_request()
+        )
+
+        self.assertEqual(status, 201)
+        user_id = response["userId"]
+        self.assertEqual(response["accessToken"], "syt_token")
+
+        module_api.register_user.assert_not_called()
+        module_api.register_device.assert_not_called()
+
+        hs = module_api._hs
+        hs.get_datastores.return_value.main._register_user.assert_called_once_with(
+            ANY,
+            user_id=user_id,
+            password_hash=None,
+            was_guest=False,
+            make_guest=False,
+            appservice_id=None,
+            create_profile_with_displayname="My Name (Guest)",
+            admin=False,
+            user_type=ANY,
+            shadow_banned=False,
+            approved=False,
+        )
+        hs.get_device_handler.return_value.notify_device_update.assert_awaited_once_with(
+            user_id, [response["deviceId"]]
+        )
+
+        self.assertEqual(
+            store.conn.execute("SELECT user_id, device_id FROM devices").fetchall(),
+            [(user_id, response["deviceId"])],
+        )
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT id, user_id, token, valid_until_ms FROM access_tokens"
+            ).fetchall(),
+            [(7, user_id, "syt_token", 4600 * 1000)],
+        )
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT user_id, created_at_sec FROM guest_module_users"
+            ).fetchall(),
+            [(user_id, 1000)],
+        )
+
+    async def test_async_render_POST_worker_uses_module_api(self) -> None:
+        module, module_api, _ = self.create_module()
+        module_api.worker_app = "synapse.app.generic_worker"
+
+        status, _ = await module.registration_servlet._async_render_POST(
+            registration_request()
+        )
+
+        self.assertEqual(status, 201)
+        module_api.register_user.assert_called_once()
+        module_api._hs.get_datastores.return_value.main._register_user.assert_not_called()
+
+
+class LocalGuestRegistrationTest(aiounittest.AsyncTestCase):
+    def create_module(self) -> Tuple[GuestModule, Mock, SQLiteStore]:
+        module, module_api, store = create_module({"enable_user_reaper": True})
+
+        hs = module_api._hs = Mock()
+        hs.get_deactivate_account_handler.return_value.deactivate_account = AsyncMock()
+
+        return module, module_api, store
+
+    async def test_async_render_POST_store_failure_rolls_back(self) -> None:
+        module, module_api, store = self.create_module()
+        store.conn.execute("DROP TABLE guest_module_users")
+
+        with self.assertRaisesRegex(Exception, "no such table"):
+            await module.registration_servlet._async_render_POST(registration_request())
+
+        user_id = module_api.register_user.call_args.args[0]
+        deactivate_account = (
+            module_api._hs.get_deactivate_account_handler.return_value.deactivate_account
+        )
+        deactivate_account.assert_awaited_once_with(
+            module_api.get_qualified_user_id(user_id),
+            erase_data=False,
+            requester=ANY,
+            by_admin=True,
+        )
+        module_api.register_device.assert_not_called()
+
+
+class MasGuestRegistrationTest(aiounittest.AsyncTestCase):
+    def create_module(self) -> Tuple[GuestModule, Mock, SQLiteStore]:
+        module, module_api, store = create_module(mas_config_override())
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+
+        return module, module_api, store
+
+    async def test_async_render_POST_session_failure_rolls_back(self) -> None:
+        module, module_api, store = self.create_module()
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        module_api.http_client.post_json_get_json.side_effect = [
+            {"data": {"id": "mas-user-id"}},
+            Exception("session creation failed"),
+            {},
+        ]
+
+        with self.assertRaisesRegex(Exception, "session creation failed"):
+            await module.registration_servlet._async_render_POST(request)
+
+        module_api.set_displayname.assert_awaited_once()
+        module_api.http_client.post_json_get_json.assert_awaited_with(
+            uri="https://mas.example.org/api/admin/v1/users/mas-user-id/deactivate",
+            post_json={"skip_erase": True},
+            headers={"Authorization": ["Bearer mas_admin_token"]},
+        )
+
+        stored_users = store.conn.execute(
+            "SELECT mas_user_id FROM guest_module_mas_users"
+        ).fetchall()
+        self.assertEqual(stored_users, [])
+
+    async def test_async_render_POST_rollback_failure_keeps_user_for_reaper(
+        self,
+    ) -> None:
+        module, module_api, store = self.create_module()
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        module_api.set_displayname.side_effect = Exception("displayname failed")
+        module_api.http_client.post_json_get_json.side_effect = [
+            {"data": {"id": "mas-user-id"}},
+            {
+                "data": {
+                    "id": "MASDEVICE123",
+                    "attributes": {"access_token": "mas_access_token"},
+                }
+            },
+            Exception("deactivation failed"),
+        ]
+
+        with self.assertRaisesRegex(Exception, "displayname failed"):
+            await module.registration_servlet._async_render_POST(request)
+
+        stored_users = store.conn.execute(
+            "SELECT mas_user_id FROM guest_module_mas_users"
+        ).fetchall()
+        self.assertEqual(stored_users, [("mas-user-id",)])
+
+    async def test_async_render_POST_claims_pool_user(self) -> None:
+        config_override = mas_config_override()
+        config_override["mas"]["user_pool_size"] = 4
+        module, module_api, store = create_module(config_override)
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+        module_api.http_client.post_json_get_json.return_value = {
+            "data": {
+                "id": "MASDEVICE123",
+                "attributes": {"access_token": "mas_access_token"},
+            }
+        }
+        module.registration_servlet._mas_admin_client._generate_device_id = (  # type: ignore[method-assign,union-attr]
+            lambda: "MASDEVICE123"
+        )
+
+        store.conn.execute(
+            "INSERT INTO guest_module_mas_user_pool VALUES ('mas-pool', '@guest-pool:matrix.local', 0)"
+        )
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        self.assertDictEqual(
+            response,
+            {
+                "userId": "@guest-pool:matrix.local",
+                "accessToken": "mas_access_token",
+                "deviceId": "MASDEVICE123",
+                "homeserverUrl": "https://matrix.local:1234/",
+            },
+        )
+
+        # Only the session is created, the user came from the pool
+        self.assertEqual(module_api.http_client.post_json_get_json.await_count, 1)
+        module_api.set_displayname.assert_awaited_once_with(
+            UserID.from_string("@guest-pool:matrix.local"), "My Name (Guest)"
+        )
+
+        registered_users = store.conn.execute(
+            "SELECT mas_user_id, user_id FROM guest_module_mas_users"
+        ).fetchall()
+        self.assertEqual(registered_users, [("mas-pool", "@guest-pool:matrix.local")])
+
+
 class MasAdminClientTest(aiounittest.AsyncTestCase):
     async def test_generate_device_id_format(self) -> None:
         device_id = MasAdminClient._generate_device_id()
 
         self.assertGreaterEqual(len(device_id), 10)
         self.assertRegex(device_id, r"^[A-Za-z0-9-]+$")
+
+    def create_client(self) -> Tuple[MasAdminClient, Mock]:
+        module, module_api, _ = create_module(mas_config_override())
+        client = module.registration_servlet._mas_admin_client
+        assert client is not None
+        return client, module_api
+
+    async def test_request_admin_token_cached(self) -> None:
+        client, module_api = self.create_client()
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+
+        with patch("time.time", return_value=1000.0):
+            self.assertEqual(await client.request_admin_token(), "mas_admin_token")
+            self.assertEqual(await client.request_admin_token(), "mas_admin_token")
+
+        self.assertEqual(module_api.http_client.post_urlencoded_get_json.await_count, 1)
+
+    async def test_request_admin_token_without_expiry_not_cached(self) -> None:
+        client, module_api = self.create_client()
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+        }
+
+        await client.request_admin_token()
+        await client.request_admin_token()
+
+        self.assertEqual(module_api.http_client.post_urlencoded_get_json.await_count, 2)
+
+    async def test_request_admin_token_expired(self) -> None:
+        client, module_api = self.create_client()
+
+        module_api.http_client.post_urlencoded_get_json.side_effect = [
+            {"access_token": "mas_admin_token_1", "expires_in": 300},
+            {"access_token": "mas_admin_token_2", "expires_in": 300},
+        ]
+
+        with patch("time.time", return_value=1000.0):
+            self.assertEqual(await client.request_admin_token(), "mas_admin_token_1")
+        # The token is dropped before MAS considers it expired
+        with patch("time.time", return_value=1000.0 + 300 - 10):
+            self.assertEqual(await client.request_admin_token(), "mas_admin_token_2")
+
+    async def test_request_admin_token_refresh_in_background(self) -> None:
+        client, module_api = self.create_client()
+
+        module_api.http_client.post_urlencoded_get_json.side_effect = [
+            {"access_token": "mas_admin_token_1", "expires_in": 300},
+            {"access_token": "mas_admin_token_2", "expires_in": 300},
+        ]
+
+        with patch("time.time", return_value=1000.0):
+            self.assertEqual(await client.request_admin_token(), "mas_admin_token_1")
+        # Within the refresh window the cached token is still returned, while a
+        # new one is requested in the background.
+        with patch("time.time", return_value=1000.0 + 240):
+            self.assertEqual(await client.request_admin_token(), "mas_admin_token_1")
+            self.assertEqual(await client.request_admin_token(), "mas_admin_token_2")
+
+        self.assertEqual(module_api.http_client.post_urlencoded_get_json.await_count, 2)
+
+    async def test_deactivate_user_retries_on_unauthorized(self) -> None:
+        client, module_api = self.create_client()
+
+        module_api.http_client.post_urlencoded_get_json.side_effect = [
+            {"access_token": "mas_admin_token_1", "expires_in": 300},
+            {"access_token": "mas_admin_token_2", "expires_in": 300},
+        ]
+        module_api.http_client.post_json_get_json.side_effect = [
+            HttpResponseException(401, "Unauthorized", b""),
+            {},
+        ]
+
+        await client.deactivate_user("mas-user-id")
+
+        self.assertEqual(module_api.http_client.post_urlencoded_get_json.await_count, 2)
+        module_api.http_client.post_json_get_json.assert_awaited_with(
+            uri="https://mas.example.org/api/admin/v1/users/mas-user-id/deactivate",
+            post_json={"skip_erase": True},
+            headers={"Authorization": ["Bearer mas_admin_token_2"]},
+        )
+
+    async def test_deactivate_user_other_error(self) -> None:
+        client, module_api = self.create_client()
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+        module_api.http_client.post_json_get_json.side_effect = HttpResponseException(
+            404, "Not Found", b""
+        )
+
+        with self.assertRaises(HttpResponseException):
+            await client.deactivate_user("mas-user-id")
+
+        self.assertEqual(module_api.http_client.post_json_get_json.await_count, 1)
+
+    async def test_request_admin_token_concurrent_requests_coalesced(self) -> None:
+        client, module_api = self.create_client()
+
+        pending: "defer.Deferred[Dict[str, Any]]" = defer.Deferred()
+
+        async def post_urlencoded_get_json(*args: object) -> Dict[str, Any]:
+            return await pending
+
+        module_api.http_client.post_urlencoded_get_json.side_effect = (
+            post_urlencoded_get_json
+        )
+
+        requests = [
+            defer.ensureDeferred(client.request_admin_token()) for _ in range(5)
+        ]
+        pending.callback({"access_token": "mas_admin_token", "expires_in": 300})
+
+        for request in requests:
+            self.assertEqual(get_deferred_result(request), "mas_admin_token")
+        self.assertEqual(module_api.http_client.post_urlencoded_get_json.await_count, 1)
+
+    async def test_deactivate_user_concurrent_requests_coalesced(self) -> None:
+        client, module_api = self.create_client()
+
+        pending: "defer.Deferred[Dict[str, Any]]" = defer.Deferred()
+
+        async def post_json_get_json(**kwargs: object) -> Dict[str, Any]:
+            return await pending
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+        module_api.http_client.post_json_get_json.side_effect = post_json_get_json
+
+        first = defer.ensureDeferred(client.deactivate_user("mas-user-id"))
+        second = defer.ensureDeferred(client.deactivate_user("mas-user-id"))
+        pending.callback({})
+
+        get_deferred_result(first)
+        get_deferred_result(second)
+        self.assertEqual(module_api.http_client.post_json_get_json.await_count, 1)
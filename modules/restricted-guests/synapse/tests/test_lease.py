@@ -0,0 +1,70 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import time
+from typing import Tuple
+from unittest.mock import Mock
+
+import aiounittest
+
+from synapse_guest_module.lease import LEASE_DURATION_SEC, DbLease
+from tests import SQLiteStore, create_module
+
+
+class DbLeaseTest(aiounittest.AsyncTestCase):
+    def create_leases(self) -> Tuple[DbLease, DbLease, Mock, SQLiteStore]:
+        _, module_api, store = create_module()
+        return (
+            DbLease(module_api, "test"),
+            DbLease(module_api, "test"),
+            module_api,
+            store,
+        )
+
+    async def test_acquire(self) -> None:
+        lease, other_lease, _, _ = self.create_leases()
+
+        self.assertTrue(await lease.acquire())
+        self.assertFalse(await other_lease.acquire())
+
+    async def test_renew(self) -> None:
+        lease, _, _, store = self.create_leases()
+
+        self.assertTrue(await lease.acquire())
+        store.conn.execute("UPDATE guest_module_leases SET expires_at_sec = 0")
+
+        self.assertTrue(await lease.acquire())
+
+        (expires_at_sec,) = store.conn.execute(
+            "SELECT expires_at_sec FROM guest_module_leases"
+        ).fetchone()
+        self.assertGreaterEqual(
+            expires_at_sec, int(time.time()) + LEASE_DURATION_SEC - 1
+        )
+
+    async def test_acquire_expired(self) -> None:
+        lease, other_lease, _, store = self.create_leases()
+
+        self.assertTrue(await lease.acquire())
+        store.conn.execute("UPDATE guest_module_leases SET expires_at_sec = 0")
+
+        self.assertTrue(await other_lease.acquire())
+        self.assertFalse(await lease.acquire())
+
+    async def test_release(self) -> None:
+        lease, other_lease, _, _ = self.create_leases()
+
+        self.assertTrue(await lease.acquire())
+        await other_lease.release()
+        self.assertFalse(await other_lease.acquire())
+
+        await lease.release()
+        self.assertTrue(await other_lease.acquire())
+
+    async def test_other_names_independent(self) -> None:
+        lease, _, module_api, _ = self.create_leases()
+
+        self.assertTrue(await lease.acquire())
+        self.assertTrue(await DbLease(module_api, "other").acquire())
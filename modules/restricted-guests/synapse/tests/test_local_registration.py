@@ -0,0 +1,163 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import tempfile
+from typing import Any, Callable
+
+import aiounittest
+from signedjson.key import generate_signing_key, write_signing_keys
+from synapse.api.errors import Codes, SynapseError
+from synapse.app.homeserver import SynapseHomeServer
+from synapse.config.homeserver import HomeServerConfig
+from synapse.module_api import LoggingTransaction, ModuleApi
+from synapse.types import UserID
+from twisted.internet.testing import MemoryReactorClock
+from twisted.python.failure import Failure
+
+from synapse_guest_module import GuestModule
+from synapse_guest_module.local_registration import LocalGuestRegistrar
+from tests import get_deferred_result
+
+
+class SynchronousReactor(MemoryReactorClock):
+    """A fake reactor that runs the results of DB transactions right away."""
+
+    def callFromThread(
+        self, callable: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> None:
+        callable(*args, **kwargs)
+
+
+class SynchronousThreadPool:
+    """Runs DB transactions right away instead of in a thread, so that they
+    complete synchronously like the mocks of the other tests.
+    """
+
+    def callInThreadWithCallback(
+        self,
+        onResult: Callable[[bool, Any], None],
+        function: Callable[..., Any],
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            onResult(False, Failure())  # type: ignore[no-untyped-call]
+        else:
+            onResult(True, result)
+
+
+def setup_homeserver() -> SynapseHomeServer:
+    """Set up a homeserver with an in-memory SQLite database, so that the
+    registrar runs against the actual schema and storage of Synapse.
+    """
+    config_dir = tempfile.mkdtemp()
+    with open(f"{config_dir}/signing.key", "w") as signing_key:
+        write_signing_keys(signing_key, [generate_signing_key("test")])
+
+    config = HomeServerConfig()
+    config.parse_config_dict(
+        {
+            "server_name": "matrix.local",
+            "report_stats": False,
+            "database": {"name": "sqlite3", "args": {"database": ":memory:"}},
+            "signing_key_path": f"{config_dir}/signing.key",
+            "media_store_path": f"{config_dir}/media",
+            "public_baseurl": "https://matrix.local/",
+            "macaroon_secret_key": "macaroon-secret",
+            "form_secret": "form-secret",
+            "trusted_key_servers": [],
+        },
+        config_dir,
+        config_dir,
+    )
+
+    hs = SynapseHomeServer(
+        "matrix.local", config=config, reactor=SynchronousReactor()  # type: ignore[no-untyped-call,arg-type]
+    )
+    hs.setup()
+    for database in hs.get_datastores().databases:
+        database._db_pool.threadpool = SynchronousThreadPool()  # type: ignore[assignment]
+        database._db_pool.running = True
+
+    return hs
+
+
+class LocalGuestRegistrarTest(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        self.hs = setup_homeserver()
+        self.api = ModuleApi(self.hs, self.hs.get_auth_handler())
+        # The cached methods of the store aren't typed without the mypy plugin
+        # of Synapse.
+        self.store: Any = self.hs.get_datastores().main
+
+        def create_table(txn: LoggingTransaction) -> None:
+            txn.execute(
+                """
+                CREATE TABLE guest_module_users (
+                    user_id TEXT PRIMARY KEY NOT NULL,
+                    created_at_sec BIGINT NOT NULL
+                )
+                """,
+                (),
+            )
+
+        get_deferred_result(
+            self.api.run_db_interaction("create_guest_module_users", create_table)
+        )
+
+    def create_registrar(self) -> LocalGuestRegistrar:
+        config = GuestModule.parse_config(
+            {"enable_user_reaper": True, "user_expiration_seconds": 3600}
+        )
+        return LocalGuestRegistrar(self.api, self.hs, config)
+
+    async def test_register(self) -> None:
+        registrar = self.create_registrar()
+
+        user_id, device_id, access_token = await registrar.register(
+            "guest-new", "My Name (Guest)", 1000
+        )
+
+        self.assertEqual(user_id, "@guest-new:matrix.local")
+
+        user = await self.store.get_user_by_id(user_id)
+        assert user is not None
+        self.assertFalse(user.is_admin)
+        self.assertFalse(user.is_guest)
+
+        profile = await self.store.get_profile_displayname(UserID.from_string(user_id))
+        self.assertEqual(profile, "My Name (Guest)")
+
+        device = await self.store.get_device(user_id, device_id)
+        assert device is not None
+        self.assertEqual(device["device_id"], device_id)
+
+        token = await self.store.get_user_by_access_token(access_token)
+        assert token is not None
+        self.assertEqual(token.user_id, user_id)
+        self.assertEqual(token.device_id, device_id)
+        # The token expires together with the user
+        self.assertEqual(token.valid_until_ms, (1000 + 3600) * 1000)
+
+        def get_tracked_users(txn: LoggingTransaction) -> object:
+            txn.execute("SELECT user_id, created_at_sec FROM guest_module_users", ())
+            return txn.fetchall()
+
+        tracked_users = await self.api.run_db_interaction(
+            "get_tracked_users", get_tracked_users
+        )
+        self.assertEqual(tracked_users, [(user_id, 1000)])
+
+    async def test_register_taken_localpart(self) -> None:
+        registrar = self.create_registrar()
+        await registrar.register("guest-taken", "First (Guest)", 1000)
+
+        with self.assertRaises(SynapseError) as error:
+            await registrar.register("guest-taken", "Second (Guest)", 1000)
+
+        # The servlet retries with another localpart on this error
+        self.assertEqual(error.exception.errcode, Codes.USER_IN_USE)
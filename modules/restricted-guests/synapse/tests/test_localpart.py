@@ -0,0 +1,30 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from synapse_guest_module.localpart import generate_localpart
+
+
+class GenerateLocalpartTest(TestCase):
+    def test_format(self) -> None:
+        localpart = generate_localpart("guest-")
+
+        self.assertRegex(localpart, r"^guest-[0-9a-hjkmnp-tv-z]{26}$")
+
+    def test_unique(self) -> None:
+        localparts = {generate_localpart("guest-") for _ in range(1000)}
+
+        self.assertEqual(len(localparts), 1000)
+
+    @patch("synapse_guest_module.localpart.time.time_ns")
+    def test_ordered_by_time(self, time_ns: Mock) -> None:
+        time_ns.return_value = 1_700_000_000_000_000_000
+        earlier = generate_localpart("guest-")
+        time_ns.return_value += 1_000_000
+        later = generate_localpart("guest-")
+
+        self.assertLess(earlier, later)
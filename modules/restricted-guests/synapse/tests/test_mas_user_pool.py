@@ -0,0 +1,180 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from typing import Any, Dict, Tuple
+from unittest.mock import Mock, patch
+
+import aiounittest
+
+from synapse_guest_module import GuestModule
+from synapse_guest_module.mas_user_pool import MasUserPool, drain_mas_user_pool
+from tests import SQLiteStore, create_module, mas_config_override
+
+
+class MasUserPoolTest(aiounittest.AsyncTestCase):
+    def create_module(self) -> Tuple[GuestModule, MasUserPool, Mock, SQLiteStore]:
+        config_override = mas_config_override()
+        config_override["mas"]["user_pool_size"] = 4
+        config_override["mas"]["user_pool_low_water_mark"] = 2
+        module, module_api, store = create_module(config_override)
+
+        assert module.mas_user_pool is not None
+
+        module_api.http_client.post_urlencoded_get_json.return_value = {
+            "access_token": "mas_admin_token",
+            "expires_in": 300,
+        }
+
+        created = 0
+
+        async def post_json_get_json(**kwargs: Any) -> Dict[str, Any]:
+            nonlocal created
+            created += 1
+            return {"data": {"id": f"mas-pool-{created}"}}
+
+        module_api.http_client.post_json_get_json.side_effect = post_json_get_json
+
+        return module, module.mas_user_pool, module_api, store
+
+    async def test_refill_empty_pool(self) -> None:
+        _, pool, module_api, store = self.create_module()
+
+        await pool.refill()
+
+        self.assertEqual(module_api.http_client.post_json_get_json.await_count, 4)
+        pool_users = store.conn.execute(
+            "SELECT mas_user_id, user_id FROM guest_module_mas_user_pool ORDER BY mas_user_id"
+        ).fetchall()
+        self.assertEqual(
+            [row[0] for row in pool_users], [f"mas-pool-{i}" for i in range(1, 5)]
+        )
+        for _, user_id in pool_users:
+            self.assertRegex(user_id, r"^@guest-[a-z0-9]+:matrix.local$")
+
+    async def test_refill_above_low_water_mark(self) -> None:
+        _, pool, module_api, store = self.create_module()
+
+        store.conn.executemany(
+            "INSERT INTO guest_module_mas_user_pool VALUES (?, ?, ?)",
+            [
+                ["mas-1", "@guest-1:matrix.local", 0],
+                ["mas-2", "@guest-2:matrix.local", 0],
+                ["mas-3", "@guest-3:matrix.local", 0],
+            ],
+        )
+
+        await pool.refill()
+
+        module_api.http_client.post_json_get_json.assert_not_awaited()
+
+    async def test_refill_at_low_water_mark(self) -> None:
+        _, pool, module_api, store = self.create_module()
+
+        store.conn.executemany(
+            "INSERT INTO guest_module_mas_user_pool VALUES (?, ?, ?)",
+            [
+                ["mas-1", "@guest-1:matrix.local", 0],
+                ["mas-2", "@guest-2:matrix.local", 0],
+            ],
+        )
+
+        await pool.refill()
+
+        self.assertEqual(module_api.http_client.post_json_get_json.await_count, 2)
+        (count,) = store.conn.execute(
+            "SELECT COUNT(*) FROM guest_module_mas_user_pool"
+        ).fetchone()
+        self.assertEqual(count, 4)
+
+    async def test_claim_user(self) -> None:
+        _, pool, _, store = self.create_module()
+
+        store.conn.executemany(
+            "INSERT INTO guest_module_mas_user_pool VALUES (?, ?, ?)",
+            [
+                ["mas-new", "@guest-new:matrix.local", 200],
+                ["mas-old", "@guest-old:matrix.local", 100],
+            ],
+        )
+
+        with patch("time.time", return_value=1000.0):
+            claimed = await pool.claim_user()
+
+        self.assertEqual(claimed, ("mas-old", "@guest-old:matrix.local"))
+        pool_users = store.conn.execute(
+            "SELECT mas_user_id FROM guest_module_mas_user_pool"
+        ).fetchall()
+        self.assertEqual(pool_users, [("mas-new",)])
+        # The expiration starts with the claim
+        registered_users = store.conn.execute(
+            "SELECT mas_user_id, user_id, created_at_sec FROM guest_module_mas_users"
+        ).fetchall()
+        self.assertEqual(
+            registered_users, [("mas-old", "@guest-old:matrix.local", 1000)]
+        )
+
+    async def test_claim_user_empty_pool(self) -> None:
+        _, pool, _, store = self.create_module()
+
+        claimed = await pool.claim_user()
+
+        self.assertIsNone(claimed)
+        registered_users = store.conn.execute(
+            "SELECT mas_user_id FROM guest_module_mas_users"
+        ).fetchall()
+        self.assertEqual(registered_users, [])
+
+    async def test_claim_user_wakes_refill_at_low_water_mark(self) -> None:
+        _, pool, _, store = self.create_module()
+
+        store.conn.executemany(
+            "INSERT INTO guest_module_mas_user_pool VALUES (?, ?, ?)",
+            [[f"mas-{i}", f"@guest-{i}:matrix.local", i] for i in range(4)],
+        )
+
+        with patch.object(pool._sleeper, "wake") as wake:
+            # The pool still holds more than the low-water mark
+            await pool.claim_user()
+            wake.assert_not_called()
+
+            await pool.claim_user()
+            wake.assert_called_once()
+
+    async def test_claim_user_empty_pool_doesnt_wake_refill(self) -> None:
+        _, pool, _, _ = self.create_module()
+
+        with patch.object(pool._sleeper, "wake") as wake:
+            self.assertIsNone(await pool.claim_user())
+
+        wake.assert_not_called()
+
+    async def test_drain_disabled_pool(self) -> None:
+        _, module_api, store = create_module(mas_config_override())
+
+        store.conn.executemany(
+            "INSERT INTO guest_module_mas_user_pool VALUES (?, ?, ?)",
+            [
+                ["mas-1", "@guest-1:matrix.local", 100],
+                ["mas-2", "@guest-2:matrix.local", 200],
+            ],
+        )
+
+        await drain_mas_user_pool(module_api)
+
+        pool_users = store.conn.execute(
+            "SELECT mas_user_id FROM guest_module_mas_user_pool"
+        ).fetchall()
+        self.assertEqual(pool_users, [])
+        registered_users = store.conn.execute(
+            "SELECT mas_user_id, user_id, created_at_sec FROM guest_module_mas_users"
+            " ORDER BY mas_user_id"
+        ).fetchall()
+        self.assertEqual(
+            registered_users,
+            [
+                ("mas-1", "@guest-1:matrix.local", 100),
+                ("mas-2", "@guest-2:matrix.local", 200),
+            ],
+        )
@@ -0,0 +1,74 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from unittest.mock import Mock, patch
+
+import aiounittest
+
+from synapse_guest_module.config import RateLimitConfig
+from synapse_guest_module.rate_limiter import RegistrationRateLimiter
+
+
+@patch("synapse_guest_module.rate_limiter.time.monotonic", return_value=1000.0)
+class RegistrationRateLimiterTest(aiounittest.AsyncTestCase):
+    async def test_no_limits(self, monotonic: Mock) -> None:
+        limiter = RegistrationRateLimiter(RateLimitConfig())
+
+        for _ in range(100):
+            self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+
+    async def test_per_ip_limit(self, monotonic: Mock) -> None:
+        limiter = RegistrationRateLimiter(
+            RateLimitConfig(per_ip_per_second=0.5, per_ip_burst=2)
+        )
+
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 2.0)
+
+        # Other clients have their own bucket
+        self.assertEqual(limiter.try_admit("5.6.7.8"), 0)
+
+        monotonic.return_value = 1001.0
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 1.0)
+
+        monotonic.return_value = 1002.0
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+
+    async def test_global_limit(self, monotonic: Mock) -> None:
+        limiter = RegistrationRateLimiter(
+            RateLimitConfig(global_per_second=1, global_burst=2)
+        )
+
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+        self.assertEqual(limiter.try_admit("5.6.7.8"), 0)
+        self.assertEqual(limiter.try_admit("9.9.9.9"), 1.0)
+
+    async def test_rejected_request_takes_no_token(self, monotonic: Mock) -> None:
+        limiter = RegistrationRateLimiter(
+            RateLimitConfig(
+                per_ip_per_second=1,
+                per_ip_burst=1,
+                global_per_second=1,
+                global_burst=1,
+            )
+        )
+
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+        # Rejected by the global bucket, must not empty the bucket of this IP
+        self.assertEqual(limiter.try_admit("5.6.7.8"), 1.0)
+
+        monotonic.return_value = 1001.0
+        self.assertEqual(limiter.try_admit("5.6.7.8"), 0)
+
+    async def test_max_concurrent(self, monotonic: Mock) -> None:
+        limiter = RegistrationRateLimiter(RateLimitConfig(max_concurrent=2))
+
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
+        self.assertGreater(limiter.try_admit("1.2.3.4"), 0)
+
+        limiter.release()
+        self.assertEqual(limiter.try_admit("1.2.3.4"), 0)
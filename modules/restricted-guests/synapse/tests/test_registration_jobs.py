@@ -0,0 +1,86 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+from typing import Any, Dict, List, Tuple
+from unittest.mock import Mock
+
+import aiounittest
+from synapse.logging.context import make_deferred_yieldable
+from synapse.module_api import ModuleApi
+from twisted.internet import defer
+
+from synapse_guest_module.config import RegistrationQueueConfig
+from synapse_guest_module.registration_jobs import RegistrationJobQueue
+from tests import run_as_background_process
+
+
+def create_job_queue(config: RegistrationQueueConfig) -> RegistrationJobQueue:
+    api = Mock(spec=ModuleApi)
+    api.run_as_background_process.side_effect = run_as_background_process
+    return RegistrationJobQueue(api, config)
+
+
+class RegistrationJobQueueTest(aiounittest.AsyncTestCase):
+    async def test_jobs_bounded(self) -> None:
+        job_queue = create_job_queue(RegistrationQueueConfig(1, 1))
+        pending: List["defer.Deferred[Tuple[int, Dict[str, Any]]]"] = [
+            defer.Deferred(),
+            defer.Deferred(),
+        ]
+        started: List[int] = []
+
+        def job(index: int) -> Any:
+            async def register() -> Tuple[int, Dict[str, Any]]:
+                started.append(index)
+                return await make_deferred_yieldable(pending[index])
+
+            return register
+
+        first = job_queue.submit(job(0))
+        second = job_queue.submit(job(1))
+        assert first is not None and second is not None
+
+        # The only worker is busy and the queue is full
+        self.assertIsNone(job_queue.submit(job(2)))
+        self.assertEqual(started, [0])
+        self.assertTrue(job_queue.is_pending(first))
+        self.assertTrue(job_queue.is_pending(second))
+
+        pending[0].callback((201, {"userId": "@first:matrix.local"}))
+
+        self.assertEqual(started, [0, 1])
+        self.assertFalse(job_queue.is_pending(first))
+        self.assertEqual(
+            job_queue.get_result(first), (201, {"userId": "@first:matrix.local"})
+        )
+        self.assertIsNone(job_queue.get_result(second))
+
+        pending[1].callback((201, {"userId": "@second:matrix.local"}))
+
+        self.assertEqual(
+            job_queue.get_result(second), (201, {"userId": "@second:matrix.local"})
+        )
+        # The queue accepts jobs again
+        self.assertIsNotNone(job_queue.submit(job(0)))
+
+    async def test_failed_job(self) -> None:
+        job_queue = create_job_queue(RegistrationQueueConfig())
+
+        async def register() -> Tuple[int, Dict[str, Any]]:
+            raise Exception("registration failed")
+
+        job_id = job_queue.submit(register)
+        assert job_id is not None
+
+        self.assertEqual(
+            job_queue.get_result(job_id),
+            (500, {"msg": "Internal error: Could not register guest"}),
+        )
+
+    async def test_unknown_job(self) -> None:
+        job_queue = create_job_queue(RegistrationQueueConfig())
+
+        self.assertFalse(job_queue.is_pending("unknown"))
+        self.assertIsNone(job_queue.get_result("unknown"))
@@ -0,0 +1,99 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the project root for full details.
+
+import sqlite3
+from typing import List
+from unittest.mock import patch
+
+import aiounittest
+
+from synapse_guest_module.user_directory_purger import UserDirectoryPurger
+from tests import create_module
+
+
+def add_to_user_directory(conn: sqlite3.Connection, user_id: str) -> None:
+    conn.execute(
+        "INSERT INTO user_directory VALUES (?, ?, ?, ?)",
+        [user_id, "!room:matrix.local", user_id, None],
+    )
+    conn.execute("INSERT INTO user_directory_search VALUES (?, ?)", [user_id, user_id])
+    conn.execute(
+        "INSERT INTO users_in_public_rooms VALUES (?, ?)",
+        [user_id, "!room:matrix.local"],
+    )
+    conn.execute(
+        "INSERT INTO users_who_share_private_rooms VALUES (?, ?, ?)",
+        [user_id, "@user-1:matrix.local", "!private:matrix.local"],
+    )
+    conn.execute(
+        "INSERT INTO users_who_share_private_rooms VALUES (?, ?, ?)",
+        ["@user-1:matrix.local", user_id, "!private:matrix.local"],
+    )
+
+
+def users_in_directory(conn: sqlite3.Connection) -> List[str]:
+    return sorted(
+        user_id
+        for (user_id,) in conn.execute("SELECT user_id FROM user_directory").fetchall()
+    )
+
+
+class UserDirectoryPurgerTest(aiounittest.AsyncTestCase):
+    async def test_purge(self) -> None:
+        _, module_api, store = create_module()
+        purger = UserDirectoryPurger(module_api)
+
+        store.conn.execute(
+            "INSERT INTO guest_module_users VALUES (?, ?)",
+            ["@guest-local:matrix.local", 0],
+        )
+        store.conn.execute(
+            "INSERT INTO guest_module_mas_users VALUES (?, ?, ?)",
+            ["mas-1", "@guest-mas:matrix.local", 0],
+        )
+        for user_id in [
+            "@user-1:matrix.local",
+            "@guest-local:matrix.local",
+            "@guest-mas:matrix.local",
+        ]:
+            add_to_user_directory(store.conn, user_id)
+
+        await purger.purge()
+
+        self.assertEqual(users_in_directory(store.conn), ["@user-1:matrix.local"])
+        for table, column in [
+            ("user_directory_search", "user_id"),
+            ("users_in_public_rooms", "user_id"),
+            ("users_who_share_private_rooms", "user_id"),
+            ("users_who_share_private_rooms", "other_user_id"),
+        ]:
+            rows = store.conn.execute(
+                f"SELECT 1 FROM {table} WHERE {column} LIKE '@guest-%'"
+            ).fetchall()
+            self.assertEqual(rows, [], f"{table}.{column}")
+
+    @patch("synapse_guest_module.user_directory_purger.PURGE_BATCH_SIZE", 2)
+    async def test_purge_in_batches(self) -> None:
+        _, module_api, store = create_module()
+        purger = UserDirectoryPurger(module_api)
+
+        for i in range(5):
+            store.conn.execute(
+                "INSERT INTO guest_module_users VALUES (?, ?)",
+                [f"@guest-{i}:matrix.local", 0],
+            )
+            add_to_user_directory(store.conn, f"@guest-{i}:matrix.local")
+
+        await purger.purge()
+
+        self.assertEqual(users_in_directory(store.conn), [])
+        self.assertEqual(
+            [
+                c.args[0]
+                for c in module_api.run_db_interaction.call_args_list
+                if c.args[0] == "guest_module_purge_user_directory"
+            ],
+            ["guest_module_purge_user_directory"] * 3,
+        )